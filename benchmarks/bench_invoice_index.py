@@ -0,0 +1,79 @@
+"""Benchmark: invoice lookup by linear cache scan vs. the per-customer index.
+
+Builds a synthetic cache of Tabs invoices and resolves one invoice per
+split CSV, the way Step 2 "Map Invoices to Split CSVs" does.
+
+    python benchmarks/bench_invoice_index.py --invoices 100000 --splits 300
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generators import invoice_issue_dates, make_customer_ids, make_invoices  # noqa: E402
+from invoice_cache import InvoiceIndex  # noqa: E402
+
+
+def find_invoice_linear(invoices, customer_id, issue_date):
+    """The pre-index lookup: one pass over every cached invoice per split."""
+    valid_invoices = []
+    for invoice in invoices:
+        if (invoice.get("customerId", "") == customer_id and
+                invoice.get("status", "").upper() != "DELETED" and
+                invoice.get("source", "").upper() == "TABS"):
+            invoice_date_str = invoice.get("issueDate", "")
+            if issue_date and invoice_date_str:
+                try:
+                    if pd.to_datetime(invoice_date_str).date() == issue_date:
+                        valid_invoices.append(invoice)
+                except Exception:
+                    valid_invoices.append(invoice)
+            else:
+                valid_invoices.append(invoice)
+    if valid_invoices:
+        valid_invoices.sort(key=lambda x: x.get("issueDate", ""), reverse=True)
+        return valid_invoices[0].get("id")
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invoices", type=int, default=100_000)
+    parser.add_argument("--customers", type=int, default=2_000)
+    parser.add_argument("--splits", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    invoices = make_invoices(args.invoices, make_customer_ids(args.customers, args.seed), args.seed)
+    rng = random.Random(args.seed + 1)
+    lookups = [
+        (rng.choice(invoices)["customerId"], rng.choice(invoice_issue_dates()))
+        for _ in range(args.splits)
+    ]
+
+    t0 = time.perf_counter()
+    expected = [find_invoice_linear(invoices, c, d) for c, d in lookups]
+    linear_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    index = InvoiceIndex.from_invoices(invoices)
+    build_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    actual = [index.find_invoice(c, d) for c, d in lookups]
+    lookup_s = time.perf_counter() - t0
+
+    assert actual == expected, "index lookup disagrees with the linear scan"
+    print(f"invoices={args.invoices:,} customers={args.customers:,} splits={args.splits:,}")
+    print(f"linear scan:  {linear_s:8.3f}s")
+    print(f"index build:  {build_s:8.3f}s")
+    print(f"index lookup: {lookup_s:8.4f}s")
+    print(f"speedup:      {linear_s / (build_s + lookup_s):8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
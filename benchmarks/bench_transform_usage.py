@@ -0,0 +1,125 @@
+"""Benchmark: the usage transformation on synthetic Income/LBPA exports.
+
+Generates seeded Income and LBPA exports with the LoanLogics columns, runs
+``build_usage`` and reports the time. With ``--baseline REV`` the
+transformation from that git revision is run on the same input as well (its
+``build_usage``, or ``transform_usage`` from revisions where it was still
+part of ``new.py``), and the generated ``LoanLogics_upload_All.csv`` files
+must be byte-identical.
+``--chunksize`` runs the low-memory streaming mode; run each mode in its own
+process to compare their peak memory.
+
+    python benchmarks/bench_transform_usage.py --rows 2000000 --baseline HEAD~1
+    python benchmarks/bench_transform_usage.py --rows 2000000 --chunksize 250000
+"""
+import argparse
+import ast
+import logging
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+from collections import Counter
+from functools import partial
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Older revisions kept the transformation in new.py, which renders the
+# Streamlit page at import time, so only the definitions it needs are loaded
+_DEFINITIONS = {"_def_norm_regex", "normalize_name", "normalize_names", "find_column", "get_api_key", "transform_usage"}
+sys.path.insert(0, REPO_DIR)
+
+import usage_schema  # noqa: E402
+from generators import make_export, make_mappings  # noqa: E402
+from loanlogics_usage_transformer import build_usage  # noqa: E402
+from row_store import RowStore, read_csv_chunks  # noqa: E402
+
+
+def git_show(revision: str, path: str) -> str | None:
+    shown = subprocess.run(["git", "show", f"{revision}:{path}"], cwd=REPO_DIR, capture_output=True, text=True)
+    return shown.stdout if shown.returncode == 0 else None
+
+
+def build_current(*args, **kwargs) -> bytes:
+    return build_usage(*args, **kwargs).usage_csv
+
+
+def load_baseline(revision: str):
+    """``build_usage``-like callable returning the usage CSV at ``revision``."""
+    label = f"{revision}:loanlogics_usage_transformer.py"
+    source = git_show(revision, "loanlogics_usage_transformer.py")
+    if source and "def build_usage(" in source:
+        namespace = {"__name__": "baseline_usage_transformer", "__file__": os.path.join(REPO_DIR, "loanlogics_usage_transformer.py")}
+        exec(compile(source, label, "exec"), namespace)
+        return lambda *args, **kwargs: namespace["build_usage"](*args, **kwargs).usage_csv
+    transform_usage = load_transform_usage(git_show(revision, "new.py"), f"{revision}:new.py")
+
+    def build(income, lbpa, mappings, **kwargs):
+        st.session_state["generated_files"] = {}
+        transform_usage(income, lbpa, mappings=mappings, **kwargs)
+        return st.session_state["generated_files"]["usage_combined"]["bytes"]
+    return build
+
+
+def load_transform_usage(source: str, label: str):
+    tree = ast.parse(source)
+    nodes = [
+        node for node in tree.body
+        if (isinstance(node, ast.FunctionDef) and node.name in _DEFINITIONS)
+        or (isinstance(node, ast.Assign) and any(getattr(t, "id", None) in _DEFINITIONS for t in node.targets))
+    ]
+    namespace = {
+        "pd": pd, "np": np, "re": re, "os": os, "Counter": Counter, "partial": partial, "st": st,
+        "RowStore": RowStore, "read_csv_chunks": read_csv_chunks, "API_KEY": "",
+        **{name: getattr(usage_schema, name) for name in dir(usage_schema) if not name.startswith("_")},
+    }
+    exec(compile(ast.Module(nodes, type_ignores=[]), label, "exec"), namespace)
+    return namespace["transform_usage"]
+
+
+def run(build, income: bytes, lbpa: bytes, mappings: dict, **kwargs) -> tuple[float, bytes]:
+    t0 = time.perf_counter()
+    usage_csv = build(BytesIO(income), BytesIO(lbpa), mappings, usage_date="2024-09-30", **kwargs)
+    return time.perf_counter() - t0, usage_csv
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000, help="rows per export")
+    parser.add_argument("--accounts", type=int, default=3_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunksize", type=int, help="stream the exports in chunks of this many rows")
+    parser.add_argument("--baseline", help="git revision whose new.py to compare against")
+    args = parser.parse_args()
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    income = make_export(args.rows, args.accounts, args.seed)
+    lbpa = make_export(args.rows, args.accounts, args.seed + 1)
+    mappings = make_mappings(args.accounts, args.seed)
+    print(f"rows={args.rows:,} per export  accounts={args.accounts:,}")
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    current_s, current_csv = run(build_current, income, lbpa, mappings, chunksize=args.chunksize)
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+    mode = f"streaming, chunks of {args.chunksize:,}" if args.chunksize else "in memory"
+    print(f"working tree: {current_s:8.2f}s ({mode})")
+    print(f"input size:   {(len(income) + len(lbpa)) / 2**20:8.0f} MiB")
+    print(f"peak RSS:     {rss_peak / 1024:8.0f} MiB ({rss_before / 1024:.0f} MiB before the transform)")
+
+    if args.baseline:
+        baseline = load_baseline(args.baseline)
+        baseline_s, baseline_csv = run(baseline, income, lbpa, mappings)
+        assert current_csv == baseline_csv, "LoanLogics_upload_All.csv differs from the baseline"
+        print(f"{args.baseline}: {baseline_s:8.2f}s")
+        print(f"speedup:      {baseline_s / current_s:8.2f}x (output byte-identical)")
+
+
+if __name__ == "__main__":
+    main()
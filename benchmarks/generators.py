@@ -0,0 +1,128 @@
+"""Seeded synthetic inputs for the benchmarks.
+
+Every generator is deterministic for a given seed, so two runs (or two
+revisions) benchmark exactly the same data:
+
+- ``make_export``: an Income or LBPA transaction export with the LoanLogics columns
+- ``make_mappings``: client mappings shaped like ``client_mappings.json``
+- ``make_clients_csv``: a clients CSV as exported for ``extract_mappings_from_clients``
+- ``make_invoices``: invoice payloads as returned by ``GET /v3/invoices``
+
+Accounts are numbered from ``FIRST_ACCOUNT``; account ``FIRST_ACCOUNT + i``
+belongs to customer ``tabs_customer_id(i)``, so the three agree with each
+other.
+"""
+import random
+import uuid
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+# ============ CONFIG ============
+FIRST_ACCOUNT = 1000
+SLICE_ROWS = 250_000              # rows generated at a time
+USAGE_START = "2024-07-01"        # exports cover the 92 days from here
+INVOICE_START = date(2023, 1, 31)
+INVOICE_MONTHS = 36               # invoices are issued every 30 days from INVOICE_START
+# =================================
+
+
+def tabs_customer_id(i: int) -> str:
+    """The Tabs customer ID of synthetic account ``FIRST_ACCOUNT + i``."""
+    return str(uuid.UUID(int=int(i), version=4))
+
+
+def invoice_issue_dates() -> list[date]:
+    """Every issue date ``make_invoices`` uses, oldest first."""
+    return [INVOICE_START + timedelta(days=30 * month) for month in range(INVOICE_MONTHS)]
+
+
+def make_export(rows: int, accounts: int, seed: int, slice_rows: int = SLICE_ROWS) -> bytes:
+    """An Income/LBPA export of ``rows`` transactions over ``accounts`` accounts, as CSV bytes."""
+    # Generated in slices so building the input does not dominate peak RSS
+    rng = np.random.default_rng(seed)
+    customers = np.array([f"Customer {i}" for i in range(accounts // 3 + 1)] + ["Finastra"], dtype=object)
+    parts = []
+    for start in range(0, rows, slice_rows):
+        n = min(slice_rows, rows - start)
+        account_ids = rng.integers(FIRST_ACCOUNT, FIRST_ACCOUNT + accounts, n)
+        df = pd.DataFrame({
+            "CustomerName": customers[(account_ids - FIRST_ACCOUNT) % len(customers)],
+            "AccountName": np.char.add("Branch ", (account_ids % 97).astype(str)).astype(object),
+            "AccountID": account_ids,
+            "LoanNumber": rng.integers(10**9, 10**10, n),
+            "SubmissionDate": (np.datetime64(USAGE_START) + rng.integers(0, 92, n)).astype(str),
+            "IsInitialSubmission": rng.integers(0, 2, n),
+            "UnitsAsPerSubmission": rng.integers(0, 6, n),
+        })
+        parts.append(df.to_csv(index=False, header=not parts).encode("utf-8"))
+    return b"".join(parts)
+
+
+def make_mappings(accounts: int, seed: int) -> dict:
+    """Client mappings for ``make_export`` accounts: 90% have a Tabs ID, every
+    fourth is billed per unit for LBPA."""
+    rng = np.random.default_rng(seed)
+    mapped = rng.random(accounts) < 0.9
+    return {
+        "parent_to_id": {"finastra": "tabs-finastra"},
+        "acct_to_tabs_id": {str(FIRST_ACCOUNT + i): tabs_customer_id(i) for i in range(accounts) if mapped[i]},
+        "acct_to_ns_id": {},
+        "acct_to_income_evt": {},
+        "acct_to_lbpa_evt": {str(FIRST_ACCOUNT + i): "Units" for i in range(0, accounts, 4)},
+        "acct_to_diff_name": {},
+        "acct_to_base_name": {},
+    }
+
+
+def make_clients_csv(rows: int, seed: int) -> bytes:
+    """A clients CSV of ``rows`` rows: one Income and one LBPA row per account,
+    under a banner like the exported client list, as CSV bytes.
+
+    As in the real list, most accounts carry only a NetSuite ID, several
+    accounts share a customer name (and are told apart by their account name)
+    and billing is per unit or per application."""
+    rng = np.random.default_rng(seed)
+    parts = [b"LoanLogics Client List,,,,,,,\nExported,,,,,,,\n"]
+    for start in range(0, rows, SLICE_ROWS):
+        n = min(SLICE_ROWS, rows - start)
+        account = (start + np.arange(n)) // 2
+        customer = account // 3
+        has_tabs_id = rng.random(n) < 0.3
+        df = pd.DataFrame({
+            "Name": np.char.add("Customer ", customer.astype(str)).astype(object),
+            "Name With Prefix": np.char.add("LL - Customer ", customer.astype(str)).astype(object),
+            "Account Name": np.char.add("Branch ", account.astype(str)).astype(object),
+            "Acct#": FIRST_ACCOUNT + account,
+            "ID": np.where(has_tabs_id, [tabs_customer_id(i) for i in account], ""),
+            "NetSuite ID": (45000 + account).astype(float),
+            "Rev. Type": np.where((start + np.arange(n)) % 2 == 0, "Income", "LBPA"),
+            "Billing Type": np.where(rng.random(n) < 0.5, "Units", "Per Application"),
+        })
+        parts.append(df.to_csv(index=False, header=len(parts) == 1).encode("utf-8"))
+    return b"".join(parts)
+
+
+def make_invoices(n_invoices: int, customer_ids: list[str], seed: int) -> list[dict]:
+    """``n_invoices`` invoice payloads for ``customer_ids``, issued on
+    ``invoice_issue_dates()``. Some are deleted or come from NetSuite, and
+    issue dates are given both as dates and as timestamps, as the API does."""
+    rng = random.Random(seed)
+    invoices = []
+    for _ in range(n_invoices):
+        issue = INVOICE_START + timedelta(days=30 * rng.randrange(INVOICE_MONTHS))
+        invoices.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "customerId": rng.choice(customer_ids),
+            "issueDate": issue.isoformat() if rng.random() < 0.5 else f"{issue.isoformat()}T00:00:00.000Z",
+            "status": "DELETED" if rng.random() < 0.05 else "OPEN",
+            "source": "TABS" if rng.random() < 0.9 else "NETSUITE",
+        })
+    return invoices
+
+
+def make_customer_ids(n_customers: int, seed: int) -> list[str]:
+    """``n_customers`` random Tabs customer IDs (customers without synthetic accounts)."""
+    rng = random.Random(seed)
+    return [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(n_customers)]
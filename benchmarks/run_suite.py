@@ -0,0 +1,257 @@
+"""Benchmark suite: the pipeline's heavy steps on synthetic inputs at several scales.
+
+Runs each benchmark at each scale (rows per input) on the seeded inputs of
+``generators`` and writes the results as JSON, so runs on two revisions
+can be compared:
+
+- ``transform_usage``: ``build_usage`` on Income and LBPA exports of that many rows each
+- ``extract_mappings``: ``extract_mappings_from_clients`` on a clients CSV of that many rows
+- ``split_csvs``: ``generate_split_csvs_with_all_columns`` on the usage built from those exports
+- ``invoice_lookup``: building the invoice index over that many cached invoices and
+  mapping one split per customer through it, as Step 2 and the command line do
+
+Each benchmark runs in a fresh process, so its peak RSS is its own. Exports
+of ``STREAM_FROM_ROWS`` rows or more are streamed in chunks (low-memory
+mode) unless ``--chunksize`` says otherwise.
+
+    python benchmarks/run_suite.py --output results.json
+    python benchmarks/run_suite.py --scales 10k,100k,1M,10M --output results.json
+    python benchmarks/run_suite.py --benchmarks invoice_lookup --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from generators import (  # noqa: E402
+    SLICE_ROWS, invoice_issue_dates, make_clients_csv, make_customer_ids, make_export, make_invoices, make_mappings,
+)
+from invoice_cache import RECORD_FIELDS, InvoiceCache, invoices_to_records  # noqa: E402
+from loanlogics_usage_transformer import (  # noqa: E402
+    build_usage, extract_mappings_from_clients, generate_split_csvs_with_all_columns, map_invoices,
+)
+from run_metrics import RunMetrics  # noqa: E402
+from usage_schema import read_usage  # noqa: E402
+
+# ============ CONFIG ============
+BENCHMARKS = ("transform_usage", "extract_mappings", "split_csvs", "invoice_lookup")
+DEFAULT_SCALES = "10k,100k,1M"
+STREAM_FROM_ROWS = 2_000_000   # exports at least this large are streamed by default
+STREAM_CHUNKSIZE = 250_000
+USAGE_DATE = "2024-09-30"
+# =================================
+
+_SUFFIXES = {"k": 10**3, "m": 10**6}
+
+
+def parse_scale(text: str) -> int:
+    """``10k`` -> 10000, ``2.5M`` -> 2500000, ``500`` -> 500."""
+    text = text.strip().lower().replace("_", "")
+    if text and text[-1] in _SUFFIXES:
+        return int(float(text[:-1]) * _SUFFIXES[text[-1]])
+    return int(text)
+
+
+def format_scale(rows: int) -> str:
+    for suffix, size in (("M", 10**6), ("k", 10**3)):
+        if rows >= size and rows % size == 0:
+            return f"{rows // size}{suffix}"
+    return str(rows)
+
+
+def git_revision() -> str | None:
+    """HEAD's commit, with ``-dirty`` when the tree has uncommitted changes."""
+    try:
+        head = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{head}-dirty" if dirty else head
+
+
+def stream_chunksize(rows: int, chunksize: int | None) -> int | None:
+    """Chunk size the exports are read in (None: in memory)."""
+    if chunksize is None:
+        return STREAM_CHUNKSIZE if rows >= STREAM_FROM_ROWS else None
+    return chunksize or None
+
+
+def make_invoice_records(n_invoices: int, customer_ids: list[str], seed: int) -> np.ndarray:
+    """``make_invoices`` converted to cache records a slice at a time, so
+    millions of invoice dicts are never held at once."""
+    parts = [
+        invoices_to_records(make_invoices(min(SLICE_ROWS, n_invoices - start), customer_ids, seed + start))
+        for start in range(0, n_invoices, SLICE_ROWS)
+    ] or [invoices_to_records([])]
+    # Slices may size their byte-string fields differently
+    dtype = np.dtype([(name, f"S{max(part.dtype[name].itemsize for part in parts)}") for name in RECORD_FIELDS]
+                     + [("issueDay", "datetime64[D]")])
+    return np.concatenate([part.astype(dtype) for part in parts])
+
+
+def run_benchmark(name: str, rows: int, seed: int, accounts: int, chunksize: int | None) -> dict:
+    """Generate the inputs of benchmark ``name`` at ``rows`` rows and time it."""
+    metrics = RunMetrics(f"{name}@{format_scale(rows)}")
+    chunksize = stream_chunksize(rows, chunksize)
+    mappings = make_mappings(accounts, seed)
+    extra = {}
+
+    if name in ("transform_usage", "split_csvs"):
+        with metrics.stage("Generate inputs", rows=2 * rows):
+            income = make_export(rows, accounts, seed)
+            lbpa = make_export(rows, accounts, seed + 1)
+        if name == "transform_usage":
+            with metrics.stage(name, rows=2 * rows):
+                build_usage(BytesIO(income), BytesIO(lbpa), mappings, usage_date=USAGE_DATE,
+                            chunksize=chunksize, metrics=metrics)
+        else:
+            with metrics.stage("Build usage"):
+                result = build_usage(BytesIO(income), BytesIO(lbpa), mappings, usage_date=USAGE_DATE,
+                                     chunksize=chunksize)
+                usage_df = read_usage(BytesIO(result.usage_csv))
+            del income, lbpa
+            with metrics.stage(name, rows=2 * rows) as stage:
+                split_csvs = generate_split_csvs_with_all_columns(
+                    result.income_rows, result.lbpa_rows, usage_df, metrics=metrics)
+            stage.rows = sum(split_csv["rows"] for split_csv in split_csvs)
+    elif name == "extract_mappings":
+        with metrics.stage("Generate inputs", rows=rows):
+            clients_csv = make_clients_csv(rows, seed)
+        with metrics.stage(name, rows=rows):
+            extract_mappings_from_clients(clients_csv)
+    elif name == "invoice_lookup":
+        # One split per mapped customer, looked up among invoices of those
+        # customers and as many others
+        customer_ids = sorted(set(mappings["acct_to_tabs_id"].values()))
+        splits = [{"name": f"Customer_{customer_id}.csv", "customer_id": customer_id} for customer_id in customer_ids]
+        with metrics.stage("Generate inputs", rows=rows):
+            records = make_invoice_records(rows, customer_ids + make_customer_ids(accounts, seed), seed)
+        with metrics.stage(name, rows=rows):
+            cache = InvoiceCache()
+            with metrics.stage("Build invoice index", rows=rows):
+                cache.update(records, datetime.now())
+                cache.index  # built on first use otherwise
+            with metrics.stage("Map invoices", rows=len(splits)):
+                mapping_rows, _ = map_invoices(splits, invoice_issue_dates()[-1], cache)
+        extra["mapped"] = len(mapping_rows)
+    else:
+        raise ValueError(f"Unknown benchmark {name!r}")
+
+    report = metrics.report()
+    timed = next(stage for stage in report["stages"] if stage["name"] == name)
+    return {
+        "benchmark": name,
+        "scale": rows,
+        "chunksize": chunksize if name in ("transform_usage", "split_csvs") else None,
+        "seconds": timed["seconds"],
+        "rows": timed["rows"],
+        "peak_rss_mb": report["peak_rss_mb"],
+        **extra,
+        "stages": report["stages"],
+    }
+
+
+def run_isolated(name: str, rows: int, args) -> dict:
+    """``run_benchmark`` in a child process."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "result.json")
+        command = [sys.executable, os.path.abspath(__file__), "--in-process", "--benchmarks", name,
+                   "--scales", str(rows), "--seed", str(args.seed), "--accounts", str(args.accounts),
+                   "--output", output, "--quiet"]
+        if args.chunksize is not None:
+            command += ["--chunksize", str(args.chunksize)]
+        subprocess.run(command, check=True)
+        with open(output, encoding="utf-8") as f:
+            return json.load(f)["results"][0]
+
+
+def format_results(results: list[dict], baseline: list[dict] | None = None) -> str:
+    """The results as a plain-text table, with the speedup over ``baseline``."""
+    previous = {(result["benchmark"], result["scale"]): result for result in baseline or []}
+    lines = [f"{'benchmark':<18}{'scale':>7}{'seconds':>10}{'rows/s':>13}{'peak RSS MB':>13}"
+             + (f"{'baseline s':>12}{'speedup':>9}" if baseline is not None else "")]
+    for result in results:
+        rate = (result["rows"] or 0) / result["seconds"] if result["seconds"] else 0
+        line = (f"{result['benchmark']:<18}{format_scale(result['scale']):>7}{result['seconds']:>10.3f}"
+                f"{rate:>13,.0f}{'' if result['peak_rss_mb'] is None else result['peak_rss_mb']:>13}")
+        before = previous.get((result["benchmark"], result["scale"]))
+        if before and result["seconds"]:
+            line += f"{before['seconds']:>12.3f}{before['seconds'] / result['seconds']:>8.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", default=DEFAULT_SCALES,
+                        help=f"comma-separated rows per input, e.g. 10k,100k,1M,10M (default {DEFAULT_SCALES})")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS),
+                        help=f"comma-separated subset of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--accounts", type=int, default=3_000, help="accounts in the exports and mappings")
+    parser.add_argument("--chunksize", type=int,
+                        help=f"stream exports in chunks of this many rows; 0 never streams "
+                             f"(default: {STREAM_CHUNKSIZE:,} from {STREAM_FROM_ROWS:,} rows)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file")
+    parser.add_argument("--compare", help="earlier results file to show speedups against")
+    parser.add_argument("--in-process", action="store_true", help="run every benchmark in this process")
+    parser.add_argument("--quiet", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.benchmarks.split(",") if name.strip()]
+    unknown = sorted(set(names) - set(BENCHMARKS))
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    scales = [parse_scale(scale) for scale in args.scales.split(",") if scale.strip()]
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    started_at = datetime.now()
+    results = []
+    for rows in scales:
+        for name in names:
+            if not args.quiet:
+                print(f"⏱️ {name} at {format_scale(rows)} rows", flush=True)
+            if args.in_process:
+                result = run_benchmark(name, rows, args.seed, args.accounts, args.chunksize)
+            else:
+                result = run_isolated(name, rows, args)
+            results.append(result)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({
+            "started_at": started_at.isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "accounts": args.accounts,
+            "isolated": not args.in_process,
+            "results": results,
+        }, f, indent=2)
+    if not args.quiet:
+        print(format_results(results, baseline))
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
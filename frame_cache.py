@@ -0,0 +1,105 @@
+"""Parse-once cache of DataFrames read from uploaded CSV bytes.
+
+Streamlit re-runs the whole page on every interaction, so without a cache
+the same upload is parsed again by each preview and by the transformation
+on every click. Frames are cached under the MD5 of the bytes (the hash
+``persist_upload`` already stores), the reader and its keyword arguments,
+and evicted least-recently-used once the entry or memory budget is
+exceeded.
+
+The cache is process-wide and shared by all sessions and call sites.
+Cached frames are shared objects: callers must not modify them in place
+(take a ``.copy()`` first).
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import pandas as pd
+
+# ============ CONFIG ============
+MAX_ENTRIES = 8
+MAX_BYTES = 2 * 1024**3   # total in-memory size of the cached frames
+# =================================
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def frame_size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class FrameCache:
+    """Thread-safe LRU of parsed frames, bounded by entry count and total size."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._frames: OrderedDict[tuple, tuple[pd.DataFrame, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def read(self, data: bytes, reader=pd.read_csv, data_hash: str | None = None, **kwargs) -> pd.DataFrame:
+        """``reader(BytesIO(data), **kwargs)``, parsed only the first time these
+        bytes are read this way. ``data_hash`` saves re-hashing large uploads."""
+        key = (
+            data_hash or content_hash(data),
+            f"{reader.__module__}.{reader.__qualname__}",
+            tuple(sorted(kwargs.items())),
+        )
+        with self._lock:
+            cached = self._frames.get(key)
+            if cached is not None:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+        # Parsed outside the lock so other sessions are not held up; two
+        # sessions parsing the same bytes at once both store the same frame
+        df = reader(BytesIO(data), **kwargs)
+        self._store(key, df)
+        return df
+
+    def _store(self, key: tuple, df: pd.DataFrame) -> None:
+        size = frame_size(df)
+        with self._lock:
+            previous = self._frames.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            if size > self.max_bytes:
+                return  # larger than the whole budget: not cached
+            self._frames[key] = (df, size)
+            self._size += size
+            while len(self._frames) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted_size) = self._frames.popitem(last=False)
+                self._size -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self._size = 0
+
+
+_cache = FrameCache()
+
+
+def get_cache() -> FrameCache:
+    """The process-wide cache shared by every session."""
+    return _cache
+
+
+def read(data: bytes, reader=pd.read_csv, data_hash: str | None = None, **kwargs) -> pd.DataFrame:
+    """Read through the process-wide cache (see ``FrameCache.read``)."""
+    return _cache.read(data, reader, data_hash=data_hash, **kwargs)
@@ -0,0 +1,338 @@
+"""Invoice cache helpers for the invoice mapping step.
+
+Fetching: ``/v3/invoices`` is paged; after the first page reports
+``totalPages`` the rest are fetched concurrently and merged in page order
+(``tabs_client.fetch_all_pages``).
+An incremental refresh fetches only invoices updated since the cache was
+written and merges them into the cached list by id.
+
+Storage: only the fields mapping needs (id, customerId, issueDate, status,
+source, plus the parsed issue day) are kept, as a NumPy structured array
+saved to ``.npy`` and memory-mapped on load.
+
+Indexing: the records are ordered once by customer and issue date, so
+matching a split CSV to its invoice is a binary search plus a scan of that
+customer's few invoices instead of a pass over the whole cache. Invoices
+can also be looked up by id (``find_by_id``), to check mapped invoices
+before their attachments are uploaded.
+
+``InvoiceCache`` bundles the records, their fetch time and their index into
+one object that the app and the command line pass to lookups.
+"""
+import json
+import os
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+import tabs_client
+
+# ============ CONFIG ============
+PAGE_LIMIT = 1000
+MAX_PAGES = 100        # safety cap: 100,000 invoices
+FETCH_WORKERS = 8      # pages fetched concurrently
+DELTA_OVERLAP = timedelta(minutes=5)  # re-fetch window to absorb clock skew
+# =================================
+
+
+def dedupe_invoices(invoices) -> list[dict]:
+    """Drop repeated invoice ids, keeping the first occurrence."""
+    seen = set()
+    unique = []
+    for invoice in invoices:
+        invoice_id = invoice.get("id")
+        if invoice_id is not None:
+            if invoice_id in seen:
+                continue
+            seen.add(invoice_id)
+        unique.append(invoice)
+    return unique
+
+
+def fetch_all_invoices(api_key: str, params: dict | None = None, limit: int = PAGE_LIMIT,
+                       max_pages: int = MAX_PAGES, max_workers: int = FETCH_WORKERS,
+                       on_page=None) -> tabs_client.PagedResult:
+    """Fetch every page of ``/v3/invoices`` (see ``tabs_client.fetch_all_pages``),
+    merged in page order with duplicate invoice ids removed.
+    ``on_page(pages_done, total_pages, invoice_count)`` reports progress.
+    """
+    result = tabs_client.fetch_all_pages(
+        "invoices", api_key, params=params, limit=limit,
+        max_pages=max_pages, max_workers=max_workers, on_page=on_page,
+    )
+    return result._replace(items=dedupe_invoices(result.items))
+
+
+def updated_since_params(since: datetime) -> dict:
+    """Query params selecting invoices created or updated at/after ``since``."""
+    since = (since - DELTA_OVERLAP).astimezone(timezone.utc)  # naive = local time
+    return {"filter": f'updatedAt:gte:"{since.strftime("%Y-%m-%dT%H:%M:%SZ")}"'}
+
+
+def merge_invoices(existing, updates):
+    """Merge freshly fetched invoices into cached invoice records by id.
+    Updated invoices replace their cached row in place; new ones are appended.
+    """
+    if not isinstance(updates, np.ndarray):
+        updates = invoices_to_records(dedupe_invoices(updates))
+    if len(existing) == 0:
+        return updates
+    dtype = _merged_dtype(existing.dtype, updates.dtype)
+    merged = np.asarray(existing).astype(dtype)  # in-memory copy of the mapped file
+    updates = updates.astype(dtype)
+    position = {invoice_id: i for i, invoice_id in enumerate(merged["id"].tolist())}
+    new_rows = []
+    for row, invoice_id in zip(updates, updates["id"].tolist()):
+        if invoice_id in position:
+            merged[position[invoice_id]] = row
+        else:
+            position[invoice_id] = len(merged) + len(new_rows)
+            new_rows.append(row)
+    if new_rows:
+        merged = np.concatenate([merged, np.array(new_rows, dtype=dtype)])
+    return merged
+
+
+# -------- Compact invoice records --------
+# Only the fields invoice mapping needs are kept, as a NumPy structured array
+# of fixed-width byte strings that is saved as .npy and memory-mapped on load.
+RECORD_FIELDS = ("id", "customerId", "issueDate", "status", "source")
+
+
+def _merged_dtype(*dtypes) -> np.dtype:
+    fields = [(name, f"S{max(dt[name].itemsize for dt in dtypes)}") for name in RECORD_FIELDS]
+    return np.dtype(fields + [("issueDay", "datetime64[D]")])
+
+
+def invoices_to_records(invoices) -> np.ndarray:
+    """Convert API invoice dicts to compact records, parsing issue dates once."""
+    columns = {
+        name: [str(invoice.get(name) or "").encode("utf-8") for invoice in invoices]
+        for name in RECORD_FIELDS
+    }
+    fields = [(name, f"S{max([1] + [len(v) for v in values])}") for name, values in columns.items()]
+    records = np.empty(len(invoices), dtype=fields + [("issueDay", "datetime64[D]")])
+    for name, values in columns.items():
+        records[name] = values
+    # Parse each distinct issue date once; NaT marks missing/unparseable dates
+    raw_dates, date_codes = np.unique(records["issueDate"], return_inverse=True)
+    issue_days = [parse_issue_date(raw_date.decode("utf-8")) for raw_date in raw_dates]
+    issue_days = np.array([day or np.datetime64("NaT") for day in issue_days], dtype="datetime64[D]")
+    records["issueDay"] = issue_days[date_codes.reshape(-1)]
+    return records
+
+
+# -------- Persistent cache file --------
+def invoice_cache_path(cache_dir: str, api_key: str) -> str:
+    return os.path.join(cache_dir, f"invoice_cache_{api_key[:10]}.npy")
+
+
+def _meta_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".meta.json"
+
+
+def _legacy_json_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".json"
+
+
+def _parse_timestamp(timestamp) -> datetime | None:
+    try:
+        if isinstance(timestamp, (int, float)):
+            return datetime.fromtimestamp(timestamp)
+        if timestamp:
+            return datetime.fromisoformat(timestamp)
+    except Exception:
+        pass
+    return None
+
+
+def load_invoice_cache(path: str) -> tuple[np.ndarray, datetime | None]:
+    """Cached invoice records (memory-mapped) and the time they were fetched.
+    A cache still in the old JSON format is converted on first load.
+    """
+    if os.path.exists(path):
+        timestamp = None
+        if os.path.exists(_meta_path(path)):
+            with open(_meta_path(path), "r") as f:
+                timestamp = _parse_timestamp(json.load(f).get("timestamp"))
+        return np.load(path, mmap_mode="r"), timestamp
+    legacy_path = _legacy_json_path(path)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "r") as f:
+            cache_data = json.load(f)
+        records = invoices_to_records(cache_data.get("invoices", []))
+        timestamp = _parse_timestamp(cache_data.get("timestamp"))
+        if timestamp:
+            save_invoice_cache(path, records, timestamp)
+            os.remove(legacy_path)
+        return records, timestamp
+    return invoices_to_records([]), None
+
+
+def save_invoice_cache(path: str, records, timestamp: datetime) -> None:
+    """Write the records and their fetch time; replaces any previous cache atomically
+    (an older memory-mapped copy stays readable until it is released).
+    """
+    if not isinstance(records, np.ndarray):
+        records = invoices_to_records(records)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, records, allow_pickle=False)
+    os.replace(tmp_path, path)
+    with open(_meta_path(path), "w") as f:
+        json.dump({"timestamp": timestamp.isoformat(), "count": len(records)}, f)
+
+
+def delete_invoice_cache(path: str) -> None:
+    for file_path in (path, _meta_path(path), _legacy_json_path(path)):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+# -------- Index --------
+def parse_issue_date(value) -> date | None:
+    """Parse a Tabs ``issueDate`` (``YYYY-MM-DD`` or ISO timestamp) to a date."""
+    value = str(value or "").strip()
+    if not value:
+        return None
+    try:
+        # Fast path for ISO strings; the date part is what pandas would return
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        pass
+    try:
+        return pd.to_datetime(value).date()
+    except Exception:
+        return None
+
+
+class InvoiceIndex:
+    """Invoice records ordered by customerId, then issue date (most recent first).
+
+    A customer's invoices are one contiguous run found by binary search on the
+    sorted customer column, so a lookup never touches other customers' rows.
+    """
+
+    def __init__(self, records: np.ndarray):
+        self.records = records
+        # Raw issue date descending with ties in API order (stable sort of the
+        # reversed column, flipped back), then a stable sort by customer
+        issue_dates = np.asarray(records["issueDate"])
+        by_date = len(records) - 1 - np.argsort(issue_dates[::-1], kind="stable")[::-1]
+        customers = np.asarray(records["customerId"])[by_date]
+        by_customer = np.argsort(customers, kind="stable")
+        self.order = by_date[by_customer]
+        self.customers = customers[by_customer]
+        self._id_order = None
+        self._ids = None
+
+    @classmethod
+    def from_invoices(cls, invoices) -> "InvoiceIndex":
+        return cls(invoices_to_records(invoices))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def customer_rows(self, customer_id) -> np.ndarray:
+        """Row numbers of the customer's invoices, most recent first."""
+        key = str(customer_id).encode("utf-8")
+        lo = np.searchsorted(self.customers, key, side="left")
+        hi = np.searchsorted(self.customers, key, side="right")
+        return self.order[lo:hi]
+
+    def find_invoice(self, customer_id, issue_date=None) -> str | None:
+        """Most recent non-deleted TABS invoice for the customer on ``issue_date``.
+        Invoices without a usable issue date match any date.
+        """
+        target_day = np.datetime64(issue_date, "D") if issue_date else None
+        for row in self.customer_rows(customer_id):
+            invoice = self.records[row]
+            if invoice["status"].upper() == b"DELETED" or invoice["source"].upper() != b"TABS":
+                continue
+            issue_day = invoice["issueDay"]
+            if target_day is not None and not np.isnat(issue_day) and issue_day != target_day:
+                continue
+            return invoice["id"].decode("utf-8")
+        return None
+
+    def find_by_id(self, invoice_id) -> dict | None:
+        """The cached invoice with ``invoice_id`` (its ``RECORD_FIELDS`` as
+        strings), or None. The id order is built on first use."""
+        if self._ids is None:
+            ids = np.asarray(self.records["id"])
+            self._id_order = np.argsort(ids, kind="stable")
+            self._ids = ids[self._id_order]
+        key = str(invoice_id).encode("utf-8")
+        position = np.searchsorted(self._ids, key)
+        if position == len(self._ids) or self._ids[position] != key:
+            return None
+        invoice = self.records[self._id_order[position]]
+        return {name: invoice[name].decode("utf-8") for name in RECORD_FIELDS}
+
+
+# -------- Cache object --------
+class InvoiceCache:
+    """One account's invoice records, the time they were fetched and their index.
+
+    The app keeps one per session and API key, the command line one per run;
+    lookups take the object rather than reading session state. With a ``path``
+    (see ``invoice_cache_path``) the records are loaded from and saved to that
+    file; without one they live in memory only.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.records = invoices_to_records([])
+        self.timestamp = None
+        self._index = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def load(self) -> "InvoiceCache":
+        """Read the saved records, when the file has any."""
+        if self.path:
+            records, timestamp = load_invoice_cache(self.path)
+            if len(records):
+                self.records, self.timestamp, self._index = records, timestamp, None
+        return self
+
+    def update(self, records, timestamp: datetime) -> None:
+        """Replace the records (after a full fetch) and save them. The records
+        are replaced even when saving fails."""
+        if not isinstance(records, np.ndarray):
+            records = invoices_to_records(records)
+        self.records, self.timestamp, self._index = records, timestamp, None
+        if self.path:
+            save_invoice_cache(self.path, records, timestamp)
+
+    def merge(self, updates, timestamp: datetime) -> None:
+        """Merge an incremental fetch into the records (see ``merge_invoices``) and save them."""
+        self.update(merge_invoices(self.records, updates), timestamp)
+
+    def clear(self) -> None:
+        """Drop the records, in memory and on disk."""
+        self.records, self.timestamp, self._index = invoices_to_records([]), None, None
+        if self.path:
+            delete_invoice_cache(self.path)
+
+    @property
+    def index(self) -> InvoiceIndex:
+        """The records' index, built once per set of records."""
+        if self._index is None:
+            self._index = InvoiceIndex(self.records)
+        return self._index
+
+    def find_invoice(self, customer_id, issue_date=None) -> str | None:
+        """See ``InvoiceIndex.find_invoice``; None while the cache is empty."""
+        if not len(self.records):
+            return None
+        return self.index.find_invoice(customer_id, issue_date)
+
+    def find_by_id(self, invoice_id) -> dict | None:
+        """See ``InvoiceIndex.find_by_id``; None while the cache is empty."""
+        if not len(self.records):
+            return None
+        return self.index.find_by_id(invoice_id)
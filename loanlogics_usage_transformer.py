@@ -0,0 +1,1468 @@
+"""LoanLogics usage transformation and invoice attachment, without Streamlit.
+
+The pipeline the Streamlit app (``new.py``) drives step by step lives here
+so it can also run headless:
+
+1. ``build_usage`` turns the Income and LBPA exports into the Tabs usage
+   upload (``LoanLogics_upload_All.csv`` and its companions).
+2. ``generate_split_csvs_with_all_columns`` splits the raw rows per customer.
+3. ``map_invoices`` finds each split's invoice for the billing issue date in
+   the invoice cache, asking the API about customers it does not cover.
+4. ``upload_csv_attachments_concurrently`` attaches the splits to their
+   invoices, recording each upload in the upload journal.
+
+Nothing here touches Streamlit session state: inputs, outputs and caches
+(``NsIdCache``, ``invoice_cache.InvoiceCache``, ``UploadJournal``) are passed
+in explicitly, and the app keeps its per-session instances.
+
+Run as a script for scheduled or large batch runs:
+
+    python loanlogics_usage_transformer.py --income Income.csv --lbpa LBPA.csv \\
+        --usage-date 2024-09-30 --issue-date 2024-10-01 --output-dir runs/2024-09
+
+The invoice cache and upload journal are the app's (under ``SESSION_DIR``),
+so a batch run and the app skip each other's completed uploads.
+``--api-base-url`` (or ``$TABS_API_BASE_URL``) sends the API calls elsewhere,
+e.g. to the local stand-in server ``tabs_stub_server``; the caches are then
+kept apart from the production ones (see ``tabs_client.scoped_cache_dir``).
+Stage timings, peak memory and API calls are printed at the end and written
+as ``run_report.json`` (see ``run_metrics``).
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from functools import partial
+from io import BytesIO
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+import tabs_client
+from invoice_cache import (
+    InvoiceCache,
+    InvoiceIndex,
+    fetch_all_invoices,
+    invoice_cache_path,
+    parse_issue_date,
+)
+from row_store import RowStore, read_csv_chunks
+from run_metrics import RunMetrics
+from split_writer import write_splits
+from upload_journal import (
+    STATUS_FAILED,
+    STATUS_STARTED,
+    STATUS_SUCCESS,
+    UploadJournal,
+    content_hash,
+)
+from usage_schema import (
+    decode, map_text, map_values, parse_dates, read_transactions, read_usage, to_counts, transaction_dtypes,
+)
+
+# ============ CONFIG ============
+SESSION_DIR = os.path.join("usage_uploads", "_session")   # shared with the Streamlit app
+MAPPINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client_mappings.json")
+UPLOAD_WORKERS = 8
+INVOICE_LOOKUP_WORKERS = 8   # concurrent /customers/{id}/invoices calls for invoices not in the cache
+MAPPING_KEYS = (
+    "parent_to_id", "acct_to_tabs_id", "acct_to_ns_id", "acct_to_income_evt",
+    "acct_to_lbpa_evt", "acct_to_diff_name", "acct_to_base_name",
+)
+# =================================
+
+
+def load_mappings_file(path: str) -> dict:
+    """Client mappings saved as JSON (``client_mappings.json``), every key and
+    value as a string; {} when the file is missing or unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {key: {str(k): str(v) for k, v in data.get(key, {}).items()} for key in MAPPING_KEYS}
+
+
+# ---------- header helpers ----------
+_def_norm_regex = re.compile(r"[^a-z0-9]")
+
+def normalize_name(name: str) -> str:
+    return _def_norm_regex.sub("", str(name).strip().lower())
+
+def normalize_names(names: pd.Series) -> pd.Series:
+    """``normalize_name`` applied to a column of strings."""
+    return names.str.strip().str.lower().str.replace(_def_norm_regex.pattern, "", regex=True)
+
+def find_column(df: pd.DataFrame, candidates: list[str]) -> str | None:
+    normalized_to_original = {normalize_name(c): c for c in df.columns}
+    for cand in candidates:
+        n = normalize_name(cand)
+        if n in normalized_to_original:
+            return normalized_to_original[n]
+    return None
+# ------------------------------------
+
+
+def detect_header_row(uploaded_clients):
+    """Return a DataFrame for the mapping CSV, auto-detecting the header row.
+    Looks for the first line that contains Acct#/AccountID and NetSuite/External ID.
+    Works with CSVs that have banner/title rows above the real headers.
+    """
+    from io import StringIO
+    raw = b""
+    if hasattr(uploaded_clients, "read"):
+        raw = uploaded_clients.read()
+    elif isinstance(uploaded_clients, bytes):
+        raw = uploaded_clients
+    elif isinstance(uploaded_clients, (str, os.PathLike)):
+        with open(uploaded_clients, "rb") as f:
+            raw = f.read()
+    else:
+        raw = b""
+    text = raw.decode("utf-8-sig", errors="ignore")
+    # Split and find header index
+    lines = [l for l in text.splitlines() if l is not None]
+    header_idx = None
+    for i, l in enumerate(lines[:500]):
+        ll = l.lower()
+        if ("acct#" in ll or "acct #" in ll or "accountid" in ll or "account id" in ll or "account number" in ll or "accountnumber" in ll or "acctno" in ll or "acct no" in ll) and ("netsuite" in ll or "external id" in ll):
+            header_idx = i
+            break
+    if header_idx is None:
+        # Fallback to first non-empty line
+        header_idx = 0
+    # Let pandas parse from the detected header row with automatic delimiter detection
+    df_clients = pd.read_csv(StringIO(text), header=header_idx)
+    # Clean column names and values
+    df_clients.columns = [re.sub(r"\s+", " ", str(c)).strip().strip('"').strip("'") for c in df_clients.columns]
+    df_clients = pd.concat(
+        [df_clients.iloc[:, i].astype(str).str.strip() for i in range(df_clients.shape[1])],
+        axis=1,
+    )
+    return df_clients
+
+def extract_mappings_from_clients(uploaded_clients):
+    """Extract mappings from clients CSV file"""
+    df_clients = detect_header_row(uploaded_clients)
+
+    name_col = find_column(df_clients, ["name", "customer", "customername"]) 
+    acc_name_col = find_column(df_clients, ["account name", "accountname"]) 
+    name_with_prefix_col = find_column(df_clients, ["namewithprefix", "name with prefix"])
+    id_col = find_column(df_clients, ["id", "tabs id", "tabs_customer_id", "tabscustomerid", "customerid", "customer id"])
+    acctnum_col = find_column(df_clients, ["acct#", "acct #", "acctno", "acct no", "acct", "accountid", "account id", "accountnumber", "account number", "acctnum"]) 
+    netsuite_id_col = find_column(df_clients, ["netsuite", "netsuite id", "netsuiteid", "ns id", "external id", "netsuite internal id"]) 
+    diff_name_col = find_column(df_clients, ["account name", "name with prefix", "subsidiary", "subsidiary name"]) 
+    rev_type_col = find_column(df_clients, ["rev. type", "rev type", "revenue type", "rev"]) 
+    billing_type_col = find_column(df_clients, ["billing type", "billing", "bill type"]) 
+    
+    def _text(col) -> pd.Series:
+        """Column as ``str(value).strip()`` strings ("" when the column is absent)."""
+        if not col:
+            return pd.Series("", index=df_clients.index, dtype=object)
+        return df_clients[col].fillna("nan").astype(str).str.strip()
+    
+    def _mapping(keys: pd.Series, values: pd.Series, mask) -> dict[str, str]:
+        # dict(zip()) keeps the first position and the last value of a repeated
+        # key, exactly like assigning row by row
+        return dict(zip(keys[mask].tolist(), values[mask].tolist()))
+    
+    tabs_ids = _text(id_col)
+    base_names = _text(name_col)
+    has_tabs_id = tabs_ids != ""
+    
+    parent_to_id_raw: dict[str, str] = {}
+    if name_col:
+        # Each row maps its name, then its prefixed alias, to the Tabs ID
+        aliases = _text(name_with_prefix_col)
+        keys = np.column_stack([base_names.to_numpy(object), aliases.to_numpy(object)])
+        use = np.column_stack([has_tabs_id.to_numpy(bool), (has_tabs_id & (aliases != "")).to_numpy(bool)])
+        ids = np.repeat(tabs_ids.to_numpy(object), 2)
+        parent_to_id_raw = dict(zip(keys.ravel()[use.ravel()].tolist(), ids[use.ravel()].tolist()))
+    
+    acct_to_tabs_id: dict[str, str] = {}
+    acct_to_ns_id: dict[str, str] = {}
+    acct_to_income_evt: dict[str, str] = {}
+    acct_to_lbpa_evt: dict[str, str] = {}
+    acct_to_diff_name: dict[str, str] = {}
+    acct_to_base_name: dict[str, str] = {}
+    
+    if acctnum_col:
+        acct_keys = _text(acctnum_col).str.replace(r"[^0-9]", "", regex=True)
+        has_acct = acct_keys != ""
+        if id_col:
+            acct_to_tabs_id = _mapping(acct_keys, tabs_ids, has_acct & has_tabs_id)
+        if netsuite_id_col:
+            ns_ids = _text(netsuite_id_col)
+            acct_to_ns_id = _mapping(acct_keys, ns_ids, has_acct & (ns_ids != ""))
+        if name_col or acc_name_col:
+            names = base_names if name_col else _text(acc_name_col)
+            acct_to_base_name = _mapping(acct_keys, names, has_acct & (names != ""))
+        if diff_name_col and name_col:
+            diff_names = _text(diff_name_col)
+            # Only names shared by several accounts get a distinguishing suffix
+            shared = base_names.map(base_names.value_counts()) > 1
+            candidates = has_acct & (diff_names != "") & (base_names != "") & shared
+            distinct = normalize_names(diff_names) != normalize_names(base_names)
+            acct_to_diff_name = _mapping(acct_keys, base_names + " - " + diff_names, candidates & distinct)
+        if rev_type_col or billing_type_col:
+            rev_vals = _text(rev_type_col).str.lower()
+            bill_vals = _text(billing_type_col).str.lower()
+            events = pd.Series(np.where(
+                bill_vals.str.contains("unit", regex=False), "Units", "Per Application"
+            ), index=df_clients.index)
+            has_event = has_acct & (bill_vals != "")
+            is_income = rev_vals.str.contains("income", regex=False)
+            is_lbpa = (
+                rev_vals.str.contains("lbpa", regex=False)
+                | rev_vals.str.contains("l b p a", regex=False)
+                | rev_vals.str.contains("loanbeam per application", regex=False)
+            )
+            acct_to_income_evt = _mapping(acct_keys, events, has_event & is_income)
+            acct_to_lbpa_evt = _mapping(acct_keys, events, has_event & is_lbpa)
+    
+    parent_to_id = {normalize_name(k): v for k, v in parent_to_id_raw.items()}
+    
+    return {
+        "parent_to_id": parent_to_id,
+        "acct_to_tabs_id": acct_to_tabs_id,
+        "acct_to_ns_id": acct_to_ns_id,
+        "acct_to_income_evt": acct_to_income_evt,
+        "acct_to_lbpa_evt": acct_to_lbpa_evt,
+        "acct_to_diff_name": acct_to_diff_name,
+        "acct_to_base_name": acct_to_base_name,
+    }
+
+
+# Resolving at least this many NetSuite IDs pages through /v3/customers once
+# instead of issuing one filtered query per ID
+_NS_BULK_SCAN_MIN = 10
+_NS_QUERY_WORKERS = 8
+
+def normalize_ns_id(ns_external_id) -> str:
+    return str(ns_external_id or "").strip().replace(".0", "")
+
+def _customer_ns_ids(cust: dict) -> list[str]:
+    """External IDs listed on a Tabs customer record."""
+    ext_list = cust.get("externalIds") or cust.get("external_ids") or []
+    return [str(ext.get("id") or "").strip() for ext in ext_list or []]
+
+def query_tabs_id_for_ns(ns_external_id: str, api_key: str) -> str | None:
+    """Look up one NetSuite ID with a filtered /v3/customers query (no caching).
+    None when no customer has it; raises when the lookup fails (connection
+    error, or RuntimeError on an error status)."""
+    res = tabs_client.get(
+        "customers", api_key, params={"filter": f'externalIds.externalId:eq:"{ns_external_id}"'}, timeout=10,
+    )
+    if res.status_code >= 400:
+        raise RuntimeError(f"NetSuite ID lookup failed with status {res.status_code}")
+    try:
+        data = res.json() if res.headers.get("content-type", "").startswith("application/json") else None
+    except ValueError:
+        data = None
+    if not data:
+        return None
+    items, _ = tabs_client.parse_page(data)
+    if not items:
+        return None
+    # Prefer exact match on externalIds array (type NETSUITE and id equals)
+    for cust in items:
+        if ns_external_id in _customer_ns_ids(cust):
+            tabs_id = str(cust.get("id") or "").strip()
+            if tabs_id:
+                return tabs_id
+    # Fallback: first item when search hits
+    tabs_id = str(items[0].get("id") or "").strip()
+    return tabs_id or None
+
+
+def resolve_tabs_ids_bulk(ns_external_ids, api_key: str, cache: dict) -> dict[str, str]:
+    """Resolve many NetSuite IDs to Tabs customer IDs in one pass.
+
+    Cached IDs are answered from ``cache``. For many misses the customer list
+    is paged once and matched on externalIds; IDs still unresolved (or all
+    misses, when there are only a few) get concurrent filtered queries.
+    New hits are added to ``cache``; IDs whose lookup failed are left
+    unresolved (and uncached), so a later run asks again. Returns
+    {normalized NS ID: Tabs ID}.
+    """
+    wanted = {normalize_ns_id(ns) for ns in ns_external_ids} - {""}
+    resolved = {ns: cache[ns] for ns in wanted if ns in cache}
+    missing = wanted - resolved.keys()
+    
+    if len(missing) >= _NS_BULK_SCAN_MIN:
+        result = tabs_client.fetch_all_pages("customers", api_key)
+        for cust in result.items:
+            tabs_id = str(cust.get("id") or "").strip()
+            if not tabs_id:
+                continue
+            for ext_id in _customer_ns_ids(cust):
+                if ext_id in missing and ext_id not in resolved:
+                    resolved[ext_id] = tabs_id
+        missing -= resolved.keys()
+    
+    if missing:
+        with ThreadPoolExecutor(max_workers=_NS_QUERY_WORKERS) as executor:
+            futures = {executor.submit(query_tabs_id_for_ns, ns, api_key): ns for ns in sorted(missing)}
+            for future in as_completed(futures):
+                try:
+                    tabs_id = future.result()
+                except Exception:
+                    tabs_id = None
+                if tabs_id:
+                    resolved[futures[future]] = tabs_id
+    
+    for ns, tabs_id in resolved.items():
+        cache[ns] = tabs_id
+    return resolved
+
+
+class NsIdCache(dict):
+    """NetSuite ID -> Tabs customer ID cache, keyed by normalized NS ID.
+
+    With a ``path`` it is saved as JSON (the file the app and the command line
+    share); without one it lives in memory only. Any dict works where a cache
+    is taken; only an ``NsIdCache`` is saved.
+    """
+
+    def __init__(self, entries=None, path: str | None = None):
+        super().__init__(entries or {})
+        self.path = path
+
+    @classmethod
+    def load(cls, path: str) -> "NsIdCache":
+        """The cache saved at ``path`` (empty when missing or unreadable)."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = {str(k): str(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            entries = {}
+        return cls(entries, path)
+
+    def save(self) -> None:
+        """Write the cache to ``path``; a cache that cannot be written is kept in memory only."""
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(dict(self), f, ensure_ascii=False)
+        except OSError:
+            pass
+
+
+def resolve_tabs_ids(ns_external_ids, api_key: str, cache: dict) -> dict[str, str]:
+    """``resolve_tabs_ids_bulk`` through ``cache``, saving an ``NsIdCache`` once
+    when new IDs resolved. Returns {NS ID as given: Tabs ID} for the IDs that resolved."""
+    cached = len(cache)
+    resolved = resolve_tabs_ids_bulk(ns_external_ids, api_key, cache)
+    if len(cache) != cached and isinstance(cache, NsIdCache):
+        cache.save()
+    return {str(ns): resolved[normalize_ns_id(ns)] for ns in ns_external_ids if normalize_ns_id(ns) in resolved}
+
+
+def resolve_tabs_id(ns_external_id, api_key: str, cache: dict) -> str | None:
+    """Tabs customer ID of one NetSuite ID (see ``resolve_tabs_ids``)."""
+    return resolve_tabs_ids([ns_external_id], api_key, cache).get(str(ns_external_id))
+
+
+def upload_csv_attachment(customer_id, invoice_id, csv_bytes, filename, api_key=None):
+    """Upload CSV attachment to invoice via API"""
+    try:
+        if not api_key:
+            return False
+        
+        # Construct API URL
+        url = f"customers/{customer_id}/invoices/{invoice_id}/attachments"
+        
+        # Upload CSV bytes
+        files = {
+            'file': (filename, csv_bytes, 'text/csv')
+        }
+        
+        response = tabs_client.post(url, api_key, files=files, timeout=30)
+        
+        if response.status_code in [200, 201]:
+            return True
+        else:
+            return False
+                
+    except Exception as e:
+        return False
+
+def upload_csv_attachments_concurrently(jobs, api_key, max_workers=8, on_complete=None, journal=None):
+    """Upload CSV attachments with at most ``max_workers`` requests in flight.
+    Each job is a dict with customer_id, invoice_id, bytes, filename and hash.
+    Returns one success flag per job, in job order; ``on_complete(done, total)``
+    is called from the calling thread each time an upload finishes.
+    With an ``UploadJournal``, each upload's start and outcome are recorded
+    as they happen so an interrupted run can be resumed.
+    """
+    results = [False] * len(jobs)
+    if not jobs:
+        return results
+
+    def _upload(job):
+        if journal is None:
+            return upload_csv_attachment(
+                job["customer_id"], job["invoice_id"], job["bytes"], job["filename"], api_key
+            )
+        entry = (job["invoice_id"], job["hash"])
+        journal.record(*entry, STATUS_STARTED, job["filename"], job["customer_id"])
+        try:
+            success = upload_csv_attachment(
+                job["customer_id"], job["invoice_id"], job["bytes"], job["filename"], api_key
+            )
+        except Exception as e:
+            journal.record(*entry, STATUS_FAILED, job["filename"], job["customer_id"], str(e))
+            raise
+        journal.record(
+            *entry,
+            STATUS_SUCCESS if success else STATUS_FAILED,
+            job["filename"],
+            job["customer_id"],
+            "" if success else "Upload failed",
+        )
+        return success
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+        futures = {executor.submit(_upload, job): i for i, job in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                results[futures[future]] = bool(future.result())
+            except Exception:
+                results[futures[future]] = False
+            if on_complete:
+                on_complete(done, len(jobs))
+    return results
+
+
+class UsageResult(NamedTuple):
+    """Output of ``build_usage``. The CSVs are the files the app offers for
+    download (``b""`` when there are no such rows); the raw rows (DataFrames,
+    or RowStores when streamed) are what the split step reads."""
+    usage_csv: bytes
+    internal_csv: bytes
+    unmapped_csv: bytes
+    missing_customer_id_csv: bytes
+    unmapped: pd.DataFrame
+    missing_customer_id: pd.DataFrame
+    income_upload: pd.DataFrame
+    income_rows: pd.DataFrame | RowStore
+    lbpa_rows: pd.DataFrame | RowStore
+
+
+def build_usage(uploaded_income, uploaded_lbpa, mappings: dict | None = None, usage_date=None,
+                chunksize=None, resolve_ns=None, metrics: RunMetrics | None = None) -> UsageResult:
+    """Build the Tabs usage upload from the Income and LBPA exports, given as
+    file objects or already parsed DataFrames (which are copied, not modified).
+    With ``chunksize`` the exports are streamed in chunks of that many rows and
+    their raw rows are kept in temporary on-disk RowStores for the split step.
+    ``resolve_ns(ns_ids)`` -> {NS ID: Tabs ID}, when given, fills in customers
+    mapped only to a NetSuite ID. Stage timings are recorded in ``metrics``.
+    """
+    metrics = metrics if metrics is not None else RunMetrics()
+    mappings = mappings or {}
+    parent_to_id = mappings.get("parent_to_id", {})
+    acct_to_tabs_id = mappings.get("acct_to_tabs_id", {})
+    acct_to_ns_id = mappings.get("acct_to_ns_id", {})
+    acct_to_income_evt = mappings.get("acct_to_income_evt", {})
+    acct_to_lbpa_evt = mappings.get("acct_to_lbpa_evt", {})
+    acct_to_diff_name = mappings.get("acct_to_diff_name", {})
+    acct_to_base_name = mappings.get("acct_to_base_name", {})
+
+    def prepare_rows(df: pd.DataFrame, qty_col_candidates: list[str], use_account_name=None) -> dict:
+        """Add the usage columns (AccountName, value, account key, customer_id) to raw rows
+        in place and return the columns they were taken from. ``use_account_name``
+        fixes the AccountName source; by default it is decided from ``df`` itself.
+        """
+        df.columns = df.columns.str.strip()
+        parent_col = find_column(df, ["customername", "accountname", "name"])
+        acct_id_col = find_column(df, ["accountid", "acct#", "acct", "account number", "accountnumber"]) 
+        datetime_col = find_column(df, ["submissiondate", "date", "createdon", "datetime"])
+        qty_col = find_column(df, qty_col_candidates)
+        if not parent_col:
+            raise KeyError("Customer/Account name column missing")
+        if not datetime_col:
+            df["__datetime_fallback__"] = pd.Timestamp.today().normalize()
+            datetime_col = "__datetime_fallback__"
+        if not qty_col:
+            raise KeyError("Quantity column not found")
+
+        # Preserve original AccountName column from Income file BEFORE overwriting
+        # This is the AccountName column that contains actual account names
+        if "AccountName" in df.columns:
+            # Preserve the AccountName column BEFORE we overwrite it
+            df["__original_account_name__"] = df["AccountName"].copy()
+        else:
+            df["__original_account_name__"] = ""
+        
+        # Now set AccountName from parent_col (CustomerName)
+        # Check if parent_col column is all NaN and try fallback to AccountName column if it exists
+        account_name_col = find_column(df, ["accountname"]) if "AccountName" in df.columns else None
+        parent_has_values = bool(df[parent_col].notna().any())
+        account_name_has_values = bool(account_name_col and df[account_name_col].notna().any())
+        if use_account_name is None:
+            # If CustomerName was all NaN, try using AccountName column directly
+            use_account_name = not parent_has_values and account_name_has_values
+        account_name_source = account_name_col if use_account_name else parent_col
+        df["AccountName"] = df[account_name_source]
+        
+        df["value"] = to_counts(df[qty_col])
+        # Always compute account id key if present
+        if acct_id_col:
+            # Blank IDs get an empty key (not a missing one, which groupby would drop)
+            df["__acct_key__"] = map_text(df[acct_id_col], lambda ids: ids.str.replace(r"[^0-9]", "", regex=True), missing="")
+        else:
+            df["__acct_key__"] = ""
+        # Prefer mapping by AccountID if available
+        if acct_id_col and acct_to_tabs_id:
+            df["customer_id"] = map_values(df["__acct_key__"], acct_to_tabs_id)
+        else:
+            df["__join_key__"] = map_text(df["AccountName"], lambda names: names.str.lower().str.replace(r"[^a-z0-9]", "", regex=True))
+            df["customer_id"] = map_values(df["__join_key__"], parent_to_id)
+        # Do NOT call APIs in the Usage tab; leave customer_id blank if only NetSuite ID exists.
+        # IMPORTANT: Do not group by customer_id (it may be NaN and would drop all rows).
+        return {
+            "acct_id_col": acct_id_col,
+            "datetime_col": datetime_col,
+            "account_name_source": account_name_source,
+            "can_use_account_name": account_name_has_values,
+            "parent_has_values": parent_has_values,
+        }
+
+    def aggregate_rows(df: pd.DataFrame, columns: dict, first_row: int = 0) -> pd.DataFrame:
+        """Aggregate prepared rows by every key any later stage groups by (usage name +
+        account key, AccountID and CustomerName for the per-customer and per-account
+        sums), so all further grouping runs on these few aggregate rows instead of
+        the raw file. Partial aggregates of consecutive chunks combine with
+        ``combine_aggregates``; ``first_row`` is the chunk's offset in the file.
+        """
+        datetime_col = columns["datetime_col"]
+        aggregate_cols = {"AccountName": df["AccountName"], "__acct_key__": df["__acct_key__"]}
+        if "AccountID" in df.columns:
+            aggregate_cols["AccountID"] = (
+                df["__acct_key__"] if columns["acct_id_col"] == "AccountID"
+                else map_text(df["AccountID"], lambda ids: ids.str.replace(r"[^0-9]", "", regex=True), missing="")
+            )
+        if "CustomerName" in df.columns and columns["account_name_source"] != "CustomerName":
+            aggregate_cols["CustomerName"] = df["CustomerName"]
+        aggregate_cols.update({
+            "value": df["value"],
+            # Parsed, so the latest date is found on datetime64 values
+            datetime_col: parse_dates(df[datetime_col]),
+            "__original_account_name__": df["__original_account_name__"],
+            # Row of the first original account name, to keep "first" exact when re-grouping
+            "__first_name_row__": pd.Series(np.arange(first_row, first_row + len(df)), index=df.index).where(
+                df["__original_account_name__"].notna()
+            ),
+        })
+        for sum_col in ("UnitsAsPerSubmission", "IsInitialSubmission"):
+            if sum_col in df.columns:
+                aggregate_cols[sum_col] = to_counts(df[sum_col])
+        return _regroup_aggregates(pd.DataFrame(aggregate_cols), datetime_col)
+
+    def _regroup_aggregates(frame: pd.DataFrame, datetime_col: str) -> pd.DataFrame:
+        aggregate_keys = [c for c in ("AccountName", "__acct_key__", "AccountID", "CustomerName") if c in frame.columns]
+        aggregate_funcs = {"value": "sum", datetime_col: "max", "__original_account_name__": "first", "__first_name_row__": "min"}
+        for sum_col in ("UnitsAsPerSubmission", "IsInitialSubmission"):
+            if sum_col in frame.columns:
+                aggregate_funcs[sum_col] = "sum"
+        aggregates = frame.groupby(aggregate_keys, as_index=False, sort=False, dropna=False, observed=True).agg(aggregate_funcs)
+        # The few aggregate rows carry plain values, like the columns they came from
+        for col in aggregates.columns:
+            aggregates[col] = decode(aggregates[col])
+        return aggregates
+
+    def combine_aggregates(partials: list[pd.DataFrame], datetime_col: str) -> pd.DataFrame:
+        if len(partials) == 1:
+            return partials[0]
+        # Partials are in file order, so "first" still picks the earliest name
+        return _regroup_aggregates(pd.concat(partials, ignore_index=True), datetime_col)
+
+    def stream_rows(read_chunks, qty_col_candidates: list[str], use_account_name=None):
+        """Prepare and aggregate an export chunk by chunk, spilling the prepared rows
+        to a RowStore for the split step. Returns (columns, aggregates, store).
+        """
+        store = RowStore(prefix="usage_rows_")
+        partials = []
+        rows_read = 0
+        any_parent_values = any_account_name_values = False
+        for chunk in read_chunks():
+            columns = prepare_rows(chunk, qty_col_candidates, use_account_name=bool(use_account_name))
+            partials.append(aggregate_rows(chunk, columns, first_row=rows_read))
+            rows_read += len(chunk)
+            store.append(chunk)
+            any_parent_values |= columns["parent_has_values"]
+            any_account_name_values |= columns["can_use_account_name"]
+        if use_account_name is None and not any_parent_values and any_account_name_values:
+            # The name column turned out empty in every chunk: read again using AccountName
+            store.delete()
+            return stream_rows(read_chunks, qty_col_candidates, use_account_name=True)
+        return columns, combine_aggregates(partials, columns["datetime_col"]), store
+
+    def process_usage(source, event_type_name: str, qty_col_candidates: list[str]):
+        """Aggregate one export (Income or LBPA) into usage rows.
+        ``source`` is a DataFrame, prepared in place, or a callable returning an
+        iterator of chunks (streaming mode). Returns the usage rows, the
+        aggregates and the prepared raw rows (the DataFrame, or a RowStore).
+        """
+        if isinstance(source, pd.DataFrame):
+            columns = prepare_rows(source, qty_col_candidates)
+            aggregates = aggregate_rows(source, columns)
+            raw_rows = source
+        else:
+            columns, aggregates, raw_rows = stream_rows(source, qty_col_candidates)
+        datetime_col = columns["datetime_col"]
+        if "CustomerName" in raw_rows.columns and columns["account_name_source"] == "CustomerName":
+            aggregates["CustomerName"] = aggregates["AccountName"]
+        # Same customer_id mapping as the raw rows got in prepare_rows
+        if columns["acct_id_col"] and acct_to_tabs_id:
+            aggregates["customer_id"] = aggregates["__acct_key__"].map(acct_to_tabs_id)
+        else:
+            aggregates["customer_id"] = (
+                aggregates["AccountName"].astype(str).str.lower().str.replace(r"[^a-z0-9]", "", regex=True).map(parent_to_id)
+            )
+
+        group_keys = ["AccountName", "__acct_key__"]
+        agg_dict = {"value": "sum", datetime_col: "max", "__original_account_name__": "first"}
+        grouped = (
+            aggregates.sort_values("__first_name_row__", kind="stable")
+              .groupby(group_keys, as_index=False, observed=True)
+              .agg(agg_dict)
+        )
+        # Map customer_id after grouping when available from mapping (name or acct)
+        grouped["__join_key__"] = grouped["AccountName"].astype(str).str.lower().str.replace(r"[^a-z0-9]", "", regex=True)
+        name_mapped = grouped["__join_key__"].map(parent_to_id) if 'parent_to_id' in locals() or 'parent_to_id' in globals() else None
+        acct_mapped = grouped["__acct_key__"].map(acct_to_tabs_id) if 'acct_to_tabs_id' in locals() else None
+        if acct_mapped is not None:
+            grouped["customer_id"] = acct_mapped
+        if name_mapped is not None:
+            grouped["customer_id"] = grouped.get("customer_id").fillna(name_mapped) if "customer_id" in grouped.columns else name_mapped
+
+        grouped["event_type_name"] = event_type_name
+        # Differentiator: will be set later for Finastra only
+        grouped["differentiator"] = ""
+        grouped.rename(columns={datetime_col: "datetime"}, inplace=True)
+        # Use usage_date if provided, otherwise use the datetime from the file
+        if usage_date is not None:
+            # Format the usage_date as YYYY-MM-DD
+            grouped["datetime"] = pd.to_datetime(usage_date).strftime("%Y-%m-%d")
+        else:
+            grouped["datetime"] = pd.to_datetime(grouped["datetime"], errors="coerce").dt.strftime("%Y-%m-%d")
+        grouped["account_id"] = grouped["__acct_key__"]
+        # Include __original_account_name__ in return if it exists
+        return_cols = ["customer_id", "AccountName", "event_type_name", "datetime", "value", "differentiator", "account_id"]
+        if "__original_account_name__" in grouped.columns:
+            return_cols.append("__original_account_name__")
+        return grouped[return_cols], aggregates, raw_rows
+
+    if chunksize:
+        # Streaming mode: the exports are read chunk by chunk and their rows
+        # spilled to disk instead of being held in memory whole
+        income_source = partial(read_csv_chunks, uploaded_income, chunksize, dtype=transaction_dtypes(str))
+        lbpa_source = partial(read_csv_chunks, uploaded_lbpa, chunksize, dtype=transaction_dtypes(str))
+    else:
+        with metrics.stage("Parse exports") as stage:
+            income_source, lbpa_source = (
+                upload.copy() if isinstance(upload, pd.DataFrame) else read_transactions(upload)
+                for upload in (uploaded_income, uploaded_lbpa)
+            )
+            stage.rows = len(income_source) + len(lbpa_source)
+
+    # Streamed exports are parsed inside these stages, chunk by chunk
+    with metrics.stage("Map and aggregate Income") as stage:
+        income_upload, income_aggregates, income_df = process_usage(income_source, "Per Application",
+                                      ["isinitialsubmission", "perapplication", "applicationcount"])
+        stage.rows = len(income_df)
+    income_upload["ApplicationTypeName"] = "Income"
+    # Apply optional event type overrides from mapping (by account_id)
+    if acct_to_income_evt:
+        income_upload["event_type_name"] = income_upload["account_id"].map(acct_to_income_evt).fillna(income_upload["event_type_name"])
+
+    with metrics.stage("Map and aggregate LBPA") as stage:
+        lbpa_upload, lbpa_aggregates, lbpa_df = process_usage(lbpa_source, "Units",
+                                    ["unitsaspersubmission", "units", "unitcount"])
+        stage.rows = len(lbpa_df)
+    lbpa_upload["ApplicationTypeName"] = "LBPA"
+    
+    if acct_to_lbpa_evt:
+        lbpa_upload["event_type_name"] = lbpa_upload["account_id"].map(acct_to_lbpa_evt).fillna(lbpa_upload["event_type_name"])
+
+    # Final combined usage (internal dataframe with account_id)
+    combined_internal = pd.concat([income_upload, lbpa_upload], ignore_index=True)
+    
+
+    # Map event_type_name based on ApplicationTypeName
+    # Income: "Per Application" -> "app", "Units" -> "unit"
+    # LBPA: "Per Application" -> "LBPA app", "Units" -> "LBPA unit"
+    income_mask = combined_internal["ApplicationTypeName"] == "Income"
+    lbpa_mask = combined_internal["ApplicationTypeName"] == "LBPA"
+    
+    # Income mapping
+    combined_internal.loc[income_mask & (combined_internal["event_type_name"] == "Per Application"), "event_type_name"] = "app"
+    combined_internal.loc[income_mask & (combined_internal["event_type_name"] == "Units"), "event_type_name"] = "unit"
+    
+    # LBPA mapping
+    combined_internal.loc[lbpa_mask & (combined_internal["event_type_name"] == "Per Application"), "event_type_name"] = "LBPA app"
+    combined_internal.loc[lbpa_mask & (combined_internal["event_type_name"] == "Units"), "event_type_name"] = "LBPA unit"
+
+    # Optional: resolve Tabs IDs now using NetSuite external IDs via API
+    if resolve_ns is not None:
+        # Build acct -> NS map from clients file
+        # Reuse acct_to_ns_id built earlier in this function
+        missing_mask = combined_internal["customer_id"].isna() | (combined_internal["customer_id"].astype(str).str.strip() == "")
+        if missing_mask.any():
+            acct_keys = combined_internal.loc[missing_mask, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
+            ns_series = acct_keys.map(acct_to_ns_id)
+            unique_ns = sorted(x for x in ns_series.dropna().unique().tolist() if str(x).strip())
+            # One bulk resolution (and one cache write) for every missing NS ID
+            with metrics.stage("Resolve NetSuite IDs", rows=len(unique_ns)):
+                ns_to_tabs = resolve_ns(unique_ns)
+            if ns_to_tabs:
+                combined_internal.loc[missing_mask, "customer_id"] = ns_series.map(ns_to_tabs)
+    
+    totals_stage = metrics.start("Customer totals", rows=len(combined_internal))
+    # Ensure customer_id is populated and string type AFTER resolution
+    combined_internal["customer_id"] = combined_internal["customer_id"].astype(str)
+    valid_customer_mask = (
+        (combined_internal["customer_id"] != "nan") &
+        (combined_internal["customer_id"] != "None") &
+        (combined_internal["customer_id"].str.strip() != "")
+    )
+    
+    # NOW calculate sums AFTER customer_id resolution
+    # Sum UnitsAsPerSubmission and IsInitialSubmission directly from Income and LBPA files per customer_id
+    # Use the account_id to customer_id mapping from combined_internal to map back to Income and LBPA files
+    
+    # Create a mapping from account_id to customer_id from combined_internal
+    account_to_customer_mapping = {}
+    if "account_id" in combined_internal.columns and "customer_id" in combined_internal.columns:
+        valid_mapping_mask = (
+            combined_internal["customer_id"].notna() &
+            (combined_internal["customer_id"].astype(str).str.strip() != "") &
+            (combined_internal["customer_id"].astype(str).str.strip().str.lower() != "nan") &
+            combined_internal["account_id"].notna()
+        )
+        mapping_df = combined_internal[valid_mapping_mask][["account_id", "customer_id"]].drop_duplicates()
+        account_to_customer_mapping = dict(zip(
+            mapping_df["account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True),
+            mapping_df["customer_id"].astype(str)
+        ))
+    
+    def customer_group_keys(aggregates: pd.DataFrame):
+        """customer_id of each aggregate row (from the account_id mapping, falling
+        back to the customer name) and its sum group: customer_id, or
+        customer_id + account for Finastra accounts."""
+        customer_ids = aggregates["customer_id"]
+        if "AccountID" in aggregates.columns:
+            if account_to_customer_mapping:
+                customer_ids = aggregates["AccountID"].map(account_to_customer_mapping)
+            elif acct_to_tabs_id:
+                # Fallback: try using acct_to_tabs_id if available
+                customer_ids = aggregates["AccountID"].map(acct_to_tabs_id)
+            else:
+                customer_ids = pd.Series(None, index=aggregates.index, dtype=object)
+        # If customer_id still missing, try mapping by customer name using parent_to_id
+        if "CustomerName" in aggregates.columns and customer_ids.isna().any():
+            join_keys = aggregates["CustomerName"].astype(str).str.lower().str.replace(r"[^a-z0-9]", "", regex=True)
+            customer_ids = customer_ids.fillna(join_keys.map(parent_to_id))
+        customer_ids = customer_ids.astype(str)
+        valid = (customer_ids != "nan") & (customer_ids != "None") & (customer_ids.str.strip() != "")
+        finastra = aggregates["CustomerName"].astype(str).str.strip().str.lower() == "finastra"
+        group_keys = customer_ids.copy()
+        if "AccountID" in aggregates.columns:
+            finastra_valid = finastra & valid
+            group_keys[finastra_valid] = customer_ids[finastra_valid] + "_" + aggregates.loc[finastra_valid, "AccountID"]
+        return valid, group_keys
+
+    # Sum UnitsAsPerSubmission and IsInitialSubmission from Income and LBPA files per group_key
+    customer_units_sums = {}
+    customer_app_sums = {}
+    for aggregates in (income_aggregates, lbpa_aggregates):
+        valid, group_keys = customer_group_keys(aggregates)
+        if not valid.any():
+            continue
+        for sum_col, sums in (("UnitsAsPerSubmission", customer_units_sums), ("IsInitialSubmission", customer_app_sums)):
+            if sum_col in aggregates.columns:
+                for group_key, value in aggregates.loc[valid, sum_col].groupby(group_keys[valid]).sum().items():
+                    sums[group_key] = sums.get(group_key, 0) + value
+    
+    # Initialize columns
+    combined_internal["UnitsAsPerSubmission"] = 0
+    combined_internal["IsInitialSubmission"] = 0
+    
+    # Set CustomerName if not already set (needed for group_key logic)
+    if "CustomerName" not in combined_internal.columns:
+        combined_internal["CustomerName"] = combined_internal.get("AccountName", "")
+    
+    # Create group_key in combined_internal for mapping
+    combined_internal["__group_key__"] = combined_internal["customer_id"].astype(str)
+    finastra_mask = combined_internal["CustomerName"].astype(str).str.strip().str.lower() == "finastra"
+    if "account_id" in combined_internal.columns:
+        finastra_with_account = finastra_mask & combined_internal["account_id"].notna()
+        combined_internal.loc[finastra_with_account, "__group_key__"] = (
+            combined_internal.loc[finastra_with_account, "customer_id"].astype(str) + "_" +
+            combined_internal.loc[finastra_with_account, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
+        )
+    
+    # Map sums to all rows using group_key
+    if customer_units_sums and valid_customer_mask.any():
+        mapped_units = combined_internal.loc[valid_customer_mask, "__group_key__"].map(customer_units_sums).fillna(0)
+        combined_internal.loc[valid_customer_mask, "UnitsAsPerSubmission"] = mapped_units
+    
+    if customer_app_sums and valid_customer_mask.any():
+        mapped_apps = combined_internal.loc[valid_customer_mask, "__group_key__"].map(customer_app_sums).fillna(0)
+        combined_internal.loc[valid_customer_mask, "IsInitialSubmission"] = mapped_apps
+    
+    # For rows with missing customer_id, calculate sums by account_id instead
+    # Sum ALL rows from original Income and LBPA files by account_id (not just ones without customer_id)
+    missing_customer_mask = ~valid_customer_mask
+    if missing_customer_mask.any() and "account_id" in combined_internal.columns:
+        # Create account_id to sum mappings for missing customer_id rows
+        account_units_sums = {}
+        account_app_sums = {}
+        
+        # Sum from Income and LBPA files by account_id (ALL rows, not filtered by customer_id)
+        for raw_df, aggregates in ((income_df, income_aggregates), (lbpa_df, lbpa_aggregates)):
+            if "AccountID" not in aggregates.columns:
+                continue
+            for sum_col, sums in (("UnitsAsPerSubmission", account_units_sums), ("IsInitialSubmission", account_app_sums)):
+                if sum_col not in aggregates.columns:
+                    continue
+                if isinstance(raw_df, pd.DataFrame):
+                    # The stored source frames carry the numeric column, as before
+                    raw_df[sum_col] = pd.to_numeric(raw_df[sum_col], errors="coerce").fillna(0)
+                for account_id, value in aggregates.groupby("AccountID")[sum_col].sum().items():
+                    if account_id:
+                        sums[account_id] = sums.get(account_id, 0) + value
+        
+        # Map sums to rows with missing customer_id using account_id
+        if account_units_sums:
+            missing_account_ids = combined_internal.loc[missing_customer_mask, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
+            mapped_units = missing_account_ids.map(account_units_sums).fillna(0)
+            combined_internal.loc[missing_customer_mask, "UnitsAsPerSubmission"] = mapped_units.values
+        
+        if account_app_sums:
+            missing_account_ids = combined_internal.loc[missing_customer_mask, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
+            mapped_apps = missing_account_ids.map(account_app_sums).fillna(0)
+            combined_internal.loc[missing_customer_mask, "IsInitialSubmission"] = mapped_apps.values
+    
+    # Update value column based on event_type_name:
+    # - If event_type_name contains "unit" → value = UnitsAsPerSubmission
+    # - If event_type_name contains "app" → value = IsInitialSubmission
+    evt_lower = combined_internal["event_type_name"].astype(str).str.lower()
+    unit_mask = evt_lower.str.contains("unit")
+    app_mask = evt_lower.str.contains("app")
+    
+    # Only update rows with valid customer_id
+    if valid_customer_mask.any():
+        # For unit events, set value to UnitsAsPerSubmission
+        if unit_mask.any():
+            combined_internal.loc[unit_mask & valid_customer_mask, "value"] = (
+                combined_internal.loc[unit_mask & valid_customer_mask, "UnitsAsPerSubmission"]
+            )
+        
+        # For app events, set value to IsInitialSubmission
+        if app_mask.any():
+            combined_internal.loc[app_mask & valid_customer_mask, "value"] = (
+                combined_internal.loc[app_mask & valid_customer_mask, "IsInitialSubmission"]
+            )
+    
+    # Set CustomerName if not already set (should be set during aggregation)
+    if "CustomerName" not in combined_internal.columns:
+        combined_internal["CustomerName"] = combined_internal.get("AccountName", "")
+    
+    # Set differentiator for Finastra customers only
+    # Use __original_account_name__ directly (it already contains "Finastra - {account name}")
+    finastra_mask = combined_internal["CustomerName"].astype(str).str.strip().str.lower() == "finastra"
+    
+    # For Finastra rows, use the original AccountName from Income file directly
+    # (it already contains "Finastra - {account name}" so no need to prepend "Finastra - ")
+    if "__original_account_name__" in combined_internal.columns:
+        # Use original AccountName from Income file AccountName column directly
+        income_finastra_mask = finastra_mask & (combined_internal["ApplicationTypeName"] == "Income")
+        if income_finastra_mask.any():
+            combined_internal.loc[income_finastra_mask, "differentiator"] = (
+                combined_internal.loc[income_finastra_mask, "__original_account_name__"].astype(str)
+            )
+        # For LBPA rows with Finastra, use AccountName (which should be the customer name)
+        lbpa_finastra_mask = finastra_mask & (combined_internal["ApplicationTypeName"] == "LBPA")
+        if lbpa_finastra_mask.any():
+            combined_internal.loc[lbpa_finastra_mask, "differentiator"] = (
+                "Finastra - " + combined_internal.loc[lbpa_finastra_mask, "AccountName"].astype(str)
+            )
+    else:
+        # Fallback: use AccountName if __original_account_name__ not available
+        combined_internal.loc[finastra_mask, "differentiator"] = (
+            "Finastra - " + combined_internal.loc[finastra_mask, "AccountName"].astype(str)
+        )
+    
+    # Set differentiator to empty for non-Finastra customers
+    combined_internal.loc[~finastra_mask, "differentiator"] = ""
+
+    # Order/output columns to match Tabs expected headers
+    upload_cols = [
+        "customer_id",
+        "CustomerName",
+        "event_type_name",
+        "datetime",
+        "ApplicationTypeName",
+        "UnitsAsPerSubmission",
+        "IsInitialSubmission",
+        "value",
+        "differentiator",
+    ]
+    
+    # Separate unmapped rows (customer_id is missing AND CustomerName is still numeric/account ID)
+    # Use the same logic as valid_customer_mask to identify invalid customer_ids
+    customer_id_missing = (
+        combined_internal["customer_id"].isna() |
+        (combined_internal["customer_id"].astype(str).str.strip() == "") |
+        (combined_internal["customer_id"].astype(str).str.strip().str.lower() == "nan") |
+        (combined_internal["customer_id"].astype(str).str.strip() == "None")
+    )
+    customer_name_is_numeric = combined_internal["CustomerName"].astype(str).str.match(r'^\d+$', na=False)
+    unmapped_mask = customer_id_missing & customer_name_is_numeric
+    
+    
+    # Also check for rows with invalid customer_id (not just missing, but also "nan", "None", empty)
+    invalid_customer_mask = (
+        combined_internal["customer_id"].isna() |
+        (combined_internal["customer_id"].astype(str).str.strip() == "") |
+        (combined_internal["customer_id"].astype(str).str.strip().str.lower() == "nan") |
+        (combined_internal["customer_id"].astype(str).str.strip() == "None")
+    )
+    
+    # Create separate DataFrames for mapped and unmapped rows
+    # Only include rows with valid customer_id in the main output
+    unmapped_df = combined_internal[unmapped_mask].copy()
+    
+    # Separate rows with missing customer_id (regardless of CustomerName status)
+    missing_customer_id_df = combined_internal[customer_id_missing].copy()
+    
+    mapped_df = combined_internal[valid_customer_mask].copy()  # Use valid_customer_mask instead of ~unmapped_mask
+    
+    combined = mapped_df[upload_cols]
+    unmapped_output = unmapped_df[upload_cols] if len(unmapped_df) > 0 else pd.DataFrame(columns=upload_cols)
+    
+    
+    # Create CSV for rows with missing customer_id
+    missing_customer_id_output = missing_customer_id_df[upload_cols] if len(missing_customer_id_df) > 0 else pd.DataFrame(columns=upload_cols)
+    metrics.finish(totals_stage)
+
+    # Prepare in-memory CSV bytes
+    with metrics.stage("Write usage CSVs", rows=len(combined_internal)):
+        missing_customer_id_csv_bytes = missing_customer_id_output.to_csv(index=False).encode("utf-8") if len(missing_customer_id_output) > 0 else b""
+        combined_csv_bytes = combined.to_csv(index=False).encode("utf-8")
+        combined_internal_csv_bytes = combined_internal.to_csv(index=False).encode("utf-8")
+        unmapped_csv_bytes = unmapped_output.to_csv(index=False).encode("utf-8") if len(unmapped_output) > 0 else b""
+
+    return UsageResult(
+        combined_csv_bytes, combined_internal_csv_bytes, unmapped_csv_bytes, missing_customer_id_csv_bytes,
+        unmapped_output, missing_customer_id_output, income_upload, income_df, lbpa_df,
+    )
+
+
+def output_files(result: UsageResult) -> dict:
+    """The generated files of ``result`` as {key: {"name", "bytes"}}; the unmapped
+    and missing customer_id files only when they have rows."""
+    files = {
+        "usage_combined": {"name": "LoanLogics_upload_All.csv", "bytes": result.usage_csv},
+        "usage_internal": {"name": "LoanLogics_upload_All_internal.csv", "bytes": result.internal_csv},
+    }
+    if len(result.unmapped) > 0:
+        files["usage_unmapped"] = {"name": "LoanLogics_upload_Unmapped.csv", "bytes": result.unmapped_csv}
+    if len(result.missing_customer_id) > 0:
+        files["usage_missing_customer_id"] = {
+            "name": "LoanLogics_upload_Missing_Customer_ID.csv",
+            "bytes": result.missing_customer_id_csv,
+        }
+    return files
+
+
+def generate_split_csvs_with_all_columns(income_df, lbpa_df, usage_df, max_rows_per_split_csv=900, max_workers=None,
+                                         metrics: RunMetrics | None = None):
+    """Generate split CSVs with all original columns from Income and LBPA files, grouped by customer_id.
+    Uses the Usage CSV (which has customer_id) to join back to original dataframes.
+
+    Each split is a dict with its ``name`` and CSV ``bytes`` plus the ``rows``,
+    ``customer_id``, ``customer_name``, ``size`` (bytes) and ``hash`` (MD5) of
+    the file, so the pages listing splits never have to parse them again.
+    ``max_workers`` processes write them (see ``split_writer.write_splits``).
+    Stage timings are recorded in ``metrics``."""
+    metrics = metrics if metrics is not None else RunMetrics()
+    
+    # Extract customer_id mapping from usage_df
+    # The usage_df has CustomerName (not AccountName) and customer_id columns
+    if usage_df is None or len(usage_df) == 0:
+        return []
+    
+    # Check what column name is used in usage_df for the customer name
+    usage_name_col = None
+    if "CustomerName" in usage_df.columns:
+        usage_name_col = "CustomerName"
+    elif "AccountName" in usage_df.columns:
+        usage_name_col = "AccountName"
+    
+    # Get mappings from usage_df - try account_id first, then CustomerName
+    account_id_to_customer_id = {}
+    customername_to_customer_id = {}
+    # Also create reverse mapping: customer_id -> CustomerName (for filename)
+    customer_id_to_name = {}
+    
+    if "account_id" in usage_df.columns and "customer_id" in usage_df.columns:
+        # Create account_id -> customer_id mapping (like reference code uses UUID)
+        usage_acct_mapping = usage_df[["account_id", "customer_id"]].drop_duplicates()
+        usage_acct_mapping["__acct_key__"] = usage_acct_mapping["account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
+        account_id_to_customer_id = dict(zip(usage_acct_mapping["__acct_key__"], usage_acct_mapping["customer_id"]))
+    
+    if usage_name_col and "customer_id" in usage_df.columns:
+        usage_mapping = usage_df[[usage_name_col, "customer_id"]].drop_duplicates()
+        # Create both exact and normalized name mappings
+        for name, cust_id in zip(usage_mapping[usage_name_col].astype(str), usage_mapping["customer_id"]):
+            customername_to_customer_id[name] = cust_id
+            # Also create normalized version for matching
+            normalized_name = normalize_name(name)
+            if normalized_name not in customername_to_customer_id:
+                customername_to_customer_id[normalized_name] = cust_id
+        # Reverse mapping for filename generation
+        customer_id_to_name = dict(zip(usage_mapping["customer_id"].astype(str), usage_mapping[usage_name_col].astype(str)))
+    
+    def add_customer_id_from_usage(df, df_name):
+        """Add customer_id to dataframe by joining with usage_df mapping"""
+        df = df.copy()
+        df.columns = df.columns.str.strip()
+        
+        # Find AccountName/CustomerName column in original Income/LBPA file
+        parent_col = find_column(df, ["customername", "accountname", "name"])
+        acct_id_col = find_column(df, ["accountid", "acct#", "acct", "account number", "accountnumber"])
+        
+        if parent_col:
+            df["__original_name__"] = df[parent_col].astype(str)
+            df["__original_name__"] = df["__original_name__"].fillna("Unknown")
+        else:
+            df["__original_name__"] = "Unknown"
+        
+        # Try account_id matching first (most reliable, like reference code)
+        if acct_id_col and account_id_to_customer_id:
+            df["__acct_key__"] = df[acct_id_col].astype(str).str.replace(r"[^0-9]", "", regex=True)
+            df["customer_id"] = df["__acct_key__"].map(account_id_to_customer_id)
+        
+        # Fill missing with name-based matching (try exact first, then normalized)
+        if customername_to_customer_id:
+            # Try exact match first
+            name_mapped = df["__original_name__"].map(customername_to_customer_id)
+            if "customer_id" in df.columns:
+                df["customer_id"] = df["customer_id"].fillna(name_mapped)
+            else:
+                df["customer_id"] = name_mapped
+            
+            # If still missing, try normalized name matching
+            missing_mask = df["customer_id"].isna()
+            if missing_mask.any():
+                df.loc[missing_mask, "__normalized_name__"] = df.loc[missing_mask, "__original_name__"].apply(normalize_name)
+                normalized_mapped = df.loc[missing_mask, "__normalized_name__"].map(customername_to_customer_id)
+                df.loc[missing_mask, "customer_id"] = df.loc[missing_mask, "customer_id"].fillna(normalized_mapped)
+        
+        if "customer_id" not in df.columns:
+            df["customer_id"] = None
+        
+        return df
+    
+    # Remove helper columns before generating CSVs (keep only original columns + customer_id)
+    helper_columns = ["__original_name__", "__acct_key__", "__normalized_name__", "__join_key__", "__original_account_name__"]
+
+    def customer_groups():
+        """(customer_id, rows) for every customer, in customer_id order, plus the
+        output columns. Streamed sources (RowStores) are read chunk by chunk and
+        partitioned per customer on disk, so only the customers being written are
+        in memory.
+        """
+        if not isinstance(income_df, RowStore) and not isinstance(lbpa_df, RowStore):
+            # Add customer_id to both dataframes using the usage mapping
+            income_with_id = add_customer_id_from_usage(income_df, "income")
+            lbpa_with_id = add_customer_id_from_usage(lbpa_df, "lbpa")
+            # Combine both dataframes
+            combined_all = pd.concat([income_with_id, lbpa_with_id], ignore_index=True)
+            return combined_all.groupby("customer_id"), list(combined_all.columns)
+
+        sources = [(income_df, "income"), (lbpa_df, "lbpa")]
+        # Column layout of the combined rows, as pd.concat would produce it
+        all_columns = []
+        for source, df_name in sources:
+            source_columns = source.columns if isinstance(source, RowStore) else list(source.columns)
+            empty_with_id = add_customer_id_from_usage(pd.DataFrame(columns=source_columns or []), df_name)
+            all_columns += [col for col in empty_with_id.columns if col not in all_columns]
+        partitions: dict[str, RowStore] = {}
+        for source, df_name in sources:
+            chunks = source.iter_chunks() if isinstance(source, RowStore) else [source]
+            for chunk in chunks:
+                with_id = add_customer_id_from_usage(chunk, df_name)
+                for customer_id, rows in with_id.groupby("customer_id"):
+                    if customer_id not in partitions:
+                        partitions[customer_id] = RowStore(prefix="split_rows_")
+                    partitions[customer_id].append(rows)
+
+        def read_partitions():
+            try:
+                for customer_id in sorted(partitions):
+                    # Aligned by pd.concat, as the in-memory rows are, then laid out like them
+                    yield customer_id, partitions[customer_id].read().reindex(columns=all_columns)
+                    partitions[customer_id].delete()
+            finally:
+                for partition in partitions.values():
+                    partition.delete()
+        return read_partitions(), all_columns
+
+    with metrics.stage("Group split rows by customer"):
+        groups, all_columns = customer_groups()
+    # Generate split CSVs grouped by customer_id
+    columns_to_keep = [col for col in all_columns if col not in helper_columns]
+    # Ensure customer_id is included
+    if "customer_id" not in columns_to_keep:
+        columns_to_keep.append("customer_id")
+    # Customers are sorted and written in worker processes, in customer_id order
+    # (streamed partitions are read back from disk during this stage)
+    with metrics.stage("Write split CSVs") as stage:
+        split_csvs = write_splits(groups, columns_to_keep, customer_id_to_name, max_rows_per_split_csv, max_workers)
+        stage.rows = sum(split_csv["rows"] for split_csv in split_csvs)
+    return split_csvs
+
+
+def load_invoices(cache: InvoiceCache, api_key: str, refresh: bool = False, log=print) -> InvoiceCache:
+    """``cache`` loaded from its file, fetching all invoices into it first when
+    it is still empty (or ``refresh`` is set). A fetch with failed pages is not
+    saved: its timestamp would keep later incremental refreshes from ever
+    filling the gaps. ``map_invoices`` looks up what the cache lacks."""
+    if not len(cache):
+        cache.load()
+    if refresh or not len(cache):
+        fetched_at = datetime.now()
+        result = fetch_all_invoices(api_key)
+        for page, error in sorted(result.failed_pages.items()):
+            log(f"❌ Invoice page {page}: {error}")
+        if result.failed_pages:
+            log("⚠️ Invoice cache left unchanged: some pages could not be fetched")
+        elif result.items:
+            cache.update(result.items, fetched_at)
+    log(f"📋 {len(cache):,} cached invoices" + (f" (fetched {cache.timestamp:%Y-%m-%d %H:%M})" if cache.timestamp else ""))
+    return cache
+
+
+def select_invoice(invoices: list[dict], issue_date=None) -> str | None:
+    """Id of the most recent non-deleted TABS invoice among one customer's
+    ``invoices`` issued on ``issue_date``, the choice ``InvoiceIndex.find_invoice``
+    makes from the cache. Invoices without a usable issue date match any date."""
+    live = [
+        invoice for invoice in invoices
+        if str(invoice.get("status") or "").upper() != "DELETED" and str(invoice.get("source") or "").upper() == "TABS"
+    ]
+    # Stable, so invoices issued the same day keep the API's order
+    for invoice in sorted(live, key=lambda invoice: str(invoice.get("issueDate") or ""), reverse=True):
+        issue_day = parse_issue_date(invoice.get("issueDate"))
+        if issue_date is None or issue_day is None or issue_day == issue_date:
+            return invoice.get("id")
+    return None
+
+
+def map_invoices(split_csvs: list[dict], issue_date, index: InvoiceCache | InvoiceIndex,
+                 api_key: str | None = None, max_workers: int = INVOICE_LOOKUP_WORKERS,
+                 on_complete=None) -> tuple[list[dict], list[dict]]:
+    """Invoice of each split CSV for ``issue_date``: (mapped rows, problematic
+    rows), with the columns of the app's Step 2 mapping tables. ``index`` is
+    anything with ``find_invoice(customer_id, issue_date)``.
+
+    Each distinct customer is resolved once, through ``index``. With an
+    ``api_key``, customers it has no invoice for (e.g. invoices created since
+    the last refresh, or an empty cache) are looked up with one
+    ``/customers/{id}/invoices?issueDate=`` call each, ``max_workers`` at a
+    time. ``on_complete(done, total)`` is called as customers are resolved."""
+    issue_date = parse_issue_date(issue_date)
+    issue_day = issue_date.strftime("%Y-%m-%d")
+    customer_ids = list(dict.fromkeys(split_csv.get("customer_id") for split_csv in split_csvs
+                                      if split_csv.get("customer_id")))
+    invoice_ids = {customer_id: index.find_invoice(customer_id, issue_date) for customer_id in customer_ids}
+    misses = [customer_id for customer_id, invoice_id in invoice_ids.items() if not invoice_id] if api_key else []
+    done = len(customer_ids) - len(misses)
+    if on_complete:
+        on_complete(done, len(customer_ids))
+    if misses:
+        with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+            futures = {executor.submit(fetch_customer_invoices, customer_id, api_key, issue_day): customer_id
+                       for customer_id in misses}
+            for future in as_completed(futures):
+                customer_id = futures[future]
+                try:
+                    customer_invoices = future.result()
+                except Exception:
+                    customer_invoices = None
+                if customer_invoices:
+                    invoice_ids[customer_id] = select_invoice(customer_invoices, issue_date)
+                done += 1
+                if on_complete:
+                    on_complete(done, len(customer_ids))
+
+    mapping_rows, problems = [], []
+    for split_csv in split_csvs:
+        customer_id = split_csv.get("customer_id")
+        if not customer_id:
+            problems.append({
+                "split_csv_filename": split_csv["name"],
+                "customer_id": "N/A",
+                "issue_date": issue_day,
+                "issue": "No customer IDs found",
+            })
+            continue
+        invoice_id = invoice_ids[customer_id]
+        if invoice_id:
+            mapping_rows.append({
+                "split_csv_filename": split_csv["name"],
+                "customer_id": customer_id,
+                "invoice_id": invoice_id,
+                "issue_date": issue_day,
+            })
+        else:
+            problems.append({
+                "split_csv_filename": split_csv["name"],
+                "customer_id": customer_id,
+                "issue_date": issue_day,
+                "issue": f"No matching invoice found for customer {customer_id} on {issue_date}",
+            })
+    return mapping_rows, problems
+
+
+def fetch_customer_invoices(customer_id, api_key: str, issue_date: str | None = None) -> list[dict] | None:
+    """Every invoice of one customer from the API (only those issued on
+    ``issue_date``, ``YYYY-MM-DD``, when given); None when they could not be read.
+    Invoices are stamped with ``customerId`` where the payload leaves it out."""
+    params = {"issueDate": issue_date} if issue_date else None
+    result = tabs_client.fetch_all_pages(f"customers/{customer_id}/invoices", api_key, params=params)
+    if result.failed_pages:
+        return None
+    for invoice in result.items:
+        # The customer-scoped endpoint need not repeat the customer it was asked about
+        invoice.setdefault("customerId", str(customer_id))
+    return result.items
+
+
+def _invoice_issue(invoice: dict, customer_id: str) -> str | None:
+    if str(invoice.get("customerId") or "") != customer_id:
+        return f"Invoice belongs to customer {invoice.get('customerId')}, not {customer_id}"
+    if str(invoice.get("status") or "").upper() == "DELETED":
+        return "Invoice is deleted"
+    return None
+
+
+def check_invoice_pairs(pairs, invoices: InvoiceCache | InvoiceIndex | None, api_key: str | None = None,
+                        max_workers: int = INVOICE_LOOKUP_WORKERS) -> list[str | None]:
+    """Why each (customer_id, invoice_id) cannot take an attachment, or None
+    when it can: the invoice must exist, belong to the customer and not be
+    deleted. Checked before uploading, so no bytes are sent to invoices that
+    would reject them.
+
+    Pairs are checked against ``invoices`` (anything with ``find_by_id``).
+    Invoices not cached, e.g. created since the last refresh, are looked up
+    with one ``/customers/{id}/invoices`` call per customer, ``max_workers``
+    at a time, when an ``api_key`` is given. Pairs that cannot be checked
+    (no API key, or the call failed) are let through."""
+    pairs = [(str(customer_id or "").strip(), str(invoice_id or "").strip()) for customer_id, invoice_id in pairs]
+    issues: list[str | None] = [None] * len(pairs)
+    uncached: dict[str, list[int]] = {}
+    for i, (customer_id, invoice_id) in enumerate(pairs):
+        if not customer_id or customer_id.lower() == "nan":
+            issues[i] = "No customer ID"
+        elif not invoice_id or invoice_id.lower() == "nan":
+            issues[i] = "No invoice ID"
+        else:
+            invoice = invoices.find_by_id(invoice_id) if invoices is not None else None
+            if invoice is not None:
+                issues[i] = _invoice_issue(invoice, customer_id)
+            else:
+                uncached.setdefault(customer_id, []).append(i)
+    if not uncached or not api_key:
+        return issues
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+        futures = {executor.submit(fetch_customer_invoices, customer_id, api_key): customer_id
+                   for customer_id in uncached}
+        for future in as_completed(futures):
+            customer_id = futures[future]
+            try:
+                customer_invoices = future.result()
+            except Exception:
+                customer_invoices = None
+            if customer_invoices is None:
+                continue
+            by_id = {str(invoice.get("id")): invoice for invoice in customer_invoices}
+            for i in uncached[customer_id]:
+                invoice = by_id.get(pairs[i][1])
+                issues[i] = _invoice_issue(invoice, customer_id) if invoice else "Invoice not found for this customer"
+    return issues
+
+
+def upload_splits(split_csvs: list[dict], mapping_rows: list[dict], api_key: str, journal: UploadJournal,
+                  max_workers: int = UPLOAD_WORKERS, on_complete=None) -> list[dict]:
+    """Attach each mapped split CSV to its invoice, skipping uploads the journal
+    already records as done. Returns one result row per mapping row."""
+    splits_by_name = {split_csv["name"]: split_csv for split_csv in split_csvs}
+    results, jobs = [], []
+    for row in mapping_rows:
+        split_csv = splits_by_name.get(row["split_csv_filename"])
+        result = {
+            "split_csv": row["split_csv_filename"],
+            "customer_id": row["customer_id"],
+            "invoice_id": row["invoice_id"],
+            "status": "Pending",
+            "reason": "",
+        }
+        results.append(result)
+        if split_csv is None:
+            result.update(status="Failed", reason="Split CSV not found")
+            continue
+        csv_hash = split_csv.get("hash") or content_hash(split_csv["bytes"])
+        if journal.is_uploaded(row["invoice_id"], csv_hash):
+            result.update(status="Skipped", reason="Already uploaded")
+            continue
+        jobs.append({
+            "customer_id": row["customer_id"],
+            "invoice_id": row["invoice_id"],
+            "bytes": split_csv["bytes"],
+            "filename": split_csv["name"],
+            "hash": csv_hash,
+            "result": result,
+        })
+    flags = upload_csv_attachments_concurrently(jobs, api_key, max_workers, on_complete, journal)
+    for job, success in zip(jobs, flags):
+        job["result"].update(status="Success" if success else "Failed", reason="" if success else "Upload failed")
+    return results
+
+
+def _write_csv(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Run the LoanLogics usage -> split CSV -> invoice mapping -> upload pipeline without the app."
+    )
+    parser.add_argument("--income", required=True, help="Income export (CSV)")
+    parser.add_argument("--lbpa", required=True, help="LBPA export (CSV)")
+    mappings_source = parser.add_mutually_exclusive_group()
+    mappings_source.add_argument("--mappings", default=MAPPINGS_FILE, help="client mappings JSON (default: %(default)s)")
+    mappings_source.add_argument("--clients", help="clients CSV to extract the mappings from instead")
+    parser.add_argument("--usage-date", help="date given to every usage row (YYYY-MM-DD); default: latest submission per account")
+    parser.add_argument("--issue-date", help="invoice issue date (YYYY-MM-DD); without it the run stops after the split CSVs")
+    parser.add_argument("--output-dir", default=os.path.join("usage_uploads", "batch"), help="default: %(default)s")
+    parser.add_argument("--api-key", default=os.environ.get("TABS_API_KEY", ""), help="Tabs API key (default: $TABS_API_KEY)")
+    parser.add_argument("--chunksize", type=int, help="stream the exports in chunks of this many rows (low-memory mode)")
+    parser.add_argument("--max-rows-per-split", type=int, default=999999, help="default: one split CSV per customer")
+    parser.add_argument("--split-workers", type=int, help="processes writing split CSVs (default: one per CPU core)")
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS, help="concurrent uploads (default: %(default)s)")
+    parser.add_argument("--rate-limit", type=float,
+                        help="Tabs API requests/second, 0 for none (default: $TABS_RATE_LIMIT or 20)")
+    parser.add_argument("--rate-burst", type=float, help="requests sent at once before pacing (default: twice the rate)")
+    parser.add_argument("--resolve-ns", action="store_true", help="resolve accounts mapped only to a NetSuite ID via the API")
+    parser.add_argument("--refresh-invoices", action="store_true", help="re-fetch all invoices instead of using the cache")
+    parser.add_argument("--no-upload", action="store_true", help="stop after writing the invoice mapping")
+    parser.add_argument("--cache-dir", default=SESSION_DIR, help="invoice cache and upload journal (default: %(default)s)")
+    parser.add_argument("--api-base-url", default=tabs_client.TABS_API_BASE_URL,
+                        help="Tabs v3 API root, e.g. a local stand-in server (default: $TABS_API_BASE_URL or %(default)s)")
+    parser.add_argument("--metrics-report", help="run report JSON (default: run_report.json in the output directory)")
+    args = parser.parse_args(argv)
+    if (args.issue_date or args.resolve_ns) and not args.api_key:
+        parser.error("--issue-date and --resolve-ns need an API key (--api-key or $TABS_API_KEY)")
+    if args.issue_date and parse_issue_date(args.issue_date) is None:
+        parser.error(f"invalid --issue-date: {args.issue_date}")
+
+    tabs_client.set_base_url(args.api_base_url)
+    if args.rate_limit is not None or args.rate_burst:
+        tabs_client.configure_rate_limit(
+            tabs_client.RATE_LIMIT_PER_SEC if args.rate_limit is None else args.rate_limit, args.rate_burst)
+    args.cache_dir = tabs_client.scoped_cache_dir(args.cache_dir)
+
+    metrics = RunMetrics("batch")
+    try:
+        return run_pipeline(args, metrics)
+    finally:
+        print(f"\n⏱️ Run metrics\n{metrics.format_table()}")
+        report_path = metrics.save(args.metrics_report or os.path.join(args.output_dir, "run_report.json"))
+        print(f"📈 Run report written to {report_path}")
+
+
+def run_pipeline(args, metrics: RunMetrics) -> int:
+    """The command line run for parsed ``args`` (see ``main``); the exit status."""
+    if args.clients:
+        mappings = extract_mappings_from_clients(args.clients)
+    else:
+        mappings = load_mappings_file(args.mappings)
+        if not mappings:
+            print(f"⚠️ No client mappings in {args.mappings}. Proceeding without customer_id mapping.")
+
+    print("\n🔹 Building usage")
+    resolve_ns = (
+        partial(resolve_tabs_ids, api_key=args.api_key,
+                cache=NsIdCache.load(os.path.join(args.cache_dir, "ns_to_tabs_cache.json")))
+        if args.resolve_ns else None
+    )
+    with open(args.income, "rb") as income, open(args.lbpa, "rb") as lbpa:
+        result = build_usage(income, lbpa, mappings, usage_date=args.usage_date,
+                             chunksize=args.chunksize, resolve_ns=resolve_ns, metrics=metrics)
+    with metrics.stage("Save usage CSVs"):
+        for generated in output_files(result).values():
+            _write_csv(os.path.join(args.output_dir, generated["name"]), generated["bytes"])
+    print(f"✅ Usage written to {args.output_dir} ({len(result.unmapped)} unmapped, "
+          f"{len(result.missing_customer_id)} missing customer_id)")
+
+    print("\n🔹 Generating split CSVs")
+    split_csvs = generate_split_csvs_with_all_columns(
+        result.income_rows, result.lbpa_rows, read_usage(BytesIO(result.usage_csv)),
+        max_rows_per_split_csv=args.max_rows_per_split, max_workers=args.split_workers, metrics=metrics,
+    )
+    with metrics.stage("Save split CSVs", rows=len(split_csvs)):
+        for split_csv in split_csvs:
+            _write_csv(os.path.join(args.output_dir, "splits", split_csv["name"]), split_csv["bytes"])
+    print(f"✅ {len(split_csvs)} split CSVs written to {os.path.join(args.output_dir, 'splits')}")
+    if not args.issue_date:
+        return 0
+
+    print(f"\n🔹 Mapping split CSVs to invoices issued {args.issue_date}")
+    with metrics.stage("Load invoices") as stage:
+        invoices = load_invoices(InvoiceCache(invoice_cache_path(args.cache_dir, args.api_key)), args.api_key,
+                                 refresh=args.refresh_invoices)
+        stage.rows = len(invoices)
+    with metrics.stage("Map invoices", rows=len(split_csvs)):
+        mapping_rows, problems = map_invoices(split_csvs, args.issue_date, invoices, args.api_key)
+    mapping_df = pd.DataFrame(mapping_rows, columns=["split_csv_filename", "customer_id", "invoice_id", "issue_date"])
+    _write_csv(os.path.join(args.output_dir, "invoice_mapping.csv"), mapping_df.to_csv(index=False).encode("utf-8"))
+    if problems:
+        _write_csv(os.path.join(args.output_dir, "problematic_split_csvs.csv"),
+                   pd.DataFrame(problems).to_csv(index=False).encode("utf-8"))
+    print(f"✅ {len(mapping_rows)} split CSVs mapped, {len(problems)} need attention")
+    if args.no_upload or not mapping_rows:
+        return 0
+
+    print(f"\n🔹 Uploading {len(mapping_rows)} attachments ({args.upload_workers} at a time)")
+    journal = UploadJournal(os.path.join(args.cache_dir, "upload_journal.jsonl"))
+    with metrics.stage("Upload attachments", rows=len(mapping_rows)):
+        results = upload_splits(
+            split_csvs, mapping_rows, args.api_key, journal, args.upload_workers,
+            on_complete=lambda done, total: print(f"📤 Uploaded {done}/{total} attachments", end="\r"),
+        )
+    results_df = pd.DataFrame(results)
+    _write_csv(os.path.join(args.output_dir, "upload_results.csv"), results_df.to_csv(index=False).encode("utf-8"))
+    counts = results_df["status"].value_counts()
+    print(f"\n✅ Upload complete! {counts.get('Success', 0)}/{len(results_df)} successful"
+          f" ({counts.get('Skipped', 0)} already uploaded, skipped; {counts.get('Failed', 0)} failed)")
+    return 1 if counts.get("Failed", 0) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
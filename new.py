@@ -1,17 +1,49 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
 import os
-import re
-import requests
 import hashlib
+import json
 import textwrap
 import uuid
 import warnings
-from collections import Counter
+from functools import partial
 from io import BytesIO
 from datetime import datetime
 from fpdf import FPDF
+import frame_cache
+import tabs_client
+from invoice_cache import (
+    InvoiceCache,
+    fetch_all_invoices,
+    invoice_cache_path,
+    invoices_to_records,
+    updated_since_params,
+    MAX_PAGES as INVOICE_MAX_PAGES,
+)
+from loanlogics_usage_transformer import (
+    build_usage,
+    check_invoice_pairs,
+    map_invoices,
+    output_files,
+    extract_mappings_from_clients,
+    generate_split_csvs_with_all_columns,
+    load_mappings_file,
+    NsIdCache,
+    resolve_tabs_id,
+    resolve_tabs_ids,
+    upload_csv_attachments_concurrently,
+)
+from row_store import CHUNK_ROWS, RowStore
+from run_metrics import RunMetrics
+from split_archive import COMPRESSION_LEVELS, DEFAULT_COMPRESSION, read_archive
+from usage_schema import read_transactions, read_usage
+from upload_journal import (
+    STATUS_FAILED,
+    STATUS_STARTED,
+    STATUS_SUCCESS,
+    UploadJournal,
+    content_hash,
+)
 
 # ============ CONFIG ============
 OUTPUT_DIR = "usage_uploads"
@@ -22,8 +54,7 @@ if not API_KEY:
         API_KEY = st.secrets["TABS_API_KEY"]
     except Exception:
         API_KEY = ""
-API_URL_BASE = "https://integrators.prod.api.tabsplatform.com/v3/customers"
-API_INVOICES_URL = "https://integrators.prod.api.tabsplatform.com/v3/invoices"
+STREAM_PREVIEW_ROWS = 1000  # rows previewed per export in low-memory mode
 # =================================
 
 # Initialize session state variables
@@ -184,19 +215,12 @@ def fetch_invoice_by_talent(company_id, talent_name, issue_date=None, api_token=
         return None
     
     try:
-        # Get invoices from API
-        headers = {
-            'Authorization': api_token,
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
-        
         # Use customer-specific endpoint with date filter if available
-        url = f"{API_URL_BASE}/{company_id}/invoices"
+        url = f"customers/{company_id}/invoices"
         if issue_date:
             url += f"?issueDate={issue_date.strftime('%Y-%m-%d')}"
             
-        response = requests.get(url, headers=headers, timeout=30)
+        response = tabs_client.get(url, api_token, json_content=True, timeout=30)
         
         if response.status_code == 200:
             data = response.json()
@@ -223,12 +247,7 @@ def upload_pdf_attachment(customer_id, invoice_id, filepath, talent_name=None, a
             return False
         
         # Construct API URL
-        url = f"{API_URL_BASE}/{customer_id}/invoices/{invoice_id}/attachments"
-        
-        # Prepare headers
-        headers = {
-            "Authorization": api_key
-        }
+        url = f"customers/{customer_id}/invoices/{invoice_id}/attachments"
         
         # Modify filename if talent name provided
         filename = os.path.basename(filepath)
@@ -243,7 +262,7 @@ def upload_pdf_attachment(customer_id, invoice_id, filepath, talent_name=None, a
                 'file': (filename, file, 'application/pdf')
             }
             
-            response = requests.post(url, headers=headers, files=files, timeout=30)
+            response = tabs_client.post(url, api_key, files=files, timeout=30)
             
             if response.status_code in [200, 201]:
                 st.success(f"✅ Upload successful: {filename}")
@@ -256,110 +275,50 @@ def upload_pdf_attachment(customer_id, invoice_id, filepath, talent_name=None, a
         st.error(f"❌ Upload error: {str(e)}")
         return False
 
-def upload_csv_attachment(customer_id, invoice_id, csv_bytes, filename, api_key=None):
-    """Upload CSV attachment to invoice via API"""
+def fetch_all_invoices_for_cache(api_token, params=None):
+    """Fetch all invoices from API for caching purposes, as compact invoice records.
+    ``params`` narrows the fetch (e.g. to invoices updated since the last refresh).
+    """
     try:
-        if not api_key:
-            return False
-        
-        # Construct API URL
-        url = f"{API_URL_BASE}/{customer_id}/invoices/{invoice_id}/attachments"
-        
-        # Prepare headers
-        headers = {
-            "Authorization": api_key
-        }
-        
-        # Upload CSV bytes
-        files = {
-            'file': (filename, csv_bytes, 'text/csv')
-        }
-        
-        response = requests.post(url, headers=headers, files=files, timeout=30)
-        
-        if response.status_code in [200, 201]:
-            return True
+        if params:
+            st.info("🚀 Fetching new and updated invoices...")
         else:
-            return False
-                
-    except Exception as e:
-        return False
-
-def fetch_all_invoices_for_cache(api_token):
-    """Fetch all invoices from API for caching purposes"""
-    try:
-        api_base_url = "https://integrators.prod.api.tabsplatform.com/v3"
-        headers = {
-            'Authorization': api_token,
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
-        
-        url = f"{api_base_url}/invoices"
-        all_invoices = []
-        page = 1
-        limit = 1000
-        
-        st.info("🚀 Starting comprehensive invoice fetch...")
+            st.info("🚀 Starting comprehensive invoice fetch...")
         
         # Create progress tracking
         progress_bar = st.progress(0)
         status_text = st.empty()
         
-        while True:
-            params = {
-                'limit': limit,
-                'page': page
-            }
-            
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success') and 'payload' in data:
-                    page_invoices = data['payload'].get('data', [])
-                elif 'data' in data:
-                    page_invoices = data.get('data', [])
-                else:
-                    page_invoices = []
-                
-                if not page_invoices:
-                    break  # No more invoices
-                
-                all_invoices.extend(page_invoices)
-                
-                # Update progress
-                progress = min(page / 50, 1.0)  # Assume max 50 pages
-                progress_bar.progress(progress)
-                status_text.text(f"📄 Fetched {len(all_invoices)} invoices (page {page})...")
-                
-                # Check pagination metadata
-                total_pages = data.get('totalPages') or data.get('payload', {}).get('totalPages')
-                current_page = data.get('currentPage') or data.get('payload', {}).get('currentPage')
-                
-                if total_pages and current_page:
-                    if current_page >= total_pages:
-                        break
-                elif len(page_invoices) < limit:
-                    break
-                
-                page += 1
-                
-                # Safety check
-                if page > 100:  # Max 100,000 invoices
-                    st.warning("⚠️ Reached maximum page limit (100), stopping pagination")
-                    break
-            else:
-                st.error(f"API call failed with status {response.status_code}")
-                break
+        def _on_page(pages_done, total_pages, invoice_count):
+            progress_bar.progress(min(pages_done / total_pages, 1.0))
+            status_text.text(f"📄 Fetched {invoice_count} invoices ({pages_done}/{total_pages} pages)...")
+        
+        with get_run_metrics().stage("Fetch updated invoices" if params else "Fetch invoices") as stage:
+            result = fetch_all_invoices(api_token, params=params, on_page=_on_page)
+            stage.rows = len(result.items)
+        save_run_report()
         
         # Clear progress indicators
         progress_bar.empty()
         status_text.empty()
         
+        if result.truncated:
+            st.warning(f"⚠️ Reached maximum page limit ({INVOICE_MAX_PAGES}), stopping pagination")
+        for page, error in sorted(result.failed_pages.items()):
+            st.error(f"Page {page}: {error}")
+        if result.failed_pages:
+            # Saving a partial fetch would stamp it as complete, and later quick
+            # refreshes would never fetch the missing pages
+            st.error(f"❌ {len(result.failed_pages)} invoice pages could not be fetched; the cache was not changed. Please try again.")
+            return None
+        
+        all_invoices = result.items
         if all_invoices:
-            st.success(f"✅ Successfully fetched {len(all_invoices)} invoices across {page} pages")
-            return all_invoices
+            st.success(f"✅ Successfully fetched {len(all_invoices)} invoices across {result.pages_fetched} pages")
+            return invoices_to_records(all_invoices)
+        elif params and result.pages_fetched:
+            # An incremental fetch can legitimately find nothing new
+            return invoices_to_records([])
         else:
             st.error("❌ No invoices fetched")
             return None
@@ -370,159 +329,17 @@ def fetch_all_invoices_for_cache(api_token):
         st.code(traceback.format_exc())
         return None
 
-def find_invoice_by_date(customer_id, issue_date, api_token):
-    """Find invoice ID by customer_id and issue_date using API with caching"""
-    if not customer_id or str(customer_id).strip() == "":
-        return None
-    
-    if not api_token:
-        return None
-    
-    try:
-        # Try to use cached invoices first
-        cache_key = f"invoice_cache_{api_token[:10]}"
-        cached_invoices = st.session_state.get(cache_key, [])
-        
-        # If no cache in session state, try to load from persistent file
-        if not cached_invoices:
-            try:
-                import json
-                cache_file = os.path.join(_CACHE_DIR, f"invoice_cache_{api_token[:10]}.json")
-                if os.path.exists(cache_file):
-                    with open(cache_file, 'r') as f:
-                        cache_data = json.load(f)
-                        cached_invoices = cache_data.get('invoices', [])
-                        cache_timestamp_str = cache_data.get('timestamp')
-                        
-                        # Check TTL (1 hour = 3600 seconds)
-                        if cache_timestamp_str:
-                            try:
-                                if isinstance(cache_timestamp_str, (int, float)):
-                                    cache_time = cache_timestamp_str
-                                else:
-                                    cache_time = datetime.fromisoformat(cache_timestamp_str).timestamp()
-                                
-                                current_time = datetime.now().timestamp()
-                                age_seconds = current_time - cache_time
-                                
-                                if age_seconds < 3600:  # Less than 1 hour old
-                                    # Restore to session state
-                                    st.session_state[cache_key] = cached_invoices
-                                else:
-                                    # Cache expired - still use it but warn user might want to refresh
-                                    st.session_state[cache_key] = cached_invoices
-                            except Exception:
-                                # If timestamp parsing fails, use cache anyway
-                                st.session_state[cache_key] = cached_invoices
-                        else:
-                            # No timestamp, use cache anyway
-                            st.session_state[cache_key] = cached_invoices
-            except Exception:
-                pass
-        
-        if cached_invoices:
-            # Use cached data for fast lookup
-            invoices = cached_invoices
-            
-            # Filter invoices for this customer and date
-            valid_invoices = []
-            for invoice in invoices:
-                invoice_customer_id = invoice.get('customerId', '')
-                invoice_date_str = invoice.get('issueDate', '')
-                
-                # Check customer match and status
-                if (invoice_customer_id == customer_id and 
-                    invoice.get('status', '').upper() != 'DELETED' and 
-                    invoice.get('source', '').upper() == 'TABS'):
-                    
-                    # If we have a specific date, filter by date
-                    if issue_date and invoice_date_str:
-                        try:
-                            if 'T' in invoice_date_str:
-                                invoice_date = pd.to_datetime(invoice_date_str).date()
-                            else:
-                                invoice_date = pd.to_datetime(invoice_date_str).date()
-                            
-                            if invoice_date == issue_date:
-                                valid_invoices.append(invoice)
-                        except:
-                            # If date parsing fails, include the invoice anyway
-                            valid_invoices.append(invoice)
-                    else:
-                        # No specific date, include all valid invoices
-                        valid_invoices.append(invoice)
-            
-            if valid_invoices:
-                # Sort by issue date (most recent first) and return the first one
-                valid_invoices.sort(key=lambda x: x.get('issueDate', ''), reverse=True)
-                selected_invoice = valid_invoices[0]
-                invoice_id = selected_invoice.get('id')
-                return invoice_id
-            else:
-                # Cache exists but no matching invoices found
-                return None
-        
-        # If no cached data at all, try to fetch and cache
-        all_invoices = fetch_all_invoices_for_cache(api_token)
-        
-        if all_invoices:
-            # Cache the results for future use
-            st.session_state[cache_key] = all_invoices
-            
-            # Also save to persistent cache file
-            try:
-                import json
-                _ensure_cache_dir_exists()
-                cache_file = os.path.join(_CACHE_DIR, f"invoice_cache_{api_token[:10]}.json")
-                cache_data = {
-                    'invoices': all_invoices,
-                    'timestamp': datetime.now().isoformat(),
-                    'count': len(all_invoices)
-                }
-                with open(cache_file, 'w') as f:
-                    json.dump(cache_data, f)
-            except Exception:
-                pass
-            
-            # Now filter the freshly fetched invoices
-            invoices = all_invoices
-            valid_invoices = []
-            for invoice in invoices:
-                invoice_customer_id = invoice.get('customerId', '')
-                invoice_date_str = invoice.get('issueDate', '')
-                
-                if (invoice_customer_id == customer_id and 
-                    invoice.get('status', '').upper() != 'DELETED' and 
-                    invoice.get('source', '').upper() == 'TABS'):
-                    
-                    if issue_date and invoice_date_str:
-                        try:
-                            if 'T' in invoice_date_str:
-                                invoice_date = pd.to_datetime(invoice_date_str).date()
-                            else:
-                                invoice_date = pd.to_datetime(invoice_date_str).date()
-                            
-                            if invoice_date == issue_date:
-                                valid_invoices.append(invoice)
-                        except:
-                            valid_invoices.append(invoice)
-                    else:
-                        valid_invoices.append(invoice)
-            
-            if valid_invoices:
-                valid_invoices.sort(key=lambda x: x.get('issueDate', ''), reverse=True)
-                selected_invoice = valid_invoices[0]
-                invoice_id = selected_invoice.get('id')
-                return invoice_id
-        
-        # If no cached data or no match found, return None
-        return None
-        
-    except Exception as e:
-        return None
+def get_invoice_cache(api_key) -> InvoiceCache:
+    """This session's invoice cache for ``api_key`` and the current API base
+    URL, backed by its cache file."""
+    cache_key = f"invoice_cache_{api_key[:10]}"
+    cache_path = invoice_cache_path(tabs_client.scoped_cache_dir(_CACHE_DIR), api_key)
+    cache = st.session_state.get(cache_key)
+    if not isinstance(cache, InvoiceCache) or cache.path != cache_path:
+        cache = InvoiceCache(cache_path)
+        st.session_state[cache_key] = cache
+    return cache
 
-if "ns_to_tabs_cache" not in st.session_state:
-    st.session_state["ns_to_tabs_cache"] = {}
 if "uploaded_files" not in st.session_state:
     st.session_state["uploaded_files"] = {}
 if "generated_files" not in st.session_state:
@@ -532,8 +349,10 @@ if "generated_files" not in st.session_state:
 
 # -------- Persistent cache helpers (avoid re-calling API across sessions) --------
 # We persist the NetSuite→Tabs ID cache to disk and hydrate it at startup.
+# Caches of API data are kept per API base URL (see tabs_client.scoped_cache_dir).
 _CACHE_DIR = os.path.join(OUTPUT_DIR, "_session")
-_NS_CACHE_FILE = os.path.join(_CACHE_DIR, "ns_to_tabs_cache.json")
+_NS_CACHE_NAME = "ns_to_tabs_cache.json"
+_UPLOAD_JOURNAL_NAME = "upload_journal.jsonl"
 # Try repo root first (for deployment), then fall back to cache dir
 _CLIENT_MAPPINGS_FILE_REPO = os.path.join(os.path.dirname(__file__), "client_mappings.json")
 _CLIENT_MAPPINGS_FILE = os.path.join(_CACHE_DIR, "client_mappings.json")
@@ -544,70 +363,30 @@ def _ensure_cache_dir_exists() -> None:
     except Exception:
         pass
 
-def _load_ns_cache_from_disk() -> dict:
-    try:
-        if os.path.exists(_NS_CACHE_FILE):
-            import json
-            with open(_NS_CACHE_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    return {str(k): str(v) for k, v in data.items()}
-    except Exception:
-        pass
-    return {}
-
-def _save_ns_cache_to_disk(cache: dict) -> None:
-    try:
-        _ensure_cache_dir_exists()
-        import json
-        with open(_NS_CACHE_FILE, "w", encoding="utf-8") as f:
-            json.dump(cache, f, ensure_ascii=False)
-    except Exception:
-        pass
-
 def _load_client_mappings_from_disk() -> dict:
     """Load client mappings (parent_to_id, acct_to_tabs_id, etc.) from disk
     Tries repo root first (for deployment), then cache directory
     """
-    import json
     # Try repo root first (for Streamlit Cloud deployment)
     for file_path in [_CLIENT_MAPPINGS_FILE_REPO, _CLIENT_MAPPINGS_FILE]:
-        try:
-            if os.path.exists(file_path):
-                with open(file_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    if isinstance(data, dict):
-                        return {
-                            "parent_to_id": {str(k): str(v) for k, v in data.get("parent_to_id", {}).items()},
-                            "acct_to_tabs_id": {str(k): str(v) for k, v in data.get("acct_to_tabs_id", {}).items()},
-                            "acct_to_ns_id": {str(k): str(v) for k, v in data.get("acct_to_ns_id", {}).items()},
-                            "acct_to_income_evt": {str(k): str(v) for k, v in data.get("acct_to_income_evt", {}).items()},
-                            "acct_to_lbpa_evt": {str(k): str(v) for k, v in data.get("acct_to_lbpa_evt", {}).items()},
-                            "acct_to_diff_name": {str(k): str(v) for k, v in data.get("acct_to_diff_name", {}).items()},
-                            "acct_to_base_name": {str(k): str(v) for k, v in data.get("acct_to_base_name", {}).items()},
-                        }
-        except Exception:
-            continue
+        mappings = load_mappings_file(file_path)
+        if mappings:
+            return mappings
     return {}
 
 def _save_client_mappings_to_disk(mappings: dict) -> None:
     """Save client mappings to disk"""
     try:
         _ensure_cache_dir_exists()
-        import json
         with open(_CLIENT_MAPPINGS_FILE, "w", encoding="utf-8") as f:
             json.dump(mappings, f, ensure_ascii=False)
     except Exception:
         pass
 
-# Hydrate session cache from disk once
-try:
-    disk_cache = _load_ns_cache_from_disk()
-    if disk_cache:
-        # Merge; keep existing session entries, add new ones from disk
-        st.session_state["ns_to_tabs_cache"] = {**disk_cache, **st.session_state.get("ns_to_tabs_cache", {})}
-except Exception:
-    pass
+# Hydrate the session's NetSuite ID cache from disk once (again when the API base URL changes)
+_ns_cache_file = os.path.join(tabs_client.scoped_cache_dir(_CACHE_DIR), _NS_CACHE_NAME)
+if getattr(st.session_state.get("ns_to_tabs_cache"), "path", None) != _ns_cache_file:
+    st.session_state["ns_to_tabs_cache"] = NsIdCache.load(_ns_cache_file)
 
 
 def get_api_key() -> str:
@@ -617,8 +396,6 @@ def get_api_key() -> str:
             return ui_key
     return API_KEY
 
-_DEF_SESSION_DIR = os.path.join(OUTPUT_DIR, "_session")
-
 def persist_upload(uploaded_file, key: str) -> None:
     """Store uploaded CSV content in memory (session_state) instead of disk.
     Saves bytes and a content hash for change detection, plus original filename.
@@ -651,6 +428,13 @@ def persist_upload(uploaded_file, key: str) -> None:
         except Exception:
             pass
 
+def read_upload(upload: dict, reader=read_transactions, **kwargs) -> pd.DataFrame:
+    """Parsed frame of stored CSV bytes (an ``uploaded_files``/``generated_files``
+    entry), parsed once per content and reader across reruns and call sites.
+    The frame is shared through the cache: do not modify it in place.
+    """
+    return frame_cache.read(upload["bytes"], reader, data_hash=upload.get("hash"), **kwargs)
+
 # Load client mappings from disk at startup
 try:
     if "client_mappings_loaded" not in st.session_state:
@@ -665,969 +449,111 @@ except Exception:
     st.session_state["client_mappings"] = {}
     st.session_state["client_mappings_loaded"] = True
 
-# ---------- header helpers ----------
-_def_norm_regex = re.compile(r"[^a-z0-9]")
-
-def normalize_name(name: str) -> str:
-    return _def_norm_regex.sub("", str(name).strip().lower())
-
-def find_column(df: pd.DataFrame, candidates: list[str]) -> str | None:
-    normalized_to_original = {normalize_name(c): c for c in df.columns}
-    for cand in candidates:
-        n = normalize_name(cand)
-        if n in normalized_to_original:
-            return normalized_to_original[n]
-    return None
-# ------------------------------------
-
-
 def resolve_tabs_id_from_ns(ns_external_id: str) -> str | None:
-    ns_external_id = str(ns_external_id or "").strip()
-    ns_external_id = ns_external_id.replace(".0", "")
-    print(ns_external_id)
-    if not ns_external_id:
-        return None
-    cache = st.session_state.get("ns_to_tabs_cache", {})
-    if ns_external_id in cache:
-        return cache[ns_external_id]
-    params_candidates = [
-        {"externalId": ns_external_id, "limit": 1},
-    ]
-    api_key = get_api_key()
-    headers = {"Authorization": f"{api_key}"}
-    for params in params_candidates:
-        try:
-            url = f'{API_URL_BASE}?filter=externalIds.externalId:eq:"{ns_external_id}"'
-            print(f"\nMaking request to: {url}")
-            print(f"Headers: {headers}")
-            try:
-                # Disable SSL verification - Note: In production, proper cert verification should be used
-                res = requests.get(url, headers=headers, timeout=10, verify=False)
-                # Suppress only the specific InsecureRequestWarning
-                import urllib3
-                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-                
-                # print(f"Response Status Code: {res.status_code}")
-                # print(f"Response Headers: {dict(res.headers)}")
-                # try:
-                #     print(f"Response Content: {res.json()}")
-                # except:
-                #     print(f"Raw Response Content: {res.text}")
-                if res.status_code >= 400:
-                    print(f"Error: Request failed with status code {res.status_code}")
-            except requests.exceptions.Timeout:
-                print("Error: Request timed out after 10 seconds")
-            except requests.exceptions.ConnectionError as e:
-                print(f"Error: Connection failed - {str(e)}")
-            except Exception as e:
-                print(f"Error: Unexpected error - {str(e)}")
-            if res.status_code >= 400:
-                continue
-            data = res.json() if res.headers.get("content-type", "").startswith("application/json") else None
-            if not data:
-                continue
-            items = (
-                data.get("payload", {}).get("data")
-                or data.get("data")
-                or data.get("items")
-                or []
-            )
-            if not items:
-                continue
-            # Prefer exact match on externalIds array (type NETSUITE and id equals)
-            for cust in items:
-                match = False
-                ext_list = cust.get("externalIds") or cust.get("external_ids") or []
-                for ext in ext_list or []:
-                    ext_id = str(ext.get("id") or "").strip()
-                    if ext_id == ns_external_id:
-                        match = True
-                        break
-                if match:
-                    tabs_id = str(cust.get("id") or "").strip()
-                    if tabs_id:
-                        cache[ns_external_id] = tabs_id
-                        st.session_state["ns_to_tabs_cache"] = cache
-                        # Persist to disk
-                        _save_ns_cache_to_disk(cache)
-                        return tabs_id
-            # Fallback: first item when search hits
-            cust = items[0]
-            tabs_id = str(cust.get("id") or "").strip()
-            if tabs_id:
-                cache[ns_external_id] = tabs_id
-                st.session_state["ns_to_tabs_cache"] = cache
-                # Persist to disk
-                _save_ns_cache_to_disk(cache)
-                return tabs_id
-        except Exception:
-            continue
-    return None
+    return resolve_tabs_id(ns_external_id, get_api_key(), st.session_state["ns_to_tabs_cache"])
 
-
-def detect_header_row(uploaded_clients):
-    """Return a DataFrame for the mapping CSV, auto-detecting the header row.
-    Looks for the first line that contains Acct#/AccountID and NetSuite/External ID.
-    Works with CSVs that have banner/title rows above the real headers.
+def resolve_tabs_ids_from_ns(ns_external_ids) -> dict[str, str]:
+    """Bulk-resolve NetSuite IDs with the session cache, persisting it once.
+    Returns {NS ID as given: Tabs ID} for the IDs that resolved.
     """
-    from io import StringIO
-    raw = b""
-    if hasattr(uploaded_clients, "read"):
-        raw = uploaded_clients.read()
-    elif isinstance(uploaded_clients, bytes):
-        raw = uploaded_clients
-    elif isinstance(uploaded_clients, (str, os.PathLike)):
-        with open(uploaded_clients, "rb") as f:
-            raw = f.read()
-    else:
-        raw = b""
-    text = raw.decode("utf-8-sig", errors="ignore")
-    # Split and find header index
-    lines = [l for l in text.splitlines() if l is not None]
-    header_idx = None
-    for i, l in enumerate(lines[:500]):
-        ll = l.lower()
-        if ("acct#" in ll or "acct #" in ll or "accountid" in ll or "account id" in ll or "account number" in ll or "accountnumber" in ll or "acctno" in ll or "acct no" in ll) and ("netsuite" in ll or "external id" in ll):
-            header_idx = i
-            break
-    if header_idx is None:
-        # Fallback to first non-empty line
-        header_idx = 0
-    # Let pandas parse from the detected header row with automatic delimiter detection
-    df_clients = pd.read_csv(StringIO(text), header=header_idx)
-    # Clean column names and values
-    df_clients.columns = [re.sub(r"\s+", " ", str(c)).strip().strip('"').strip("'") for c in df_clients.columns]
-    df_clients = df_clients.apply(lambda x: x.astype(str).str.strip())
-    return df_clients
+    return resolve_tabs_ids(ns_external_ids, get_api_key(), st.session_state["ns_to_tabs_cache"])
 
-def extract_mappings_from_clients(uploaded_clients):
-    """Extract mappings from clients CSV file"""
-    df_clients = detect_header_row(uploaded_clients)
 
-    name_col = find_column(df_clients, ["name", "customer", "customername"]) 
-    acc_name_col = find_column(df_clients, ["account name", "accountname"]) 
-    name_with_prefix_col = find_column(df_clients, ["namewithprefix", "name with prefix"])
-    id_col = find_column(df_clients, ["id", "tabs id", "tabs_customer_id", "tabscustomerid", "customerid", "customer id"])
-    acctnum_col = find_column(df_clients, ["acct#", "acct #", "acctno", "acct no", "acct", "accountid", "account id", "accountnumber", "account number", "acctnum"]) 
-    netsuite_id_col = find_column(df_clients, ["netsuite", "netsuite id", "netsuiteid", "ns id", "external id", "netsuite internal id"]) 
-    diff_name_col = find_column(df_clients, ["account name", "name with prefix", "subsidiary", "subsidiary name"]) 
-    rev_type_col = find_column(df_clients, ["rev. type", "rev type", "revenue type", "rev"]) 
-    billing_type_col = find_column(df_clients, ["billing type", "billing", "bill type"]) 
-    
-    parent_to_id_raw: dict[str, str] = {}
-    acct_to_tabs_id: dict[str, str] = {}
-    acct_to_ns_id: dict[str, str] = {}
-    acct_to_income_evt: dict[str, str] = {}
-    acct_to_lbpa_evt: dict[str, str] = {}
-    acct_to_diff_name: dict[str, str] = {}
-    acct_to_base_name: dict[str, str] = {}
-    
-    base_names_series = df_clients[name_col] if name_col else pd.Series([], dtype=str)
-    base_name_counts = Counter(str(x).strip() for x in base_names_series) if not base_names_series.empty else {}
-    
-    for _, r in df_clients.iterrows():
-        tabs_id_val = str(r[id_col]).strip() if id_col else ""
-        if name_col and tabs_id_val:
-            parent_to_id_raw[str(r[name_col]).strip()] = tabs_id_val
-            if name_with_prefix_col:
-                alias = str(r[name_with_prefix_col]).strip()
-                if alias:
-                    parent_to_id_raw[alias] = tabs_id_val
-        if acctnum_col and tabs_id_val:
-            acct_key = re.sub(r"[^0-9]", "", str(r[acctnum_col]))
-            if acct_key:
-                acct_to_tabs_id[acct_key] = tabs_id_val
-        if acctnum_col and netsuite_id_col:
-            ns_val = str(r[netsuite_id_col]).strip()
-            acct_key = re.sub(r"[^0-9]", "", str(r[acctnum_col]))
-            if acct_key and ns_val:
-                acct_to_ns_id[acct_key] = ns_val
-        if acctnum_col and (name_col or acc_name_col):
-            acct_key = re.sub(r"[^0-9]", "", str(r[acctnum_col]))
-            base_name = str(r[name_col]).strip() if name_col else str(r[acc_name_col]).strip()
-            if acct_key and base_name:
-                acct_to_base_name[acct_key] = base_name
-        if acctnum_col and diff_name_col:
-            acct_key = re.sub(r"[^0-9]", "", str(r[acctnum_col]))
-            dval = str(r[diff_name_col]).strip()
-            base_name = str(r[name_col]).strip() if name_col else ""
-            if acct_key and dval and base_name:
-                if base_name_counts.get(base_name, 0) > 1 and normalize_name(dval) != normalize_name(base_name):
-                    acct_to_diff_name[acct_key] = f"{base_name} - {dval}"
-        if acctnum_col and (rev_type_col or billing_type_col):
-            acct_key = re.sub(r"[^0-9]", "", str(r[acctnum_col]))
-            rev_val = str(r[rev_type_col]).strip().lower() if rev_type_col else ""
-            bill_val = str(r[billing_type_col]).strip().lower() if billing_type_col else ""
-            evt = "Units" if "unit" in bill_val else ("Per Application" if bill_val else None)
-            if acct_key and evt:
-                if "income" in rev_val:
-                    acct_to_income_evt[acct_key] = evt
-                if "lbpa" in rev_val or "l b p a" in rev_val or "loanbeam per application" in rev_val:
-                    acct_to_lbpa_evt[acct_key] = evt
-    
-    parent_to_id = {normalize_name(k): v for k, v in parent_to_id_raw.items()}
-    
-    return {
-        "parent_to_id": parent_to_id,
-        "acct_to_tabs_id": acct_to_tabs_id,
-        "acct_to_ns_id": acct_to_ns_id,
-        "acct_to_income_evt": acct_to_income_evt,
-        "acct_to_lbpa_evt": acct_to_lbpa_evt,
-        "acct_to_diff_name": acct_to_diff_name,
-        "acct_to_base_name": acct_to_base_name,
-    }
+def get_run_metrics() -> RunMetrics:
+    """This session's run metrics; each Usage CSV generation starts a new run."""
+    if not isinstance(st.session_state.get("run_metrics"), RunMetrics):
+        st.session_state["run_metrics"] = RunMetrics("app")
+    return st.session_state["run_metrics"]
+
+def save_run_report() -> None:
+    """Write the session's run report to ``run_metrics.REPORT_DIR``."""
+    try:
+        get_run_metrics().save()
+    except OSError:
+        pass
 
-def transform_usage(uploaded_income, uploaded_lbpa, uploaded_clients=None, resolve_now: bool = False, usage_date=None, mappings=None):
+def transform_usage(uploaded_income, uploaded_lbpa, uploaded_clients=None, resolve_now: bool = False, usage_date=None, mappings=None, chunksize=None):
+    """Run ``build_usage`` for the app: mappings default to the clients file or
+    the saved mappings, and the generated files and raw rows are stored in the
+    session for the download buttons and the Invoice Attachment tab.
+    """
     # Load mappings: use provided mappings, or extract from clients file, or load from disk
-    if mappings:
-        # Use provided mappings
-        parent_to_id = mappings.get("parent_to_id", {})
-        acct_to_tabs_id = mappings.get("acct_to_tabs_id", {})
-        acct_to_ns_id = mappings.get("acct_to_ns_id", {})
-        acct_to_income_evt = mappings.get("acct_to_income_evt", {})
-        acct_to_lbpa_evt = mappings.get("acct_to_lbpa_evt", {})
-        acct_to_diff_name = mappings.get("acct_to_diff_name", {})
-        acct_to_base_name = mappings.get("acct_to_base_name", {})
-    elif uploaded_clients:
-        # Extract mappings from clients file
+    if not mappings and uploaded_clients:
         mappings = extract_mappings_from_clients(uploaded_clients)
         # Save to disk for future use
         _save_client_mappings_to_disk(mappings)
-        parent_to_id = mappings.get("parent_to_id", {})
-        acct_to_tabs_id = mappings.get("acct_to_tabs_id", {})
-        acct_to_ns_id = mappings.get("acct_to_ns_id", {})
-        acct_to_income_evt = mappings.get("acct_to_income_evt", {})
-        acct_to_lbpa_evt = mappings.get("acct_to_lbpa_evt", {})
-        acct_to_diff_name = mappings.get("acct_to_diff_name", {})
-        acct_to_base_name = mappings.get("acct_to_base_name", {})
-    else:
-        # Try to load from disk
+    elif not mappings:
         mappings = _load_client_mappings_from_disk()
-        if mappings:
-            parent_to_id = mappings.get("parent_to_id", {})
-            acct_to_tabs_id = mappings.get("acct_to_tabs_id", {})
-            acct_to_ns_id = mappings.get("acct_to_ns_id", {})
-            acct_to_income_evt = mappings.get("acct_to_income_evt", {})
-            acct_to_lbpa_evt = mappings.get("acct_to_lbpa_evt", {})
-            acct_to_diff_name = mappings.get("acct_to_diff_name", {})
-            acct_to_base_name = mappings.get("acct_to_base_name", {})
-        else:
-            # No mappings available - use empty dicts
-            parent_to_id = {}
-            acct_to_tabs_id = {}
-            acct_to_ns_id = {}
-            acct_to_income_evt = {}
-            acct_to_lbpa_evt = {}
-            acct_to_diff_name = {}
-            acct_to_base_name = {}
+        if not mappings:
             try:
                 st.warning("No client mappings found. Proceeding without customer_id mapping.")
             except Exception:
                 pass
 
-    def process_usage(df: pd.DataFrame, event_type_name: str, qty_col_candidates: list[str]):
-        df.columns = df.columns.str.strip()
-        parent_col = find_column(df, ["customername", "accountname", "name"])
-        acct_id_col = find_column(df, ["accountid", "acct#", "acct", "account number", "accountnumber"]) 
-        datetime_col = find_column(df, ["submissiondate", "date", "createdon", "datetime"])
-        qty_col = find_column(df, qty_col_candidates)
-        if not parent_col:
-            raise KeyError("Customer/Account name column missing")
-        if not datetime_col:
-            df["__datetime_fallback__"] = pd.Timestamp.today().normalize()
-            datetime_col = "__datetime_fallback__"
-        if not qty_col:
-            raise KeyError("Quantity column not found")
-
-        # Preserve original AccountName column from Income file BEFORE overwriting
-        # This is the AccountName column that contains actual account names
-        if "AccountName" in df.columns:
-            # Preserve the AccountName column BEFORE we overwrite it
-            df["__original_account_name__"] = df["AccountName"].copy()
-        else:
-            df["__original_account_name__"] = ""
-        
-        # Now set AccountName from parent_col (CustomerName)
-        # Check if parent_col column is all NaN and try fallback to AccountName column if it exists
-        if df[parent_col].isna().all() and "AccountName" in df.columns:
-            # If CustomerName was all NaN, try using AccountName column directly
-            account_name_col = find_column(df, ["accountname"])
-            if account_name_col and not df[account_name_col].isna().all():
-                df["AccountName"] = df[account_name_col]
-            else:
-                df["AccountName"] = df[parent_col]
-        else:
-            df["AccountName"] = df[parent_col]
-        
-        df["value"] = pd.to_numeric(df[qty_col], errors="coerce").fillna(0)
-        # Always compute account id key if present
-        if acct_id_col:
-            df["__acct_key__"] = df[acct_id_col].astype(str).str.replace(r"[^0-9]", "", regex=True)
-        else:
-            df["__acct_key__"] = ""
-        # Prefer mapping by AccountID if available
-        if acct_id_col and acct_to_tabs_id:
-            df["customer_id"] = df["__acct_key__"].map(acct_to_tabs_id)
-        else:
-            df["__join_key__"] = df["AccountName"].astype(str).str.lower().str.replace(r"[^a-z0-9]", "", regex=True)
-            df["customer_id"] = df["__join_key__"].map(parent_to_id)
-        # Do NOT call APIs in the Usage tab; leave customer_id blank if only NetSuite ID exists.
-        # IMPORTANT: Do not group by customer_id (it may be NaN and would drop all rows).
-        group_keys = ["AccountName", "__acct_key__"]
-        agg_dict = {"value": "sum", datetime_col: "max"}
-        # Preserve original account name if it exists
-        if "__original_account_name__" in df.columns:
-            agg_dict["__original_account_name__"] = "first"
-        grouped = (
-            df.groupby(group_keys, as_index=False)
-              .agg(agg_dict)
-        )
-        # Map customer_id after grouping when available from mapping (name or acct)
-        grouped["__join_key__"] = grouped["AccountName"].astype(str).str.lower().str.replace(r"[^a-z0-9]", "", regex=True)
-        name_mapped = grouped["__join_key__"].map(parent_to_id) if 'parent_to_id' in locals() or 'parent_to_id' in globals() else None
-        acct_mapped = grouped["__acct_key__"].map(acct_to_tabs_id) if 'acct_to_tabs_id' in locals() else None
-        if acct_mapped is not None:
-            grouped["customer_id"] = acct_mapped
-        if name_mapped is not None:
-            grouped["customer_id"] = grouped.get("customer_id").fillna(name_mapped) if "customer_id" in grouped.columns else name_mapped
-
-        grouped["event_type_name"] = event_type_name
-        # Differentiator: will be set later for Finastra only
-        grouped["differentiator"] = ""
-        grouped.rename(columns={datetime_col: "datetime"}, inplace=True)
-        # Use usage_date if provided, otherwise use the datetime from the file
-        if usage_date is not None:
-            # Format the usage_date as YYYY-MM-DD
-            grouped["datetime"] = pd.to_datetime(usage_date).strftime("%Y-%m-%d")
-        else:
-            grouped["datetime"] = pd.to_datetime(grouped["datetime"], errors="coerce").dt.strftime("%Y-%m-%d")
-        grouped["account_id"] = grouped["__acct_key__"]
-        # Include __original_account_name__ in return if it exists
-        return_cols = ["customer_id", "AccountName", "event_type_name", "datetime", "value", "differentiator", "account_id"]
-        if "__original_account_name__" in grouped.columns:
-            return_cols.append("__original_account_name__")
-        return grouped[return_cols]
-
-    income_df = pd.read_csv(uploaded_income)
-    lbpa_df = pd.read_csv(uploaded_lbpa)
-    
-    # Debug: Track Income and LBPA rows before processing
-    income_initial_count = len(income_df)
-    lbpa_initial_count = len(lbpa_df)
-
-    income_upload = process_usage(income_df, "Per Application",
-                                  ["isinitialsubmission", "perapplication", "applicationcount"])
-    income_upload["ApplicationTypeName"] = "Income"
-    # Apply optional event type overrides from mapping (by account_id)
-    if acct_to_income_evt:
-        income_upload["event_type_name"] = income_upload["account_id"].map(acct_to_income_evt).fillna(income_upload["event_type_name"])
-
-    lbpa_upload = process_usage(lbpa_df, "Units",
-                                ["unitsaspersubmission", "units", "unitcount"])
-    lbpa_upload["ApplicationTypeName"] = "LBPA"
-    
-    if acct_to_lbpa_evt:
-        lbpa_upload["event_type_name"] = lbpa_upload["account_id"].map(acct_to_lbpa_evt).fillna(lbpa_upload["event_type_name"])
-
-    # Final combined usage (internal dataframe with account_id)
-    combined_internal = pd.concat([income_upload, lbpa_upload], ignore_index=True)
-    
-
-    # Map event_type_name based on ApplicationTypeName
-    # Income: "Per Application" -> "app", "Units" -> "unit"
-    # LBPA: "Per Application" -> "LBPA app", "Units" -> "LBPA unit"
-    income_mask = combined_internal["ApplicationTypeName"] == "Income"
-    lbpa_mask = combined_internal["ApplicationTypeName"] == "LBPA"
-    
-    # Income mapping
-    combined_internal.loc[income_mask & (combined_internal["event_type_name"] == "Per Application"), "event_type_name"] = "app"
-    combined_internal.loc[income_mask & (combined_internal["event_type_name"] == "Units"), "event_type_name"] = "unit"
-    
-    # LBPA mapping
-    combined_internal.loc[lbpa_mask & (combined_internal["event_type_name"] == "Per Application"), "event_type_name"] = "LBPA app"
-    combined_internal.loc[lbpa_mask & (combined_internal["event_type_name"] == "Units"), "event_type_name"] = "LBPA unit"
-
-    # Map event_type_name based on ApplicationTypeName
-    # Income: "Per Application" -> "app", "Units" -> "unit"
-    # LBPA: "Per Application" -> "LBPA app", "Units" -> "LBPA unit"
-    income_mask = combined_internal["ApplicationTypeName"] == "Income"
-    lbpa_mask = combined_internal["ApplicationTypeName"] == "LBPA"
-    
-    # Income mapping
-    combined_internal.loc[income_mask & (combined_internal["event_type_name"] == "Per Application"), "event_type_name"] = "app"
-    combined_internal.loc[income_mask & (combined_internal["event_type_name"] == "Units"), "event_type_name"] = "unit"
-    
-    # LBPA mapping
-    combined_internal.loc[lbpa_mask & (combined_internal["event_type_name"] == "Per Application"), "event_type_name"] = "LBPA app"
-    combined_internal.loc[lbpa_mask & (combined_internal["event_type_name"] == "Units"), "event_type_name"] = "LBPA unit"
-
-    # Optional: resolve Tabs IDs now using NetSuite external IDs via API
-    if resolve_now and get_api_key():
-        # Build acct -> NS map from clients file
-        # Reuse acct_to_ns_id built earlier in this function
-        missing_mask = combined_internal["customer_id"].isna() | (combined_internal["customer_id"].astype(str).str.strip() == "")
-        if missing_mask.any():
-            acct_keys = combined_internal.loc[missing_mask, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            ns_series = acct_keys.map(acct_to_ns_id)
-            unique_ns = sorted(x for x in ns_series.dropna().unique().tolist() if str(x).strip())
-            ns_to_tabs: dict[str, str] = {}
-            for ns in unique_ns:
-                tabs_id = resolve_tabs_id_from_ns(ns)
-                if tabs_id:
-                    ns_to_tabs[str(ns)] = tabs_id
-            if ns_to_tabs:
-                combined_internal.loc[missing_mask, "customer_id"] = ns_series.map(ns_to_tabs)
-    
-    # Optional: resolve Tabs IDs now using NetSuite external IDs via API
-    if resolve_now and get_api_key():
-        # Build acct -> NS map from clients file
-        # Reuse acct_to_ns_id built earlier in this function
-        missing_mask = combined_internal["customer_id"].isna() | (combined_internal["customer_id"].astype(str).str.strip() == "")
-        if missing_mask.any():
-            acct_keys = combined_internal.loc[missing_mask, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            ns_series = acct_keys.map(acct_to_ns_id)
-            unique_ns = sorted(x for x in ns_series.dropna().unique().tolist() if str(x).strip())
-            ns_to_tabs: dict[str, str] = {}
-            for ns in unique_ns:
-                tabs_id = resolve_tabs_id_from_ns(ns)
-                if tabs_id:
-                    ns_to_tabs[str(ns)] = tabs_id
-            if ns_to_tabs:
-                combined_internal.loc[missing_mask, "customer_id"] = ns_series.map(ns_to_tabs)
-    
-    # Ensure customer_id is populated and string type AFTER resolution
-    combined_internal["customer_id"] = combined_internal["customer_id"].astype(str)
-    valid_customer_mask = (
-        (combined_internal["customer_id"] != "nan") &
-        (combined_internal["customer_id"] != "None") &
-        (combined_internal["customer_id"].str.strip() != "")
-    )
-    
-    # NOW calculate sums AFTER customer_id resolution
-    # Sum UnitsAsPerSubmission and IsInitialSubmission directly from Income and LBPA files per customer_id
-    # Use the account_id to customer_id mapping from combined_internal to map back to Income and LBPA files
-    
-    # Create a mapping from account_id to customer_id from combined_internal
-    account_to_customer_mapping = {}
-    if "account_id" in combined_internal.columns and "customer_id" in combined_internal.columns:
-        valid_mapping_mask = (
-            combined_internal["customer_id"].notna() &
-            (combined_internal["customer_id"].astype(str).str.strip() != "") &
-            (combined_internal["customer_id"].astype(str).str.strip().str.lower() != "nan") &
-            combined_internal["account_id"].notna()
-        )
-        mapping_df = combined_internal[valid_mapping_mask][["account_id", "customer_id"]].drop_duplicates()
-        account_to_customer_mapping = dict(zip(
-            mapping_df["account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True),
-            mapping_df["customer_id"].astype(str)
-        ))
-    
-    # Map customer_id to Income and LBPA files using account_id
-    income_df_with_customer = income_df.copy()
-    lbpa_df_with_customer = lbpa_df.copy()
-    
-    # Map customer_id to Income file using account_id from combined_internal mapping
-    if "AccountID" in income_df_with_customer.columns:
-        income_account_ids = income_df_with_customer["AccountID"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-        if account_to_customer_mapping:
-            income_df_with_customer["customer_id"] = income_account_ids.map(account_to_customer_mapping)
-        else:
-            # Fallback: try using acct_to_tabs_id if available
-            if acct_to_tabs_id:
-                income_df_with_customer["customer_id"] = income_account_ids.map(acct_to_tabs_id)
-            else:
-                income_df_with_customer["customer_id"] = None
-    
-    # Map customer_id to LBPA file using account_id from combined_internal mapping
-    if "AccountID" in lbpa_df_with_customer.columns:
-        lbpa_account_ids = lbpa_df_with_customer["AccountID"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-        if account_to_customer_mapping:
-            lbpa_df_with_customer["customer_id"] = lbpa_account_ids.map(account_to_customer_mapping)
+    resolve_ns = resolve_tabs_ids_from_ns if resolve_now and get_api_key() else None
+    metrics = st.session_state["run_metrics"] = RunMetrics("app")
+    result = build_usage(uploaded_income, uploaded_lbpa, mappings, usage_date=usage_date,
+                         chunksize=chunksize, resolve_ns=resolve_ns, metrics=metrics)
+    save_run_report()
+
+    # Store in session_state for later tabs/downloads; the unmapped and missing
+    # customer_id files are only offered when they have rows
+    generated_files = st.session_state["generated_files"]
+    generated_files.pop("usage_unmapped", None)
+    generated_files.pop("usage_missing_customer_id", None)
+    generated_files.update(output_files(result))
+    for prefix, rows in (("unmapped", result.unmapped), ("missing_customer_id", result.missing_customer_id)):
+        st.session_state[f"{prefix}_count"] = len(rows)
+        if len(rows) > 0:
+            # Stored for preview
+            st.session_state[f"{prefix}_preview_df"] = rows.copy()
         else:
-            # Fallback: try using acct_to_tabs_id if available
-            if acct_to_tabs_id:
-                lbpa_df_with_customer["customer_id"] = lbpa_account_ids.map(acct_to_tabs_id)
-            else:
-                lbpa_df_with_customer["customer_id"] = None
-    
-    # If customer_id still missing, try mapping by customer name using parent_to_id
-    if "CustomerName" in income_df_with_customer.columns:
-        if "customer_id" not in income_df_with_customer.columns or income_df_with_customer["customer_id"].isna().any():
-            income_df_with_customer["__join_key__"] = income_df_with_customer["CustomerName"].astype(str).str.lower().str.replace(r"[^a-z0-9]", "", regex=True)
-            name_mapped = income_df_with_customer["__join_key__"].map(parent_to_id)
-            if "customer_id" not in income_df_with_customer.columns:
-                income_df_with_customer["customer_id"] = name_mapped
-            else:
-                income_df_with_customer["customer_id"] = income_df_with_customer["customer_id"].fillna(name_mapped)
-    
-    if "CustomerName" in lbpa_df_with_customer.columns:
-        if "customer_id" not in lbpa_df_with_customer.columns or lbpa_df_with_customer["customer_id"].isna().any():
-            lbpa_df_with_customer["__join_key__"] = lbpa_df_with_customer["CustomerName"].astype(str).str.lower().str.replace(r"[^a-z0-9]", "", regex=True)
-            name_mapped = lbpa_df_with_customer["__join_key__"].map(parent_to_id)
-            if "customer_id" not in lbpa_df_with_customer.columns:
-                lbpa_df_with_customer["customer_id"] = name_mapped
-            else:
-                lbpa_df_with_customer["customer_id"] = lbpa_df_with_customer["customer_id"].fillna(name_mapped)
-    
-    # Convert customer_id to string and filter valid ones
-    if "customer_id" in income_df_with_customer.columns:
-        income_df_with_customer["customer_id"] = income_df_with_customer["customer_id"].astype(str)
-    else:
-        income_df_with_customer["customer_id"] = None
-    
-    if "customer_id" in lbpa_df_with_customer.columns:
-        lbpa_df_with_customer["customer_id"] = lbpa_df_with_customer["customer_id"].astype(str)
-    else:
-        lbpa_df_with_customer["customer_id"] = None
-    
-    income_valid_mask = (
-        income_df_with_customer["customer_id"].notna() &
-        (income_df_with_customer["customer_id"] != "nan") &
-        (income_df_with_customer["customer_id"] != "None") &
-        (income_df_with_customer["customer_id"].str.strip() != "")
-    )
-    
-    lbpa_valid_mask = (
-        lbpa_df_with_customer["customer_id"].notna() &
-        (lbpa_df_with_customer["customer_id"] != "nan") &
-        (lbpa_df_with_customer["customer_id"] != "None") &
-        (lbpa_df_with_customer["customer_id"].str.strip() != "")
-    )
-    
-    # For Finastra customers, we need to group by customer_id + account_id (differentiator)
-    # For other customers, group by customer_id only
-    # First, identify Finastra customers
-    income_finastra_mask = income_df_with_customer["CustomerName"].astype(str).str.strip().str.lower() == "finastra"
-    lbpa_finastra_mask = lbpa_df_with_customer["CustomerName"].astype(str).str.strip().str.lower() == "finastra"
-    
-    # Create a grouping key: for Finastra use customer_id + account_id, for others just customer_id
-    income_df_with_customer["__group_key__"] = income_df_with_customer["customer_id"]
-    if "AccountID" in income_df_with_customer.columns:
-        income_finastra_rows = income_df_with_customer[income_finastra_mask & income_valid_mask]
-        if len(income_finastra_rows) > 0:
-            income_df_with_customer.loc[income_finastra_mask & income_valid_mask, "__group_key__"] = (
-                income_df_with_customer.loc[income_finastra_mask & income_valid_mask, "customer_id"].astype(str) + "_" +
-                income_df_with_customer.loc[income_finastra_mask & income_valid_mask, "AccountID"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            )
-    
-    lbpa_df_with_customer["__group_key__"] = lbpa_df_with_customer["customer_id"]
-    if "AccountID" in lbpa_df_with_customer.columns:
-        lbpa_finastra_rows = lbpa_df_with_customer[lbpa_finastra_mask & lbpa_valid_mask]
-        if len(lbpa_finastra_rows) > 0:
-            lbpa_df_with_customer.loc[lbpa_finastra_mask & lbpa_valid_mask, "__group_key__"] = (
-                lbpa_df_with_customer.loc[lbpa_finastra_mask & lbpa_valid_mask, "customer_id"].astype(str) + "_" +
-                lbpa_df_with_customer.loc[lbpa_finastra_mask & lbpa_valid_mask, "AccountID"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            )
-    
-    # Sum UnitsAsPerSubmission and IsInitialSubmission from Income file per group_key
-    customer_units_sums = {}
-    customer_app_sums = {}
-    
-    if "UnitsAsPerSubmission" in income_df_with_customer.columns and income_valid_mask.any():
-        # Convert to numeric, handling any non-numeric values
-        income_df_with_customer["UnitsAsPerSubmission"] = pd.to_numeric(income_df_with_customer["UnitsAsPerSubmission"], errors="coerce").fillna(0)
-        income_units = income_df_with_customer[income_valid_mask].groupby("__group_key__")["UnitsAsPerSubmission"].sum()
-        customer_units_sums.update(income_units.to_dict())
-    
-    if "IsInitialSubmission" in income_df_with_customer.columns and income_valid_mask.any():
-        # Convert to numeric, handling any non-numeric values
-        income_df_with_customer["IsInitialSubmission"] = pd.to_numeric(income_df_with_customer["IsInitialSubmission"], errors="coerce").fillna(0)
-        income_apps = income_df_with_customer[income_valid_mask].groupby("__group_key__")["IsInitialSubmission"].sum()
-        customer_app_sums.update(income_apps.to_dict())
-    
-    # Sum UnitsAsPerSubmission and IsInitialSubmission from LBPA file per group_key
-    if "UnitsAsPerSubmission" in lbpa_df_with_customer.columns and lbpa_valid_mask.any():
-        # Convert to numeric, handling any non-numeric values
-        lbpa_df_with_customer["UnitsAsPerSubmission"] = pd.to_numeric(lbpa_df_with_customer["UnitsAsPerSubmission"], errors="coerce").fillna(0)
-        lbpa_units = lbpa_df_with_customer[lbpa_valid_mask].groupby("__group_key__")["UnitsAsPerSubmission"].sum()
-        for group_key, value in lbpa_units.items():
-            customer_units_sums[group_key] = customer_units_sums.get(group_key, 0) + value
-    
-    if "IsInitialSubmission" in lbpa_df_with_customer.columns and lbpa_valid_mask.any():
-        # Convert to numeric, handling any non-numeric values
-        lbpa_df_with_customer["IsInitialSubmission"] = pd.to_numeric(lbpa_df_with_customer["IsInitialSubmission"], errors="coerce").fillna(0)
-        lbpa_apps = lbpa_df_with_customer[lbpa_valid_mask].groupby("__group_key__")["IsInitialSubmission"].sum()
-        for group_key, value in lbpa_apps.items():
-            customer_app_sums[group_key] = customer_app_sums.get(group_key, 0) + value
-    
-    # Initialize columns
-    combined_internal["UnitsAsPerSubmission"] = 0
-    combined_internal["IsInitialSubmission"] = 0
-    
-    # Set CustomerName if not already set (needed for group_key logic)
-    if "CustomerName" not in combined_internal.columns:
-        combined_internal["CustomerName"] = combined_internal.get("AccountName", "")
-    
-    # Create group_key in combined_internal for mapping
-    combined_internal["__group_key__"] = combined_internal["customer_id"].astype(str)
-    finastra_mask = combined_internal["CustomerName"].astype(str).str.strip().str.lower() == "finastra"
-    if "account_id" in combined_internal.columns:
-        finastra_with_account = finastra_mask & combined_internal["account_id"].notna()
-        combined_internal.loc[finastra_with_account, "__group_key__"] = (
-            combined_internal.loc[finastra_with_account, "customer_id"].astype(str) + "_" +
-            combined_internal.loc[finastra_with_account, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-        )
-    
-    # Map sums to all rows using group_key
-    if customer_units_sums and valid_customer_mask.any():
-        mapped_units = combined_internal.loc[valid_customer_mask, "__group_key__"].map(customer_units_sums).fillna(0)
-        combined_internal.loc[valid_customer_mask, "UnitsAsPerSubmission"] = mapped_units
-    
-    if customer_app_sums and valid_customer_mask.any():
-        mapped_apps = combined_internal.loc[valid_customer_mask, "__group_key__"].map(customer_app_sums).fillna(0)
-        combined_internal.loc[valid_customer_mask, "IsInitialSubmission"] = mapped_apps
-    
-    # For rows with missing customer_id, calculate sums by account_id instead
-    # Sum ALL rows from original Income and LBPA files by account_id (not just ones without customer_id)
-    missing_customer_mask = ~valid_customer_mask
-    if missing_customer_mask.any() and "account_id" in combined_internal.columns:
-        # Create account_id to sum mappings for missing customer_id rows
-        account_units_sums = {}
-        account_app_sums = {}
-        
-        # Sum from Income file by account_id (ALL rows, not filtered by customer_id)
-        if "UnitsAsPerSubmission" in income_df.columns and "AccountID" in income_df.columns:
-            income_account_groups = income_df["AccountID"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            income_df["UnitsAsPerSubmission"] = pd.to_numeric(income_df["UnitsAsPerSubmission"], errors="coerce").fillna(0)
-            income_units_by_account = income_df.groupby(income_account_groups)["UnitsAsPerSubmission"].sum()
-            for account_id, value in income_units_by_account.items():
-                if account_id:
-                    account_units_sums[account_id] = account_units_sums.get(account_id, 0) + value
-        
-        if "IsInitialSubmission" in income_df.columns and "AccountID" in income_df.columns:
-            income_account_groups = income_df["AccountID"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            income_df["IsInitialSubmission"] = pd.to_numeric(income_df["IsInitialSubmission"], errors="coerce").fillna(0)
-            income_apps_by_account = income_df.groupby(income_account_groups)["IsInitialSubmission"].sum()
-            for account_id, value in income_apps_by_account.items():
-                if account_id:
-                    account_app_sums[account_id] = account_app_sums.get(account_id, 0) + value
-        
-        # Sum from LBPA file by account_id (ALL rows, not filtered by customer_id)
-        if "UnitsAsPerSubmission" in lbpa_df.columns and "AccountID" in lbpa_df.columns:
-            lbpa_account_groups = lbpa_df["AccountID"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            lbpa_df["UnitsAsPerSubmission"] = pd.to_numeric(lbpa_df["UnitsAsPerSubmission"], errors="coerce").fillna(0)
-            lbpa_units_by_account = lbpa_df.groupby(lbpa_account_groups)["UnitsAsPerSubmission"].sum()
-            for account_id, value in lbpa_units_by_account.items():
-                if account_id:
-                    account_units_sums[account_id] = account_units_sums.get(account_id, 0) + value
-        
-        if "IsInitialSubmission" in lbpa_df.columns and "AccountID" in lbpa_df.columns:
-            lbpa_account_groups = lbpa_df["AccountID"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            lbpa_df["IsInitialSubmission"] = pd.to_numeric(lbpa_df["IsInitialSubmission"], errors="coerce").fillna(0)
-            lbpa_apps_by_account = lbpa_df.groupby(lbpa_account_groups)["IsInitialSubmission"].sum()
-            for account_id, value in lbpa_apps_by_account.items():
-                if account_id:
-                    account_app_sums[account_id] = account_app_sums.get(account_id, 0) + value
-        
-        # Map sums to rows with missing customer_id using account_id
-        if account_units_sums:
-            missing_account_ids = combined_internal.loc[missing_customer_mask, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            mapped_units = missing_account_ids.map(account_units_sums).fillna(0)
-            combined_internal.loc[missing_customer_mask, "UnitsAsPerSubmission"] = mapped_units.values
-        
-        if account_app_sums:
-            missing_account_ids = combined_internal.loc[missing_customer_mask, "account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            mapped_apps = missing_account_ids.map(account_app_sums).fillna(0)
-            combined_internal.loc[missing_customer_mask, "IsInitialSubmission"] = mapped_apps.values
-    
-    # Update value column based on event_type_name:
-    # - If event_type_name contains "unit" → value = UnitsAsPerSubmission
-    # - If event_type_name contains "app" → value = IsInitialSubmission
-    evt_lower = combined_internal["event_type_name"].astype(str).str.lower()
-    unit_mask = evt_lower.str.contains("unit")
-    app_mask = evt_lower.str.contains("app")
-    
-    # Only update rows with valid customer_id
-    if valid_customer_mask.any():
-        # For unit events, set value to UnitsAsPerSubmission
-        if unit_mask.any():
-            combined_internal.loc[unit_mask & valid_customer_mask, "value"] = (
-                combined_internal.loc[unit_mask & valid_customer_mask, "UnitsAsPerSubmission"]
-            )
-        
-        # For app events, set value to IsInitialSubmission
-        if app_mask.any():
-            combined_internal.loc[app_mask & valid_customer_mask, "value"] = (
-                combined_internal.loc[app_mask & valid_customer_mask, "IsInitialSubmission"]
-            )
-    
-    # Set CustomerName if not already set (should be set during aggregation)
-    if "CustomerName" not in combined_internal.columns:
-        combined_internal["CustomerName"] = combined_internal.get("AccountName", "")
-    
-    # Set differentiator for Finastra customers only
-    # Use __original_account_name__ directly (it already contains "Finastra - {account name}")
-    finastra_mask = combined_internal["CustomerName"].astype(str).str.strip().str.lower() == "finastra"
-    
-    # For Finastra rows, use the original AccountName from Income file directly
-    # (it already contains "Finastra - {account name}" so no need to prepend "Finastra - ")
-    if "__original_account_name__" in combined_internal.columns:
-        # Use original AccountName from Income file AccountName column directly
-        income_finastra_mask = finastra_mask & (combined_internal["ApplicationTypeName"] == "Income")
-        if income_finastra_mask.any():
-            combined_internal.loc[income_finastra_mask, "differentiator"] = (
-                combined_internal.loc[income_finastra_mask, "__original_account_name__"].astype(str)
-            )
-        # For LBPA rows with Finastra, use AccountName (which should be the customer name)
-        lbpa_finastra_mask = finastra_mask & (combined_internal["ApplicationTypeName"] == "LBPA")
-        if lbpa_finastra_mask.any():
-            combined_internal.loc[lbpa_finastra_mask, "differentiator"] = (
-                "Finastra - " + combined_internal.loc[lbpa_finastra_mask, "AccountName"].astype(str)
-            )
-    else:
-        # Fallback: use AccountName if __original_account_name__ not available
-        combined_internal.loc[finastra_mask, "differentiator"] = (
-            "Finastra - " + combined_internal.loc[finastra_mask, "AccountName"].astype(str)
-        )
-    
-    # Set differentiator to empty for non-Finastra customers
-    combined_internal.loc[~finastra_mask, "differentiator"] = ""
-
-    # Order/output columns to match Tabs expected headers
-    upload_cols = [
-        "customer_id",
-        "CustomerName",
-        "event_type_name",
-        "datetime",
-        "ApplicationTypeName",
-        "UnitsAsPerSubmission",
-        "IsInitialSubmission",
-        "value",
-        "differentiator",
-    ]
-    
-    # Separate unmapped rows (customer_id is missing AND CustomerName is still numeric/account ID)
-    # Use the same logic as valid_customer_mask to identify invalid customer_ids
-    customer_id_missing = (
-        combined_internal["customer_id"].isna() |
-        (combined_internal["customer_id"].astype(str).str.strip() == "") |
-        (combined_internal["customer_id"].astype(str).str.strip().str.lower() == "nan") |
-        (combined_internal["customer_id"].astype(str).str.strip() == "None")
-    )
-    customer_name_is_numeric = combined_internal["CustomerName"].astype(str).str.match(r'^\d+$', na=False)
-    unmapped_mask = customer_id_missing & customer_name_is_numeric
-    
-    
-    # Also check for rows with invalid customer_id (not just missing, but also "nan", "None", empty)
-    invalid_customer_mask = (
-        combined_internal["customer_id"].isna() |
-        (combined_internal["customer_id"].astype(str).str.strip() == "") |
-        (combined_internal["customer_id"].astype(str).str.strip().str.lower() == "nan") |
-        (combined_internal["customer_id"].astype(str).str.strip() == "None")
-    )
-    
-    # Create separate DataFrames for mapped and unmapped rows
-    # Only include rows with valid customer_id in the main output
-    unmapped_df = combined_internal[unmapped_mask].copy()
-    
-    # Separate rows with missing customer_id (regardless of CustomerName status)
-    missing_customer_id_df = combined_internal[customer_id_missing].copy()
-    
-    mapped_df = combined_internal[valid_customer_mask].copy()  # Use valid_customer_mask instead of ~unmapped_mask
-    
-    combined = mapped_df[upload_cols]
-    unmapped_output = unmapped_df[upload_cols] if len(unmapped_df) > 0 else pd.DataFrame(columns=upload_cols)
-    
-    
-    # Create CSV for rows with missing customer_id
-    missing_customer_id_output = missing_customer_id_df[upload_cols] if len(missing_customer_id_df) > 0 else pd.DataFrame(columns=upload_cols)
-    missing_customer_id_csv_bytes = missing_customer_id_output.to_csv(index=False).encode("utf-8") if len(missing_customer_id_output) > 0 else b""
-
-    # Prepare in-memory CSV bytes
-    combined_csv_bytes = combined.to_csv(index=False).encode("utf-8")
-    combined_internal_csv_bytes = combined_internal.to_csv(index=False).encode("utf-8")
-    unmapped_csv_bytes = unmapped_output.to_csv(index=False).encode("utf-8") if len(unmapped_output) > 0 else b""
-
-    # Store in session_state for later tabs/downloads
-    st.session_state["generated_files"]["usage_combined"] = {
-        "name": "LoanLogics_upload_All.csv",
-        "bytes": combined_csv_bytes,
-    }
-    st.session_state["generated_files"]["usage_internal"] = {
-        "name": "LoanLogics_upload_All_internal.csv",
-        "bytes": combined_internal_csv_bytes,
-    }
-    if len(unmapped_output) > 0:
-        st.session_state["generated_files"]["usage_unmapped"] = {
-            "name": "LoanLogics_upload_Unmapped.csv",
-            "bytes": unmapped_csv_bytes,
-        }
-        st.session_state["unmapped_count"] = len(unmapped_output)
-        # Store unmapped DataFrame for preview
-        st.session_state["unmapped_preview_df"] = unmapped_output.copy()
-    else:
-        # Clear unmapped files if no unmapped rows
-        if "usage_unmapped" in st.session_state.get("generated_files", {}):
-            del st.session_state["generated_files"]["usage_unmapped"]
-        st.session_state["unmapped_count"] = 0
-        if "unmapped_preview_df" in st.session_state:
-            del st.session_state["unmapped_preview_df"]
-    
-    # Store missing customer_id CSV
-    if len(missing_customer_id_output) > 0:
-        st.session_state["generated_files"]["usage_missing_customer_id"] = {
-            "name": "LoanLogics_upload_Missing_Customer_ID.csv",
-            "bytes": missing_customer_id_csv_bytes,
-        }
-        st.session_state["missing_customer_id_count"] = len(missing_customer_id_output)
-        # Store missing customer_id DataFrame for preview
-        st.session_state["missing_customer_id_preview_df"] = missing_customer_id_output.copy()
-    else:
-        # Clear missing customer_id files if no missing rows
-        if "usage_missing_customer_id" in st.session_state.get("generated_files", {}):
-            del st.session_state["generated_files"]["usage_missing_customer_id"]
-        st.session_state["missing_customer_id_count"] = 0
-        if "missing_customer_id_preview_df" in st.session_state:
-            del st.session_state["missing_customer_id_preview_df"]
+            st.session_state.pop(f"{prefix}_preview_df", None)
 
     # Store original dataframes for later split CSV generation with all columns
-    st.session_state["original_income_df"] = income_df.copy()
-    st.session_state["original_lbpa_df"] = lbpa_df.copy()
-
-    return income_upload, lbpa_df, combined_csv_bytes, combined_internal_csv_bytes
-
-
-def generate_split_csvs_with_all_columns(income_df, lbpa_df, usage_df, max_rows_per_split_csv=900):
-    """Generate split CSVs with all original columns from Income and LBPA files, grouped by customer_id.
-    Uses the Usage CSV (which has customer_id) to join back to original dataframes."""
-    
-    # Extract customer_id mapping from usage_df
-    # The usage_df has CustomerName (not AccountName) and customer_id columns
-    if usage_df is None or len(usage_df) == 0:
-        return []
-    
-    # Check what column name is used in usage_df for the customer name
-    usage_name_col = None
-    if "CustomerName" in usage_df.columns:
-        usage_name_col = "CustomerName"
-    elif "AccountName" in usage_df.columns:
-        usage_name_col = "AccountName"
-    
-    # Get mappings from usage_df - try account_id first, then CustomerName
-    account_id_to_customer_id = {}
-    customername_to_customer_id = {}
-    # Also create reverse mapping: customer_id -> CustomerName (for filename)
-    customer_id_to_name = {}
-    
-    if "account_id" in usage_df.columns and "customer_id" in usage_df.columns:
-        # Create account_id -> customer_id mapping (like reference code uses UUID)
-        usage_acct_mapping = usage_df[["account_id", "customer_id"]].drop_duplicates()
-        usage_acct_mapping["__acct_key__"] = usage_acct_mapping["account_id"].astype(str).str.replace(r"[^0-9]", "", regex=True)
-        account_id_to_customer_id = dict(zip(usage_acct_mapping["__acct_key__"], usage_acct_mapping["customer_id"]))
-    
-    if usage_name_col and "customer_id" in usage_df.columns:
-        usage_mapping = usage_df[[usage_name_col, "customer_id"]].drop_duplicates()
-        # Create both exact and normalized name mappings
-        for name, cust_id in zip(usage_mapping[usage_name_col].astype(str), usage_mapping["customer_id"]):
-            customername_to_customer_id[name] = cust_id
-            # Also create normalized version for matching
-            normalized_name = normalize_name(name)
-            if normalized_name not in customername_to_customer_id:
-                customername_to_customer_id[normalized_name] = cust_id
-        # Reverse mapping for filename generation
-        customer_id_to_name = dict(zip(usage_mapping["customer_id"].astype(str), usage_mapping[usage_name_col].astype(str)))
-    
-    def add_customer_id_from_usage(df, df_name):
-        """Add customer_id to dataframe by joining with usage_df mapping"""
-        df = df.copy()
-        df.columns = df.columns.str.strip()
-        
-        # Find AccountName/CustomerName column in original Income/LBPA file
-        parent_col = find_column(df, ["customername", "accountname", "name"])
-        acct_id_col = find_column(df, ["accountid", "acct#", "acct", "account number", "accountnumber"])
-        
-        if parent_col:
-            df["__original_name__"] = df[parent_col].astype(str)
-            df["__original_name__"] = df["__original_name__"].fillna("Unknown")
-        else:
-            df["__original_name__"] = "Unknown"
-        
-        # Try account_id matching first (most reliable, like reference code)
-        if acct_id_col and account_id_to_customer_id:
-            df["__acct_key__"] = df[acct_id_col].astype(str).str.replace(r"[^0-9]", "", regex=True)
-            df["customer_id"] = df["__acct_key__"].map(account_id_to_customer_id)
-        
-        # Fill missing with name-based matching (try exact first, then normalized)
-        if customername_to_customer_id:
-            # Try exact match first
-            name_mapped = df["__original_name__"].map(customername_to_customer_id)
-            if "customer_id" in df.columns:
-                df["customer_id"] = df["customer_id"].fillna(name_mapped)
-            else:
-                df["customer_id"] = name_mapped
-            
-            # If still missing, try normalized name matching
-            missing_mask = df["customer_id"].isna()
-            if missing_mask.any():
-                df.loc[missing_mask, "__normalized_name__"] = df.loc[missing_mask, "__original_name__"].apply(normalize_name)
-                normalized_mapped = df.loc[missing_mask, "__normalized_name__"].map(customername_to_customer_id)
-                df.loc[missing_mask, "customer_id"] = df.loc[missing_mask, "customer_id"].fillna(normalized_mapped)
-        
-        if "customer_id" not in df.columns:
-            df["customer_id"] = None
-        
-        return df
-    
-    # Add customer_id to both dataframes using the usage mapping
-    income_with_id = add_customer_id_from_usage(income_df, "income")
-    lbpa_with_id = add_customer_id_from_usage(lbpa_df, "lbpa")
-    
-    # Combine both dataframes
-    combined_all = pd.concat([income_with_id, lbpa_with_id], ignore_index=True)
-    
-    # Generate split CSVs grouped by customer_id
-    results = []
-    if len(combined_all) == 0:
-        return results
-    
-    # Remove helper columns before generating CSVs (keep only original columns + customer_id)
-    helper_columns = ["__original_name__", "__acct_key__", "__normalized_name__", "__join_key__", "__original_account_name__"]
-    columns_to_keep = [col for col in combined_all.columns if col not in helper_columns]
-    # Ensure customer_id is included
-    if "customer_id" not in columns_to_keep:
-        columns_to_keep.append("customer_id")
-    
-    for customer_id, group in combined_all.groupby("customer_id"):
-        group = group.sort_values("SubmissionDate" if "SubmissionDate" in group.columns else group.columns[0])
-        if pd.isna(customer_id) or str(customer_id).strip() == "":
-            continue
-        split_csvs = [group[i:i + max_rows_per_split_csv] for i in range(0, len(group), max_rows_per_split_csv)]
-        for idx, split_csv in enumerate(split_csvs, start=1):
-            suffix = f"_part{idx}" if len(split_csvs) > 1 else ""
-            
-            # Get customer name for filename
-            customer_name = customer_id_to_name.get(str(customer_id), "Unknown")
-            # Clean customer name for filesystem: remove special chars, replace spaces with underscores
-            safe_name = re.sub(r'[<>:"/\\|?*]', '', customer_name)  # Remove invalid filename chars
-            safe_name = re.sub(r'\s+', '_', safe_name.strip())  # Replace spaces with underscores
-            safe_name = safe_name[:50] if len(safe_name) > 50 else safe_name  # Limit length
-            
-            filename = f"{safe_name}_{customer_id}{suffix}.csv"
-            # Only include original columns + customer_id (exclude helper columns)
-            split_csv_clean = split_csv[[col for col in columns_to_keep if col in split_csv.columns]]
-            split_csv_bytes = split_csv_clean.to_csv(index=False).encode("utf-8")
-            results.append({"name": filename, "bytes": split_csv_bytes})
-    return results
-
-def generate_chunks(combined_df, max_rows_per_chunk=900):
-    results = []
-    for customer_id, group in combined_df.groupby("customer_id"):
-        group = group.sort_values("datetime")
-        if pd.isna(customer_id) or str(customer_id).strip() == "":
-            continue
-        chunks = [group[i:i + max_rows_per_chunk] for i in range(0, len(group), max_rows_per_chunk)]
-        for idx, chunk in enumerate(chunks, start=1):
-            suffix = f"_part{idx}" if len(chunks) > 1 else ""
-            filename = f"tabs_upload_{customer_id}{suffix}.csv"
-            chunk_bytes = chunk.to_csv(index=False).encode("utf-8")
-            results.append({"name": filename, "bytes": chunk_bytes})
-    return results
+    # (streamed exports are stored as their on-disk RowStores). build_usage
+    # returns frames of its own, so they are stored without another copy
+    for key in ("original_income_df", "original_lbpa_df"):
+        if isinstance(st.session_state.get(key), RowStore):
+            st.session_state[key].delete()
+    income_df, lbpa_df = result.income_rows, result.lbpa_rows
+    st.session_state["original_income_df"] = income_df
+    st.session_state["original_lbpa_df"] = lbpa_df
+
+    return result.income_upload, lbpa_df, result.usage_csv, result.internal_csv
+
+
+def split_details(split_csv: dict) -> dict:
+    """``split_csv`` with its ``rows``, ``customer_id``, ``customer_name``, ``size``
+    and ``hash``. Records made before these were stored with the split are
+    parsed once here and filled in place."""
+    if "rows" not in split_csv:
+        split_df = read_transactions(BytesIO(split_csv["bytes"]))
+        customer_ids = split_df["customer_id"].dropna().unique() if "customer_id" in split_df.columns else []
+        split_csv.update({
+            "rows": len(split_df),
+            "customer_id": str(customer_ids[0]) if len(customer_ids) else None,
+            "customer_name": None,
+            "size": len(split_csv["bytes"]),
+            "hash": content_hash(split_csv["bytes"]),
+        })
+    return split_csv
 
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="LoanLogics Usage Automation", layout="wide")
 st.title("LoanBeam Usage and Invoice Attachment Workflow")
 
+# Tabs API base URL: production unless the app was started with $TABS_API_BASE_URL
+# (e.g. pointing at the local stand-in server). It is shared by every session, so
+# it is only shown here, never set from the page.
+if tabs_client.TABS_API_BASE_URL != tabs_client.DEFAULT_BASE_URL:
+    with st.sidebar.expander("🔌 Tabs API", expanded=True):
+        st.code(tabs_client.TABS_API_BASE_URL, language=None)
+        st.caption("Set by $TABS_API_BASE_URL when the app was started. The invoice cache, NetSuite ID "
+                   "cache and upload journal are kept separately for each base URL.")
+    st.warning(f"🔌 Tabs API calls go to {tabs_client.TABS_API_BASE_URL}, not the production API.")
+
 usage_tab, chunk_tab = st.tabs(["Usage Transformation", "Invoice Attachment"])
 
 tab_names = [
@@ -1649,8 +575,13 @@ with usage_tab:
     if uploaded_files.get("income", {}).get("bytes"):
         with st.expander("Preview", expanded=False):
             try:
-                income_df = pd.read_csv(BytesIO(uploaded_files["income"]["bytes"]))
-                st.caption(f"Rows: {len(income_df):,} | Columns: {len(income_df.columns)}")
+                if st.session_state.get("usage_streaming"):
+                    # Large exports are only sampled; the full file is never parsed here
+                    income_df = read_upload(uploaded_files["income"], nrows=STREAM_PREVIEW_ROWS)
+                    st.caption(f"First {len(income_df):,} rows | Columns: {len(income_df.columns)}")
+                else:
+                    income_df = read_upload(uploaded_files["income"])
+                    st.caption(f"Rows: {len(income_df):,} | Columns: {len(income_df.columns)}")
                 st.dataframe(income_df, use_container_width=True)
             except Exception as e:
                 st.error(f"Could not preview Income file: {e}")
@@ -1664,8 +595,13 @@ with usage_tab:
     if uploaded_files.get("lbpa", {}).get("bytes"):
         with st.expander("Preview", expanded=False):
             try:
-                lbpa_df = pd.read_csv(BytesIO(uploaded_files["lbpa"]["bytes"]))
-                st.caption(f"Rows: {len(lbpa_df):,} | Columns: {len(lbpa_df.columns)}")
+                if st.session_state.get("usage_streaming"):
+                    # Large exports are only sampled; the full file is never parsed here
+                    lbpa_df = read_upload(uploaded_files["lbpa"], nrows=STREAM_PREVIEW_ROWS)
+                    st.caption(f"First {len(lbpa_df):,} rows | Columns: {len(lbpa_df.columns)}")
+                else:
+                    lbpa_df = read_upload(uploaded_files["lbpa"])
+                    st.caption(f"Rows: {len(lbpa_df):,} | Columns: {len(lbpa_df.columns)}")
                 st.dataframe(lbpa_df, use_container_width=True)
             except Exception as e:
                 st.error(f"Could not preview LBPA file: {e}")
@@ -1682,6 +618,12 @@ with usage_tab:
     resolve_now = st.checkbox("Retrieve Tabs Customer IDs (requires API key)")
     if resolve_now:
         st.text_input("Tabs API Key", type="password", key="ui_api_key_usage", placeholder="Enter Tabs API key")
+    streaming_mode = st.checkbox(
+        "Low-memory mode for large exports",
+        key="usage_streaming",
+        help="Reads the Income and LBPA files in chunks and keeps their rows on disk instead of in memory. "
+             "Use for exports with millions of rows.",
+    )
 
     # Usage date picker
     st.markdown("---")
@@ -1706,13 +648,19 @@ with usage_tab:
                 with st.spinner("Running transformation..."):
                     # Use stored mappings if available
                     stored_mappings = st.session_state.get("client_mappings")
+                    if streaming_mode:
+                        income_source, lbpa_source = BytesIO(up["income"]["bytes"]), BytesIO(up["lbpa"]["bytes"])
+                    else:
+                        # Parsed once and shared with the previews
+                        income_source, lbpa_source = read_upload(up["income"]), read_upload(up["lbpa"])
                     income_df, lbpa_df, combined_csv, combined_internal_csv = transform_usage(
-                        BytesIO(up["income"]["bytes"]),
-                        BytesIO(up["lbpa"]["bytes"]),
+                        income_source,
+                        lbpa_source,
                         uploaded_clients=None,
                         resolve_now=resolve_now,
                         usage_date=usage_date,
                         mappings=stored_mappings if stored_mappings else None,
+                        chunksize=CHUNK_ROWS if streaming_mode else None,
                     )
                 st.success("Transformation complete!")
                 st.session_state["show_usage_download"] = True
@@ -1726,8 +674,7 @@ with usage_tab:
         # Show preview of generated Usage CSV
         with st.expander("Preview", expanded=False):
             try:
-                usage_csv_bytes = st.session_state["generated_files"]["usage_combined"]["bytes"]
-                usage_df = pd.read_csv(BytesIO(usage_csv_bytes))
+                usage_df = read_upload(st.session_state["generated_files"]["usage_combined"], read_usage)
                 st.caption(f"Rows: {len(usage_df):,} | Columns: {len(usage_df.columns)}")
                 st.dataframe(usage_df, use_container_width=True)
             except Exception as e:
@@ -1825,8 +772,7 @@ with chunk_tab:
                         # Get Usage CSV (which has customer_id) - use generated or uploaded
                         usage_df = st.session_state.get("invoice_usage_csv")
                         if usage_df is None and st.session_state.get("generated_files", {}).get("usage_combined"):
-                            usage_csv_bytes = st.session_state["generated_files"]["usage_combined"]["bytes"]
-                            usage_df = pd.read_csv(BytesIO(usage_csv_bytes))
+                            usage_df = read_upload(st.session_state["generated_files"]["usage_combined"], read_usage)
                         
                         if usage_df is None or len(usage_df) == 0:
                             st.error("⚠️ Usage CSV not found. Please generate Usage CSV in the 'Usage Transformation' tab first.")
@@ -1837,8 +783,10 @@ with chunk_tab:
                                 income_df, 
                                 lbpa_df, 
                                 usage_df,
-                                max_rows_per_split_csv=999999  # One CSV per customer, no splitting
+                                max_rows_per_split_csv=999999,  # One CSV per customer, no splitting
+                                metrics=get_run_metrics(),
                             )
+                            save_run_report()
                             
                             if len(split_csvs) == 0:
                                 st.warning(f"⚠️ No split CSVs created. Check that customer_id mapping is working correctly.")
@@ -1857,7 +805,7 @@ with chunk_tab:
             if split_csvs:
                 # Show split CSV summary
                 split_csv_summary = pd.DataFrame([
-                    {"Filename": split_csv["name"], "Size (rows)": len(pd.read_csv(BytesIO(split_csv["bytes"])))}
+                    {"Filename": split_csv["name"], "Size (rows)": split_details(split_csv)["rows"]}
                     for split_csv in split_csvs
                 ])
                 st.dataframe(split_csv_summary, use_container_width=True)
@@ -1878,16 +826,18 @@ with chunk_tab:
                                 key=f"download_split_csv_{idx}"
                             )
                 
-                # Download all option
-                import zipfile
-                zip_buffer = BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for split_csv in split_csvs:
-                        zip_file.writestr(split_csv["name"], split_csv["bytes"])
-                zip_buffer.seek(0)
+                # Download all option: the archive is built on the first click and
+                # cached, so reruns of this page do not recompress the splits
+                zip_compression = st.selectbox(
+                    "ZIP compression",
+                    list(COMPRESSION_LEVELS),
+                    index=list(COMPRESSION_LEVELS).index(DEFAULT_COMPRESSION),
+                    help="Fastest and None (stored) build large archives sooner, at the cost of a bigger download",
+                    key="split_zip_compression"
+                )
                 st.download_button(
                     "Download All Split CSVs (ZIP)",
-                    data=zip_buffer.getvalue(),
+                    data=partial(read_archive, split_csvs, zip_compression),
                     file_name="all_split_csvs.zip",
                     mime="application/zip",
                     key="download_all_split_csvs"
@@ -1919,45 +869,23 @@ with chunk_tab:
             if api_key:
                 st.subheader("Invoice Cache Management")
                 
-                # Check if we have cached invoices (with better persistence)
-                cache_key = f"invoice_cache_{api_key[:10]}"
+                # This session's cache for the key (with better persistence)
+                invoice_cache = get_invoice_cache(api_key)
                 
-                # Try to get from session state first
-                cached_invoices = st.session_state.get(cache_key, [])
-                cache_timestamp = st.session_state.get(f"{cache_key}_timestamp", None)
-                
-                # If no cache in session state, try to load from file
-                if not cached_invoices:
+                # If nothing is cached this session, try to load from file
+                if not len(invoice_cache):
                     try:
-                        import json
-                        cache_file = os.path.join(_CACHE_DIR, f"invoice_cache_{api_key[:10]}.json")
-                        if os.path.exists(cache_file):
-                            with open(cache_file, 'r') as f:
-                                cache_data = json.load(f)
-                                cached_invoices = cache_data.get('invoices', [])
-                                cache_timestamp_str = cache_data.get('timestamp')
-                                if cache_timestamp_str:
-                                    try:
-                                        if isinstance(cache_timestamp_str, (int, float)):
-                                            cache_timestamp = datetime.fromtimestamp(cache_timestamp_str)
-                                        else:
-                                            cache_timestamp = datetime.fromisoformat(cache_timestamp_str)
-                                    except Exception:
-                                        cache_timestamp = None
-                                    
-                                # Restore to session state
-                                st.session_state[cache_key] = cached_invoices
-                                st.session_state[f"{cache_key}_timestamp"] = cache_timestamp
-                                st.success(f"✅ Loaded {len(cached_invoices)} invoices from persistent cache")
+                        if len(invoice_cache.load()):
+                            st.success(f"✅ Loaded {len(invoice_cache)} invoices from persistent cache")
                     except Exception as e:
                         st.warning(f"Could not load persistent cache: {e}")
-                        cached_invoices = []
-                        cache_timestamp = None
+                cached_invoices = invoice_cache.records
+                cache_timestamp = invoice_cache.timestamp
                 
-                col1, col2, col3 = st.columns([2, 1, 1])
+                col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
                 
                 with col1:
-                    if cached_invoices:
+                    if len(cached_invoices):
                         cache_age = datetime.now() - cache_timestamp if cache_timestamp else None
                         if cache_age:
                             age_hours = cache_age.total_seconds() / 3600
@@ -1969,40 +897,35 @@ with chunk_tab:
                         st.info("💡 Click 'Refresh Cache' to fetch all invoices from API (one-time setup)")
                 
                 with col2:
+                    if st.button(
+                        "⚡ Quick Refresh",
+                        help="Fetch only invoices created or updated since the cache was last refreshed",
+                        disabled=not (len(cached_invoices) and cache_timestamp),
+                    ):
+                        with st.spinner("Fetching new and updated invoices..."):
+                            fetched_at = datetime.now()
+                            new_invoices = fetch_all_invoices_for_cache(api_key, params=updated_since_params(cache_timestamp))
+                            if new_invoices is not None:
+                                try:
+                                    invoice_cache.merge(new_invoices, fetched_at)
+                                    st.success(f"✅ Merged {len(new_invoices)} new/updated invoices into the cache")
+                                except Exception as e:
+                                    st.success(f"✅ Merged {len(new_invoices)} new/updated invoices into the cache (File save failed: {e})")
+                                
+                                st.rerun()
+                            else:
+                                st.error("❌ Failed to fetch invoices")
+                
+                with col3:
                     if st.button("🔄 Refresh Cache", help="Fetch fresh invoices from API"):
-                        # Clear existing cache first
-                        if cache_key in st.session_state:
-                            del st.session_state[cache_key]
-                        if f"{cache_key}_timestamp" in st.session_state:
-                            del st.session_state[f"{cache_key}_timestamp"]
-                        
-                        # Also clear from file
-                        try:
-                            cache_file = os.path.join(_CACHE_DIR, f"invoice_cache_{api_key[:10]}.json")
-                            if os.path.exists(cache_file):
-                                os.remove(cache_file)
-                        except Exception:
-                            pass
-                        
+                        # The fetched invoices replace the cache; it is kept if the fetch fails
                         with st.spinner("Fetching all invoices from API (this may take a few minutes)..."):
+                            fetched_at = datetime.now()
                             all_invoices = fetch_all_invoices_for_cache(api_key)
-                            if all_invoices:
-                                # Save to session state
-                                st.session_state[cache_key] = all_invoices
-                                st.session_state[f"{cache_key}_timestamp"] = datetime.now()
-                                
-                                # Also save to file for persistence
+                            if all_invoices is not None and len(all_invoices):
+                                # Cache for the session and save to file for persistence
                                 try:
-                                    import json
-                                    _ensure_cache_dir_exists()
-                                    cache_file = os.path.join(_CACHE_DIR, f"invoice_cache_{api_key[:10]}.json")
-                                    cache_data = {
-                                        'invoices': all_invoices,
-                                        'timestamp': datetime.now().isoformat(),
-                                        'count': len(all_invoices)
-                                    }
-                                    with open(cache_file, 'w') as f:
-                                        json.dump(cache_data, f)
+                                    invoice_cache.update(all_invoices, fetched_at)
                                     st.success(f"✅ Cached {len(all_invoices)} invoices successfully! (Saved to file)")
                                 except Exception as e:
                                     st.success(f"✅ Cached {len(all_invoices)} invoices successfully! (File save failed: {e})")
@@ -2011,19 +934,11 @@ with chunk_tab:
                             else:
                                 st.error("❌ Failed to fetch invoices")
                 
-                with col3:
+                with col4:
                     if st.button("🗑️ Clear Cache", help="Clear cached invoices"):
-                        # Clear from session state
-                        if cache_key in st.session_state:
-                            del st.session_state[cache_key]
-                        if f"{cache_key}_timestamp" in st.session_state:
-                            del st.session_state[f"{cache_key}_timestamp"]
-                        
-                        # Also clear from file
+                        # Clear from session state and from file
                         try:
-                            cache_file = os.path.join(_CACHE_DIR, f"invoice_cache_{api_key[:10]}.json")
-                            if os.path.exists(cache_file):
-                                os.remove(cache_file)
+                            invoice_cache.clear()
                             st.success("✅ Cache cleared! (Both memory and file)")
                         except Exception as e:
                             st.success(f"✅ Cache cleared! (File removal failed: {e})")
@@ -2031,7 +946,7 @@ with chunk_tab:
                         st.rerun()
                 
                 # Show cache recommendations
-                if cached_invoices and cache_timestamp:
+                if len(cached_invoices) and cache_timestamp:
                     cache_age = datetime.now() - cache_timestamp
                     age_hours = cache_age.total_seconds() / 3600
                     if age_hours > 24:
@@ -2059,54 +974,36 @@ with chunk_tab:
                     problematic_split_csvs = []
                     
                     st.info(f"📋 Processing {len(split_csvs)} split CSV files...")
+                    progress_bar = st.progress(0)
+                    status_text = st.empty()
                     
-                    for i, split_csv in enumerate(split_csvs, 1):
-                        split_csv_df = pd.read_csv(BytesIO(split_csv["bytes"]))
-                        
-                        # Get unique customer IDs from split CSV
-                        customer_ids = split_csv_df["customer_id"].dropna().unique()
-                        
-                        st.write(f"📄 Processing {i}/{len(split_csvs)}: {split_csv['name']}")
-                        
-                        if len(customer_ids) == 0:
-                            st.warning(f"   ⚠️ No customer IDs found in split CSV")
-                            problematic_split_csvs.append({
-                                "split_csv_filename": split_csv["name"],
-                                "customer_id": "N/A",
-                                "issue_date": issue_date.strftime("%Y-%m-%d"),
-                                "issue": "No customer IDs found"
-                            })
-                            st.write("---")
-                            continue
-                        
-                        # For now, use first customer_id (each split CSV should be per customer)
-                        customer_id = customer_ids[0]
-                        st.write(f"   Customer ID: {customer_id}")
-                        
-                        # Find invoice ID by customer and issue date
-                        st.write(f"   Looking up invoice for date: {issue_date.strftime('%Y-%m-%d')}")
-                        
-                        invoice_id = find_invoice_by_date(customer_id, issue_date, api_key)
-                        
-                        if not invoice_id:
-                            st.warning(f"   ⚠️ No matching invoice found for customer {customer_id} on {issue_date}")
-                            problematic_split_csvs.append({
-                                "split_csv_filename": split_csv["name"],
-                                "customer_id": customer_id,
-                                "issue_date": issue_date.strftime("%Y-%m-%d"),
-                                "issue": f"No matching invoice found for customer {customer_id} on {issue_date}"
-                            })
-                            st.error(f"   ❌ No invoice ID found")
-                        else:
-                            st.success(f"   ✅ Invoice ID: {invoice_id}")
-                            mapping_data.append({
-                                "split_csv_filename": split_csv["name"],
-                                "customer_id": customer_id,
-                                "invoice_id": invoice_id,
-                                "issue_date": issue_date.strftime("%Y-%m-%d")
-                            })
-                        
-                        st.write("---")
+                    def _on_customer(done, total):
+                        progress_bar.progress(done / total if total else 1.0)
+                        status_text.text(f"🔎 Invoices found for {done}/{total} customers...")
+                    
+                    invoice_cache = get_invoice_cache(api_key)
+                    if not len(invoice_cache):
+                        try:
+                            invoice_cache.load()
+                        except Exception:
+                            pass
+                    if not len(invoice_cache):
+                        st.info("💡 No invoice cache: each customer's invoices are looked up in the API")
+                    
+                    with get_run_metrics().stage("Map invoices", rows=len(split_csvs)):
+                        # Each split CSV holds one customer's rows; customers the
+                        # cache does not cover are looked up concurrently
+                        splits = [
+                            {"name": split_csv["name"], "customer_id": split_details(split_csv)["customer_id"]}
+                            for split_csv in split_csvs
+                        ]
+                        mapping_data, problematic_split_csvs = map_invoices(
+                            splits, issue_date, invoice_cache, api_key, on_complete=_on_customer
+                        )
+                    
+                    progress_bar.empty()
+                    status_text.empty()
+                    save_run_report()
                         
                     # Show results summary after processing all split CSVs
                     if mapping_data:
@@ -2224,7 +1121,7 @@ with chunk_tab:
                 st.subheader("Upload Preview")
                 preview_df = mapping_df.copy()
                 preview_df["split_csv_size"] = preview_df["split_csv_filename"].map(
-                    lambda x: len(pd.read_csv(BytesIO(split_csvs_dict[x]["bytes"]))) if x in split_csvs_dict else 0
+                    lambda x: split_details(split_csvs_dict[x])["rows"] if x in split_csvs_dict else 0
                 )
                 preview_df["split_csv_exists"] = preview_df["split_csv_filename"].map(
                     lambda x: "Yes" if x in split_csvs_dict else "No"
@@ -2243,21 +1140,95 @@ with chunk_tab:
                 else:
                     # Add test mode option
                     test_mode = st.checkbox("🧪 Test Mode: Upload only one row from the first split CSV", value=False)
+                    max_concurrent_uploads = st.number_input(
+                        "Concurrent uploads",
+                        min_value=1,
+                        max_value=32,
+                        value=8,
+                        step=1,
+                        help="Number of attachments uploaded to Tabs in parallel",
+                        key="bulk_upload_concurrency"
+                    )
+                    upload_journal = UploadJournal(os.path.join(tabs_client.scoped_cache_dir(_CACHE_DIR), _UPLOAD_JOURNAL_NAME))
+                    skip_uploaded = st.checkbox(
+                        "⏭️ Skip attachments already uploaded (resume a previous run)",
+                        value=True,
+                        help="Attachments recorded as uploaded with identical CSV content are not sent again",
+                    )
+                    check_invoices = st.checkbox(
+                        "🔎 Check invoice IDs before uploading",
+                        value=True,
+                        help="Rows whose invoice does not exist, belongs to another customer or is deleted are "
+                             "reported and not uploaded. Invoices missing from the invoice cache are looked up "
+                             "with one API call per customer.",
+                    )
+                    journal_counts = upload_journal.counts()
+                    if journal_counts:
+                        journal_col1, journal_col2 = st.columns([3, 1])
+                        with journal_col1:
+                            st.caption(
+                                f"📒 Upload journal: {journal_counts.get(STATUS_SUCCESS, 0)} uploaded, "
+                                f"{journal_counts.get(STATUS_FAILED, 0)} failed, "
+                                f"{journal_counts.get(STATUS_STARTED, 0)} unfinished"
+                            )
+                        with journal_col2:
+                            if st.button("🗑️ Clear Upload Journal"):
+                                upload_journal.clear()
+                                st.rerun()
                     
                     if st.button("Start Bulk Upload", type="primary"):
                         try:
                             with st.spinner("Uploading CSV attachments..."):
                                 upload_results = []
+                                upload_jobs = []
                                 progress_bar = st.progress(0)
+                                status_text = st.empty()
                                 
                                 # Limit to first row if test mode is enabled
                                 rows_to_process = mapping_df.head(1) if test_mode else mapping_df
                                 
-                                for idx, row in rows_to_process.iterrows():
+                                # Pre-flight: report rows bound to fail before any bytes are sent
+                                invoice_issues = [None] * len(rows_to_process)
+                                if check_invoices:
+                                    status_text.text("🔎 Checking invoice IDs...")
+                                    invoice_cache = get_invoice_cache(api_key)
+                                    if not len(invoice_cache):
+                                        try:
+                                            invoice_cache.load()
+                                        except Exception:
+                                            pass
+                                    with get_run_metrics().stage("Check invoices", rows=len(rows_to_process)):
+                                        invoice_issues = check_invoice_pairs(
+                                            zip(rows_to_process["customer_id"], rows_to_process["invoice_id"]),
+                                            invoice_cache,
+                                            api_key,
+                                        )
+                                    invalid_rows = [
+                                        {"split_csv_filename": name, "customer_id": customer_id, "invoice_id": invoice_id, "issue": issue}
+                                        for name, customer_id, invoice_id, issue in zip(
+                                            rows_to_process["split_csv_filename"], rows_to_process["customer_id"],
+                                            rows_to_process["invoice_id"], invoice_issues,
+                                        ) if issue
+                                    ]
+                                    if invalid_rows:
+                                        st.warning(f"⚠️ {len(invalid_rows)} of {len(rows_to_process)} mapping rows point at invoices that cannot take an attachment; they will not be uploaded")
+                                        st.dataframe(pd.DataFrame(invalid_rows), use_container_width=True, hide_index=True)
+                                
+                                for (idx, row), invoice_issue in zip(rows_to_process.iterrows(), invoice_issues):
                                     split_csv_name = row["split_csv_filename"]
                                     customer_id = row["customer_id"]
                                     invoice_id = row["invoice_id"]
                                     
+                                    if invoice_issue:
+                                        upload_results.append({
+                                            "split_csv": split_csv_name,
+                                            "customer_id": customer_id,
+                                            "invoice_id": invoice_id,
+                                            "status": "Invalid",
+                                            "reason": invoice_issue
+                                        })
+                                        continue
+                                    
                                     if split_csv_name not in split_csvs_dict:
                                         upload_results.append({
                                             "split_csv": split_csv_name,
@@ -2266,12 +1237,15 @@ with chunk_tab:
                                         })
                                         continue
                                     
-                                    split_csv_bytes = split_csvs_dict[split_csv_name]["bytes"]
+                                    split_csv = split_details(split_csvs_dict[split_csv_name])
+                                    split_csv_bytes = split_csv["bytes"]
+                                    csv_hash = split_csv["hash"]
                                     
                                     # In test mode, create a CSV with only the first row
                                     if test_mode:
                                         try:
-                                            test_df = pd.read_csv(BytesIO(split_csv_bytes))
+                                            # Only the first row is needed
+                                            test_df = read_transactions(BytesIO(split_csv_bytes), nrows=1)
                                             if len(test_df) > 0:
                                                 # Keep only the first row
                                                 test_df = test_df.head(1)
@@ -2279,6 +1253,7 @@ with chunk_tab:
                                                 test_filename = split_csv_name.replace(".csv", "_test.csv")
                                                 split_csv_bytes = test_df.to_csv(index=False).encode("utf-8")
                                                 split_csv_name = test_filename
+                                                csv_hash = content_hash(split_csv_bytes)
                                             else:
                                                 upload_results.append({
                                                     "split_csv": split_csv_name,
@@ -2294,37 +1269,87 @@ with chunk_tab:
                                             })
                                             continue
                                     
-                                    # Upload CSV as attachment to invoice
-                                    success = upload_csv_attachment(
-                                        customer_id,
-                                        invoice_id,
-                                        split_csv_bytes,
-                                        split_csv_name,
-                                        api_key
-                                    )
+                                    if skip_uploaded and upload_journal.is_uploaded(invoice_id, csv_hash):
+                                        upload_results.append({
+                                            "split_csv": split_csv_name,
+                                            "customer_id": customer_id,
+                                            "invoice_id": invoice_id,
+                                            "status": "Skipped",
+                                            "reason": "Already uploaded"
+                                        })
+                                        continue
                                     
+                                    # Queue the upload; the result row is filled in once it finishes
                                     upload_results.append({
                                         "split_csv": split_csv_name,
                                         "customer_id": customer_id,
                                         "invoice_id": invoice_id,
-                                        "status": "Success" if success else "Failed",
-                                        "reason": "" if success else "Upload failed"
+                                        "status": "Pending",
+                                        "reason": ""
                                     })
-                                    
-                                    progress_bar.progress((idx + 1) / len(rows_to_process))
+                                    upload_jobs.append({
+                                        "customer_id": customer_id,
+                                        "invoice_id": invoice_id,
+                                        "bytes": split_csv_bytes,
+                                        "filename": split_csv_name,
+                                        "hash": csv_hash,
+                                        "result_idx": len(upload_results) - 1,
+                                    })
+                                
+                                def _on_upload_complete(done, total):
+                                    progress_bar.progress(done / total)
+                                    status_text.text(f"📤 Uploaded {done}/{total} attachments...")
+                                
+                                # Upload CSVs as attachments to invoices, N at a time
+                                with get_run_metrics().stage("Upload attachments", rows=len(upload_jobs)):
+                                    upload_flags = upload_csv_attachments_concurrently(
+                                        upload_jobs,
+                                        api_key,
+                                        max_workers=max_concurrent_uploads,
+                                        on_complete=_on_upload_complete,
+                                        journal=upload_journal,
+                                    )
+                                save_run_report()
+                                for job, success in zip(upload_jobs, upload_flags):
+                                    upload_results[job["result_idx"]]["status"] = "Success" if success else "Failed"
+                                    upload_results[job["result_idx"]]["reason"] = "" if success else "Upload failed"
+                                status_text.empty()
                                 
                                 results_df = pd.DataFrame(upload_results)
                                 st.session_state["upload_results"] = results_df
                                 
                                 success_count = (results_df["status"] == "Success").sum()
+                                skipped_count = (results_df["status"] == "Skipped").sum()
+                                invalid_count = (results_df["status"] == "Invalid").sum()
+                                skipped_note = f" ({skipped_count} already uploaded, skipped)" if skipped_count else ""
+                                skipped_note += f" ({invalid_count} invalid invoices, not uploaded)" if invalid_count else ""
                                 progress_bar.empty()
                                 
                                 if test_mode:
-                                    st.success(f"✅ Test upload complete! {success_count}/{len(results_df)} successful")
+                                    st.success(f"✅ Test upload complete! {success_count}/{len(results_df)} successful{skipped_note}")
                                 else:
-                                    st.success(f"✅ Upload complete! {success_count}/{len(results_df)} successful")
+                                    st.success(f"✅ Upload complete! {success_count}/{len(results_df)} successful{skipped_note}")
                                 
                         except Exception as e:
                             st.error(f"Error during bulk upload: {str(e)}")
                             import traceback
                             st.code(traceback.format_exc())
+
+# --- Run metrics panel ---
+run_metrics = st.session_state.get("run_metrics")
+if isinstance(run_metrics, RunMetrics) and run_metrics.stages:
+    with st.expander("⏱️ Run metrics", expanded=False):
+        run_report = run_metrics.report()
+        peak_rss = f"{run_report['peak_rss_mb']:,.0f} MB" if run_report["peak_rss_mb"] is not None else "n/a"
+        st.caption(f"Run {run_report['run_id']} | {run_report['total_seconds']:.1f}s in stages | Peak memory (RSS): {peak_rss}")
+        st.dataframe(pd.DataFrame(run_report["stages"]), use_container_width=True, hide_index=True)
+        if run_report["api"]:
+            st.caption("Tabs API calls")
+            st.dataframe(pd.DataFrame(run_report["api"]).drop(columns="statuses"), use_container_width=True, hide_index=True)
+        st.download_button(
+            "Download Run Report (JSON)",
+            data=json.dumps(run_report, indent=2),
+            file_name=f"run_report_{run_report['run_id']}.json",
+            mime="application/json",
+            key="download_run_report"
+        )
@@ -0,0 +1,87 @@
+"""Temporary on-disk store for raw Income/LBPA rows.
+
+In streaming mode the exports are never held in memory whole: each chunk
+read from an export is appended to a ``RowStore`` once its usage has been
+aggregated, and the split step reads the rows back chunk by chunk.
+
+Chunks are appended to one file as pickled DataFrames, which is much faster
+to write and read back than CSV and keeps each column's dtype. Streamed
+exports are read with every column as strings, so values reach the split
+CSVs as they appeared in the export. The file is removed when the store is
+deleted or garbage collected.
+"""
+import os
+import pickle
+import tempfile
+import weakref
+
+import pandas as pd
+
+# ============ CONFIG ============
+CHUNK_ROWS = 250_000   # rows per chunk when streaming exports
+SPILL_DIR = None       # None = the system temp directory
+# =================================
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_csv_chunks(source, chunksize: int = CHUNK_ROWS, dtype=str):
+    """Read a CSV (path or file object) in chunks, by default every column as strings."""
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return pd.read_csv(source, dtype=dtype, chunksize=chunksize)
+
+
+class RowStore:
+    """Rows appended chunk by chunk to a temporary file."""
+
+    def __init__(self, directory: str | None = None, prefix: str = "rows_"):
+        directory = directory or SPILL_DIR
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(suffix=".pkl", prefix=prefix, dir=directory)
+        os.close(fd)
+        self.columns: list[str] | None = None
+        self.rows = 0
+        self._finalizer = weakref.finalize(self, _remove, self.path)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def append(self, chunk: pd.DataFrame) -> None:
+        """Append rows. Chunks may have different columns: ``columns`` is their
+        union and ``read`` aligns them as ``pd.concat`` does."""
+        if self.columns is None:
+            self.columns = []
+        self.columns += [col for col in chunk.columns if col not in self.columns]
+        with open(self.path, "ab") as f:
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.rows += len(chunk)
+
+    def iter_chunks(self):
+        """Stored rows in order, one DataFrame per appended chunk (with its own columns)."""
+        if self.columns is None:
+            return
+        with open(self.path, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def read(self) -> pd.DataFrame:
+        """All stored rows as one DataFrame."""
+        chunks = list(self.iter_chunks())
+        if not chunks:
+            return pd.DataFrame(columns=self.columns or [])
+        return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+    def delete(self) -> None:
+        self._finalizer()
+        self.columns = None
+        self.rows = 0
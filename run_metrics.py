@@ -0,0 +1,219 @@
+"""Stage timings, row counts, peak memory and Tabs API calls of a pipeline run.
+
+A ``RunMetrics`` collects one record per stage of a run (parsing the
+exports, mapping, aggregation, NetSuite resolution, invoice fetches, split
+serialisation, uploads): its wall time, the rows it handled, the process's
+peak RSS when it finished and how much the stage raised it, and the Tabs API
+calls made while it ran. API calls are also summarised per endpoint (count,
+errors, latency), from every attempt ``tabs_client.request`` sends, retries
+included.
+
+The app keeps one per session (shown in the "Run metrics" panel), the
+command line one per run; both write it as a JSON run report. API calls are
+observed process-wide, so calls made by other sessions during a stage are
+counted too. Peak RSS is the process's own: split CSVs written by worker
+processes (see ``split_writer``) are not included.
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import tabs_client
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ============ CONFIG ============
+REPORT_DIR = os.path.join("usage_uploads", "_runs")
+MAX_REPORTS = 200   # oldest reports in REPORT_DIR are removed past this many
+# =================================
+
+_ID_SEGMENT = re.compile(r"\d|^[^/]{20,}$")
+
+
+def peak_rss_bytes() -> int | None:
+    """Peak resident set size of this process so far (None where unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _mb(size: int | None) -> float | None:
+    return None if size is None else round(size / 1024**2, 1)
+
+
+def endpoint_name(method: str, url: str) -> str:
+    """``METHOD path`` of a call with its IDs replaced, e.g.
+    ``POST customers/{id}/invoices/{id}/attachments``."""
+    path = url.split("?", 1)[0]
+    if path.startswith(tabs_client.TABS_API_BASE_URL):
+        path = path[len(tabs_client.TABS_API_BASE_URL):]
+    segments = ["{id}" if _ID_SEGMENT.search(segment) else segment
+                for segment in path.strip("/").split("/")]
+    return f"{method.upper()} {'/'.join(segments)}"
+
+
+def _prune_reports(keep: int, exclude: str) -> None:
+    try:
+        names = sorted(name for name in os.listdir(REPORT_DIR) if name.endswith(".json"))
+    except OSError:
+        return
+    # Report names start with their run's timestamp, so sorted is oldest first
+    stale = [name for name in names if os.path.join(REPORT_DIR, name) != exclude]
+    for name in stale[:max(0, len(stale) - keep)]:
+        try:
+            os.remove(os.path.join(REPORT_DIR, name))
+        except OSError:
+            pass
+
+
+class Stage:
+    """One timed stage; ``rows`` may be set while it runs. A stage started
+    while another runs (e.g. an invoice fetch during mapping) names it as
+    ``parent``."""
+
+    def __init__(self, name: str, rows: int | None = None, parent: str | None = None):
+        self.name = name
+        self.rows = rows
+        self.parent = parent
+        self.seconds = None
+        self.api_calls = 0
+        self.peak_rss = None
+        self.rss_growth = None
+        self._started = time.perf_counter()
+        self._peak_before = peak_rss_bytes()
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "seconds": None if self.seconds is None else round(self.seconds, 3),
+            "rows": self.rows,
+            "api_calls": self.api_calls,
+            "peak_rss_mb": _mb(self.peak_rss),
+            "rss_growth_mb": _mb(self.rss_growth),
+        }
+
+
+class RunMetrics:
+    """Thread-safe collector of the stages and API calls of one run."""
+
+    def __init__(self, name: str = "run"):
+        self.name = name
+        self.run_id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+        self.started_at = datetime.now()
+        self.stages: list[Stage] = []
+        self.api: dict[str, dict] = {}
+        self._active: list[Stage] = []
+        self._lock = threading.Lock()
+
+    def start(self, name: str, rows: int | None = None) -> Stage:
+        """Start a stage; API calls are attributed to it until ``finish``."""
+        with self._lock:
+            stage = Stage(name, rows, self._active[-1].name if self._active else None)
+            self.stages.append(stage)
+            if not self._active:
+                tabs_client.add_observer(self._record_api_call)
+            self._active.append(stage)
+        return stage
+
+    def finish(self, stage: Stage, rows: int | None = None) -> Stage:
+        stage.seconds = time.perf_counter() - stage._started
+        if rows is not None:
+            stage.rows = rows
+        stage.peak_rss = peak_rss_bytes()
+        if stage.peak_rss is not None and stage._peak_before is not None:
+            stage.rss_growth = stage.peak_rss - stage._peak_before
+        with self._lock:
+            if stage in self._active:
+                self._active.remove(stage)
+                if not self._active:
+                    tabs_client.remove_observer(self._record_api_call)
+        return stage
+
+    @contextmanager
+    def stage(self, name: str, rows: int | None = None):
+        """Time the block as stage ``name``; yields the ``Stage`` (set its ``rows``)."""
+        stage = self.start(name, rows)
+        try:
+            yield stage
+        finally:
+            self.finish(stage)
+
+    def _record_api_call(self, method: str, url: str, status: int | None, seconds: float) -> None:
+        endpoint = endpoint_name(method, url)
+        with self._lock:
+            for stage in self._active:
+                stage.api_calls += 1
+            calls = self.api.setdefault(endpoint, {"latencies": [], "errors": 0, "statuses": {}})
+            calls["latencies"].append(seconds)
+            key = str(status) if status is not None else "connection error"
+            calls["statuses"][key] = calls["statuses"].get(key, 0) + 1
+            if status is None or status >= 400:
+                calls["errors"] += 1
+
+    def api_summary(self) -> list[dict]:
+        """Calls, errors and latency (ms) per endpoint, busiest first."""
+        with self._lock:
+            api = {endpoint: (sorted(calls["latencies"]), calls["errors"], dict(calls["statuses"]))
+                   for endpoint, calls in self.api.items()}
+        summary = []
+        for endpoint, (latencies, errors, statuses) in api.items():
+            summary.append({
+                "endpoint": endpoint,
+                "calls": len(latencies),
+                "errors": errors,
+                "statuses": statuses,
+                "total_s": round(sum(latencies), 3),
+                "mean_ms": round(1000 * sum(latencies) / len(latencies), 1),
+                "p95_ms": round(1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 1),
+                "max_ms": round(1000 * latencies[-1], 1),
+            })
+        return sorted(summary, key=lambda row: -row["calls"])
+
+    def report(self) -> dict:
+        """The run report (what ``save`` writes)."""
+        stages = [stage.to_dict() for stage in self.stages]
+        return {
+            "run_id": self.run_id,
+            "name": self.name,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "total_seconds": round(sum(stage["seconds"] or 0 for stage in stages if not stage["parent"]), 3),
+            "peak_rss_mb": _mb(peak_rss_bytes()),
+            "python": sys.version.split()[0],
+            "stages": stages,
+            "api": self.api_summary(),
+        }
+
+    def save(self, path: str | None = None) -> str:
+        """Write the report as JSON (by default ``REPORT_DIR/<run_id>.json``,
+        keeping the newest ``MAX_REPORTS`` there)."""
+        if path is None:
+            path = os.path.join(REPORT_DIR, f"{self.run_id}.json")
+            _prune_reports(keep=MAX_REPORTS - 1, exclude=path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+    def format_table(self) -> str:
+        """The stages as a plain-text table, for the command line."""
+        lines = [f"{'stage':<36}{'seconds':>10}{'rows':>12}{'API calls':>11}{'peak RSS MB':>13}"]
+        for stage in self.stages:
+            name = f"  {stage.name}" if stage.parent else stage.name
+            lines.append(
+                f"{name:<36}{stage.seconds or 0:>10.2f}"
+                f"{'' if stage.rows is None else f'{stage.rows:,}':>12}{stage.api_calls:>11}"
+                f"{'' if stage.peak_rss is None else _mb(stage.peak_rss):>13}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,110 @@
+"""ZIP archive of the split CSVs, built once per set of splits.
+
+Step 1 used to recompress every split CSV into an in-memory buffer on each
+rerun of the page and then copy the buffer again for the download button.
+The archive is now built only when it is downloaded, written to a spooled
+temporary file (kept in memory while small, moved to disk past
+``SPOOL_MAX_BYTES``), and cached under the content hash of the splits and
+the compression chosen, so later downloads reuse it. Each download gets the
+archive as bytes: Streamlit reads whatever its download button is handed
+into memory, so a file-like object would save nothing.
+
+The cache is process-wide and thread-safe: Streamlit runs deferred download
+callables outside the script thread.
+"""
+import hashlib
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+from frame_cache import content_hash
+
+# ============ CONFIG ============
+MAX_ENTRIES = 4                    # archives kept (each set of splits x compression)
+SPOOL_MAX_BYTES = 32 * 1024**2     # larger archives are written to disk
+COMPRESSION_LEVELS = {             # label: (zipfile method, compresslevel)
+    "Standard": (zipfile.ZIP_DEFLATED, None),
+    "Fastest": (zipfile.ZIP_DEFLATED, 1),
+    "Smallest": (zipfile.ZIP_DEFLATED, 9),
+    "None (stored)": (zipfile.ZIP_STORED, None),
+}
+DEFAULT_COMPRESSION = "Standard"
+# =================================
+
+
+def splits_hash(split_csvs: list[dict]) -> str:
+    """Content hash of a set of split records (their names and file hashes)."""
+    digest = hashlib.md5()
+    for split_csv in split_csvs:
+        file_hash = split_csv.get("hash") or content_hash(split_csv["bytes"])
+        digest.update(f"{split_csv['name']}\0{file_hash}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_archive(split_csvs: list[dict], compression: str = DEFAULT_COMPRESSION):
+    """The splits zipped into a spooled temporary file, rewound for reading."""
+    method, level = COMPRESSION_LEVELS[compression]
+    archive = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, suffix=".zip")
+    with zipfile.ZipFile(archive, "w", method, compresslevel=level) as zip_file:
+        for split_csv in split_csvs:
+            zip_file.writestr(split_csv["name"], split_csv["bytes"])
+    archive.seek(0)
+    return archive
+
+
+class ArchiveCache:
+    """Thread-safe LRU of built archives; evicted archives are closed (and
+    their temporary files removed)."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._archives: OrderedDict[tuple, tempfile.SpooledTemporaryFile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._archives)
+
+    def read(self, split_csvs: list[dict], compression: str = DEFAULT_COMPRESSION) -> bytes:
+        """The archive of ``split_csvs``, built the first time it is asked for."""
+        key = (splits_hash(split_csvs), compression)
+        with self._lock:
+            archive = self._archives.get(key)
+            if archive is not None:
+                self._archives.move_to_end(key)
+                archive.seek(0)
+                return archive.read()
+        # Built outside the lock so downloads of other archives are not held up
+        archive = build_archive(split_csvs, compression)
+        data = archive.read()
+        self._store(key, archive)
+        return data
+
+    def _store(self, key: tuple, archive) -> None:
+        with self._lock:
+            previous = self._archives.pop(key, None)
+            if previous is not None:
+                previous.close()
+            self._archives[key] = archive
+            while len(self._archives) > self.max_entries:
+                _, evicted = self._archives.popitem(last=False)
+                evicted.close()
+
+    def clear(self) -> None:
+        with self._lock:
+            for archive in self._archives.values():
+                archive.close()
+            self._archives.clear()
+
+
+_cache = ArchiveCache()
+
+
+def get_cache() -> ArchiveCache:
+    """The process-wide archive cache shared by every session."""
+    return _cache
+
+
+def read_archive(split_csvs: list[dict], compression: str = DEFAULT_COMPRESSION) -> bytes:
+    """Archive bytes through the process-wide cache (see ``ArchiveCache.read``)."""
+    return _cache.read(split_csvs, compression)
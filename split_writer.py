@@ -0,0 +1,135 @@
+"""Per-customer split CSV serialisation, fanned out over worker processes.
+
+Sorting each customer's rows and writing them with ``to_csv`` is CPU-bound
+and was done one customer after another. ``write_splits`` sends batches of
+customers to a process pool instead; results are collected in submission
+order, so the split records (and their filenames) come out exactly as the
+serial loop produced them.
+
+The worker functions live in this module rather than in ``new.py`` because
+worker processes import them by name, and importing ``new.py`` would render
+the Streamlit page. Workers are started with ``forkserver`` (``spawn`` where
+that is unavailable) since forking the multi-threaded Streamlit server is
+unsafe. The pool is created on first use and shared by every session.
+
+Inputs that fit in a single batch are written in-process, as are all inputs
+on single-core machines.
+"""
+import multiprocessing
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+
+import pandas as pd
+
+from frame_cache import content_hash
+from usage_schema import decode
+
+# ============ CONFIG ============
+MAX_WORKERS = None     # None = one per CPU core
+BATCH_ROWS = 50_000    # rows of customers sent to a worker per task
+# =================================
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def safe_filename(customer_name: str) -> str:
+    """``customer_name`` cleaned for use in a filename."""
+    safe_name = re.sub(r'[<>:"/\\|?*]', '', customer_name)  # Remove invalid filename chars
+    safe_name = re.sub(r'\s+', '_', safe_name.strip())  # Replace spaces with underscores
+    return safe_name[:50]  # Limit length
+
+
+def write_customer_splits(customer_id, group: pd.DataFrame, columns: list, customer_name: str,
+                          max_rows: int) -> list[dict]:
+    """Split records (see ``generate_split_csvs_with_all_columns``) for one customer's rows."""
+    # Categoricals are sorted on their text: codes would order tied rows differently
+    group = group.sort_values("SubmissionDate" if "SubmissionDate" in group.columns else group.columns[0], key=decode)
+    split_csvs = [group[i:i + max_rows] for i in range(0, len(group), max_rows)]
+    safe_name = safe_filename(customer_name)
+    # Only include original columns + customer_id (exclude helper columns)
+    columns = [col for col in columns if col in group.columns]
+    records = []
+    for idx, split_csv in enumerate(split_csvs, start=1):
+        suffix = f"_part{idx}" if len(split_csvs) > 1 else ""
+        split_csv_bytes = split_csv[columns].to_csv(index=False).encode("utf-8")
+        records.append({
+            "name": f"{safe_name}_{customer_id}{suffix}.csv",
+            "bytes": split_csv_bytes,
+            "rows": len(split_csv),
+            "customer_id": str(customer_id),
+            "customer_name": customer_name,
+            "size": len(split_csv_bytes),
+            "hash": content_hash(split_csv_bytes),
+        })
+    return records
+
+
+def _write_batch(batch: list, columns: list, max_rows: int) -> list[dict]:
+    return [record for customer_id, group, customer_name in batch
+            for record in write_customer_splits(customer_id, group, columns, customer_name, max_rows)]
+
+
+def _batches(groups, customer_names: dict, batch_rows: int):
+    batch, rows = [], 0
+    for customer_id, group in groups:
+        if pd.isna(customer_id) or str(customer_id).strip() == "":
+            continue
+        batch.append((customer_id, group, customer_names.get(str(customer_id), "Unknown")))
+        rows += len(group)
+        if rows >= batch_rows:
+            yield batch
+            batch, rows = [], 0
+    if batch:
+        yield batch
+
+
+def _mp_context():
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    # Workers are forked from a server that has already imported pandas
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def get_pool(max_workers: int) -> ProcessPoolExecutor:
+    """The shared worker pool, (re)created when ``max_workers`` changes."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != max_workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=_mp_context())
+            _pool_workers = max_workers
+        return _pool
+
+
+def write_splits(groups, columns: list, customer_names: dict, max_rows: int,
+                 max_workers: int | None = MAX_WORKERS, batch_rows: int = BATCH_ROWS) -> list[dict]:
+    """Split records for every ``(customer_id, rows)`` in ``groups``, in order.
+
+    Customers with a blank ID are skipped. ``groups`` is consumed lazily: at
+    most two batches per worker are pending at a time, so streamed groups are
+    never all held in memory at once."""
+    max_workers = max_workers or os.cpu_count() or 1
+    batches = _batches(groups, customer_names, batch_rows)
+    head = list(islice(batches, 2))
+    if len(head) < 2 or max_workers == 1:
+        return [record for batch in chain(head, batches) for record in _write_batch(batch, columns, max_rows)]
+
+    pool = get_pool(max_workers)
+    results = []
+    pending = deque()
+    for batch in chain(head, batches):
+        pending.append(pool.submit(_write_batch, batch, columns, max_rows))
+        if len(pending) >= 2 * max_workers:
+            results += pending.popleft().result()
+    while pending:
+        results += pending.popleft().result()
+    return results
@@ -1,41 +1,286 @@
+"""Attach per-customer CSVs to their Tabs invoices, as listed in invoice_mapping.csv.
+
+Each mapping row names a customer and an invoice; the CSV attached is the
+row's ``split_csv_filename`` when the mapping has that column (the mapping
+the app and ``loanlogics_usage_transformer`` write), else
+``tabs_upload_<customer_id>.csv``, in ``OUTPUT_DIR``.
+
+Uploads run concurrently on an asyncio event loop: at most ``--concurrency``
+are in flight, each sent from a worker thread through ``tabs_client`` (pooled
+connections, rate limiting, retries). A file is opened only when its upload
+starts and its multipart body is streamed from disk, so thousands of files
+never sit in memory at once. Each upload's outcome is printed as it
+finishes, followed by a summary; the exit status is 1 when any upload failed,
+any CSV was missing or any invoice was invalid. With ``--journal``, uploads recorded there as done
+are skipped, so a re-run sends only what did not land. With
+``--check-invoices``, every invoice is checked first (against the app's
+invoice cache, else with one API call per customer) and rows bound to fail
+are reported as invalid instead of uploaded.
+
+    TABS_API_KEY=... python tabs_bulk_attach.py --mapping invoice_mapping.csv --concurrency 16
+"""
+import argparse
+import asyncio
+import hashlib
 import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
-import requests
+
+import tabs_client
+from invoice_cache import InvoiceCache, invoice_cache_path
+from loanlogics_usage_transformer import SESSION_DIR, check_invoice_pairs
+from upload_journal import STATUS_FAILED, STATUS_STARTED, STATUS_SUCCESS, UploadJournal
 
 # ========= CONFIGURATION =========
-API_KEY = "YOUR_TABS_API_KEY"
-API_URL_BASE = "https://api.tabs.dev/v3/customers"
+API_KEY = os.environ.get("TABS_API_KEY", "")
 OUTPUT_DIR = "output_usage_chunks"
 MAPPING_FILE = "invoice_mapping.csv"
+CONCURRENCY = 16
+READ_BLOCK = 64 * 1024
 # =================================
 
 
-def bulk_attach():
-    mapping = pd.read_csv(MAPPING_FILE)
+class StreamingFileBody:
+    """``multipart/form-data`` body of one file, read from disk while it is sent.
 
-    for _, row in mapping.iterrows():
-        cust_id = str(row["customer_id"])
-        invoice_id = str(row["invoice_id"])
-        csv_path = os.path.join(OUTPUT_DIR, f"tabs_upload_{cust_id}.csv")
+    ``requests`` sends it with a Content-Length (from ``len``) in blocks read
+    by ``read``; ``seek(0)`` rewinds it for a retry."""
 
-        if not os.path.exists(csv_path):
-            print(f"⚠️ Skipping {cust_id} — no CSV found")
-            continue
+    def __init__(self, path: str, field: str = "file", content_type: str = "text/csv"):
+        self.boundary = uuid.uuid4().hex
+        self._head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{os.path.basename(path)}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._file = open(path, "rb")
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._position = 0
 
-        with open(csv_path, "rb") as f:
-            res = requests.post(
-                f"{API_URL_BASE}/{cust_id}/invoices/{invoice_id}/attachments",
-                headers={"Authorization": f"Bearer {API_KEY}"},
-                files={"file": (os.path.basename(csv_path), f, "text/csv")},
-            )
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self._size + len(self._tail)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self) - self._position
+        parts = []
+        while size > 0 and self._position < len(self):
+            if self._position < len(self._head):
+                part = self._head[self._position:self._position + size]
+            elif self._position < len(self._head) + self._size:
+                part = self._file.read(min(size, len(self._head) + self._size - self._position))
+                if not part:  # the file shrank while being sent
+                    raise OSError(f"{self._file.name} changed during upload")
+            else:
+                offset = self._position - len(self._head) - self._size
+                part = self._tail[offset:offset + size]
+            parts.append(part)
+            self._position += len(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    def __iter__(self):
+        while True:
+            block = self.read(READ_BLOCK)
+            if not block:
+                return
+            yield block
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if offset or whence:
+            raise OSError("StreamingFileBody can only be rewound to the start")
+        self._file.seek(0)
+        self._position = 0
+        return 0
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def file_hash(path: str) -> str:
+    """``upload_journal.content_hash`` of a file, read in blocks."""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_jobs(mapping_file: str, output_dir: str) -> list[dict]:
+    """One job (customer_id, invoice_id, path) per mapping row."""
+    mapping = pd.read_csv(mapping_file, dtype=str).fillna("")
+    filenames = (
+        mapping["split_csv_filename"] if "split_csv_filename" in mapping.columns
+        else "tabs_upload_" + mapping["customer_id"] + ".csv"
+    )
+    return [
+        {"customer_id": customer_id, "invoice_id": invoice_id, "path": os.path.join(output_dir, filename)}
+        for customer_id, invoice_id, filename in zip(mapping["customer_id"], mapping["invoice_id"], filenames)
+    ]
+
+
+def result_row(job: dict, status: str = "Failed", reason: str = "") -> dict:
+    return {
+        "file": os.path.basename(job["path"]),
+        "customer_id": job["customer_id"],
+        "invoice_id": job["invoice_id"],
+        "status": status,
+        "reason": reason,
+        "http_status": None,
+        "seconds": 0.0,
+    }
 
-        if res.status_code in (200, 201):
-            print(f"✅ Attached {csv_path} to invoice {invoice_id}")
+
+def check_jobs(jobs: list[dict], api_key: str, cache_dir: str, max_workers: int) -> tuple[list[dict], list[dict]]:
+    """(jobs whose invoice can take the attachment, result rows of the others);
+    see ``check_invoice_pairs``. Uses the invoice cache the app keeps for ``api_key``."""
+    cache = InvoiceCache(invoice_cache_path(tabs_client.scoped_cache_dir(cache_dir), api_key)).load()
+    issues = check_invoice_pairs([(job["customer_id"], job["invoice_id"]) for job in jobs], cache, api_key, max_workers)
+    valid = [job for job, issue in zip(jobs, issues) if not issue]
+    invalid = [result_row(job, "Invalid", issue) for job, issue in zip(jobs, issues) if issue]
+    return valid, invalid
+
+
+def attach_file(job: dict, api_key: str, journal: UploadJournal | None = None) -> dict:
+    """Upload one job's CSV (blocking). Returns its result row."""
+    result = result_row(job)
+    started = time.perf_counter()
+    try:
+        if not os.path.exists(job["path"]):
+            result.update(status="Missing", reason="No CSV found")
+            return result
+        csv_hash = file_hash(job["path"]) if journal is not None else None
+        if journal is not None:
+            if journal.is_uploaded(job["invoice_id"], csv_hash):
+                result.update(status="Skipped", reason="Already uploaded")
+                return result
+            journal.record(job["invoice_id"], csv_hash, STATUS_STARTED, result["file"], job["customer_id"])
+        body = StreamingFileBody(job["path"])
+        try:
+            response = tabs_client.post(
+                f"customers/{job['customer_id']}/invoices/{job['invoice_id']}/attachments",
+                api_key,
+                data=body,
+                headers={"Content-Type": body.content_type},
+            )
+        except Exception as e:
+            result["reason"] = str(e)
         else:
-            print(f"❌ Failed for {cust_id} ({res.status_code}): {res.text}")
+            result["http_status"] = response.status_code
+            if response.status_code in (200, 201):
+                result["status"] = "Success"
+            else:
+                result["reason"] = response.text[:200]
+        finally:
+            body.close()
+        if journal is not None:
+            journal.record(
+                job["invoice_id"], csv_hash, STATUS_SUCCESS if result["status"] == "Success" else STATUS_FAILED,
+                result["file"], job["customer_id"], result["reason"],
+            )
+        return result
+    except OSError as e:
+        result["reason"] = str(e)
+        return result
+    finally:
+        result["seconds"] = round(time.perf_counter() - started, 3)
+
+
+async def attach_all(jobs: list[dict], api_key: str, concurrency: int = CONCURRENCY,
+                     journal: UploadJournal | None = None, on_result=None) -> list[dict]:
+    """Upload every job with at most ``concurrency`` in flight; result rows in
+    job order. ``on_result(result)`` is called on the event loop as each finishes."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    # A dedicated pool: the loop's default executor may have fewer threads than ``concurrency``
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="attach") as executor:
+
+        async def _attach(job):
+            async with semaphore:
+                result = await loop.run_in_executor(executor, attach_file, job, api_key, journal)
+            if on_result:
+                on_result(result)
+            return result
+
+        return await asyncio.gather(*(_attach(job) for job in jobs))
+
+
+def print_result(result: dict) -> None:
+    if result["status"] == "Success":
+        print(f"✅ Attached {result['file']} to invoice {result['invoice_id']} ({result['seconds']:.2f}s)")
+    elif result["status"] == "Skipped":
+        print(f"⏭️ Skipping {result['file']} — already attached to invoice {result['invoice_id']}")
+    elif result["status"] == "Invalid":
+        print(f"🚫 Not uploading {result['file']} — {result['reason']}")
+    elif result["status"] == "Missing":
+        print(f"⚠️ Skipping {result['customer_id']} — no CSV found ({result['file']})")
+    else:
+        status = f" ({result['http_status']})" if result["http_status"] else ""
+        print(f"❌ Failed for {result['customer_id']}{status}: {result['reason']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mapping", default=MAPPING_FILE, help="invoice mapping CSV (default: %(default)s)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR, help="directory of the CSVs (default: %(default)s)")
+    parser.add_argument("--api-key", default=API_KEY, help="Tabs API key (default: $TABS_API_KEY)")
+    parser.add_argument("--api-base-url", default=tabs_client.TABS_API_BASE_URL,
+                        help="Tabs v3 API root (default: $TABS_API_BASE_URL or %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="uploads in flight (default: %(default)s)")
+    parser.add_argument("--rate-limit", type=float,
+                        help="requests/second across all uploads, 0 for none (default: $TABS_RATE_LIMIT or 20)")
+    parser.add_argument("--rate-burst", type=float, help="requests sent at once before pacing (default: twice the rate)")
+    parser.add_argument("--journal", help="upload journal: skip uploads it records as done, record new ones")
+    parser.add_argument("--check-invoices", action="store_true",
+                        help="check every invoice before uploading; rows bound to fail are not uploaded")
+    parser.add_argument("--cache-dir", default=SESSION_DIR,
+                        help="where the app keeps its invoice cache, used by --check-invoices (default: %(default)s)")
+    parser.add_argument("--results", help="write one result row per upload to this CSV")
+    args = parser.parse_args(argv)
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or $TABS_API_KEY)")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
+    tabs_client.set_base_url(args.api_base_url)
+    if args.rate_limit is not None or args.rate_burst:
+        tabs_client.configure_rate_limit(
+            tabs_client.RATE_LIMIT_PER_SEC if args.rate_limit is None else args.rate_limit, args.rate_burst)
+    journal = UploadJournal(args.journal) if args.journal else None
+    jobs = read_jobs(args.mapping, args.output_dir)
+
+    started = time.perf_counter()
+    invalid = []
+    if args.check_invoices:
+        print(f"\n🔹 Checking {len(jobs)} invoices")
+        jobs, invalid = check_jobs(jobs, args.api_key, args.cache_dir, args.concurrency)
+        for result in invalid:
+            print_result(result)
+        print(f"{'✅' if not invalid else '⚠️'} {len(jobs)} invoices OK, {len(invalid)} invalid")
+
+    print(f"\n🔹 Attaching {len(jobs)} CSVs ({args.concurrency} at a time)")
+    results = invalid + asyncio.run(attach_all(jobs, args.api_key, args.concurrency, journal, on_result=print_result))
+    elapsed = time.perf_counter() - started
+
+    if args.results:
+        pd.DataFrame(results, columns=["file", "customer_id", "invoice_id", "status", "reason", "http_status", "seconds"]
+                     ).to_csv(args.results, index=False)
+    counts = pd.Series([result["status"] for result in results], dtype=object).value_counts()
+    failed = int(counts.get("Failed", 0)) + int(counts.get("Missing", 0)) + int(counts.get("Invalid", 0))
+    print(f"\n{'✅' if not failed else '⚠️'} Done in {elapsed:.1f}s: {counts.get('Success', 0)}/{len(results)} attached, "
+          f"{counts.get('Skipped', 0)} already attached, {counts.get('Missing', 0)} missing, "
+          f"{counts.get('Invalid', 0)} invalid, {counts.get('Failed', 0)} failed")
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-    print("\n🔹 Starting bulk attachment process")
-    bulk_attach()
-    print("\n✅ All done!")
+    sys.exit(main())
@@ -0,0 +1,388 @@
+"""Shared HTTP layer for every Tabs API call.
+
+All requests go through one pooled, keep-alive ``requests.Session`` so the
+TCP+TLS handshake is paid once per connection instead of once per call, and
+the connection pool is shared by the worker threads of the bulk operations.
+Paged list endpoints (``/v3/invoices``, ``/v3/customers``) are read with
+``fetch_all_pages``, which fetches pages concurrently once the total is known.
+
+Every request is paced by a client-side token bucket shared by all threads
+(``$TABS_RATE_LIMIT`` requests/second in bursts of ``$TABS_RATE_BURST``,
+or as set by ``configure_rate_limit``; a rate of 0 turns pacing off), and 429/5xx responses and connection errors are retried with exponential
+backoff and full jitter, honouring ``Retry-After`` when the API sends one.
+Requests that are not idempotent (the attachment POSTs) are retried only
+when the server cannot have acted on them: no connection was made, or it
+answered 429, or 503 with ``Retry-After``. A timeout or 502 may come after
+the file was accepted, and resending would attach it twice.
+
+Observers registered with ``add_observer`` are told about every attempt
+(method, URL, status or None for a connection error, seconds); the run
+metrics use this to count calls and latencies.
+
+Calls go to ``TABS_API_BASE_URL``: the production API unless the
+``TABS_API_BASE_URL`` environment variable or ``set_base_url`` points them
+elsewhere, e.g. at the local stand-in server (``tabs_stub_server``) for
+load tests. Caches of API data are kept per base URL (``scoped_cache_dir``).
+"""
+import hashlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# ============ CONFIG ============
+DEFAULT_BASE_URL = "https://integrators.prod.api.tabsplatform.com/v3"
+TABS_API_BASE_URL = os.environ.get("TABS_API_BASE_URL", "").strip().rstrip("/") or DEFAULT_BASE_URL
+POOL_CONNECTIONS = 4   # number of hosts to keep connection pools for
+POOL_MAXSIZE = 32      # keep-alive connections kept open per host
+DEFAULT_TIMEOUT = 30
+PAGE_WORKERS = 8       # pages fetched concurrently by fetch_all_pages
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+MAX_ATTEMPTS = 5       # first try + 4 retries
+BACKOFF_BASE = 0.5     # seconds, doubled per attempt
+BACKOFF_MAX = 30.0
+# Tabs documents no rate limit: 20/s (bursts of 40) is a conservative default,
+# not a published figure. Raise it where the API takes more; any 429s then
+# still pause every thread (see ``request``).
+RATE_LIMIT_PER_SEC = float(os.environ.get("TABS_RATE_LIMIT") or 20.0)  # sustained requests/second, all threads
+RATE_LIMIT_BURST = float(os.environ.get("TABS_RATE_BURST") or 2 * RATE_LIMIT_PER_SEC)
+# =================================
+
+_session = None
+_session_lock = threading.Lock()
+_observers = []
+
+
+class TokenBucket:
+    """Thread-safe token bucket: ``acquire`` blocks until a request may be sent."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller back for ``seconds`` (the server asked us to slow down)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+def configure_rate_limit(rate: float, burst: float | None = None) -> None:
+    """Replace the shared token bucket (requests/second, burst size; by
+    default twice the rate). A rate of 0 sends requests unpaced."""
+    global _rate_limiter
+    if rate <= 0:
+        _rate_limiter = None
+    else:
+        _rate_limiter = TokenBucket(rate, burst if burst else max(1.0, rate * 2))
+
+
+_rate_limiter = None
+configure_rate_limit(RATE_LIMIT_PER_SEC, RATE_LIMIT_BURST)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for retry number ``attempt`` (0-based)."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def retry_after_seconds(response: requests.Response) -> float | None:
+    """Seconds requested by a ``Retry-After`` header (delta or HTTP date)."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _rewind_files(files) -> None:
+    """Seek file objects in a ``files=`` argument back to the start before a resend."""
+    values = files.values() if isinstance(files, dict) else (files or [])
+    for value in values:
+        if isinstance(value, (list, tuple)) and not isinstance(value, str):
+            value = value[1] if len(value) > 1 else value[0]
+        if hasattr(value, "seek"):
+            value.seek(0)
+
+
+def _connect_failed(error: Exception) -> bool:
+    """The request never reached the server: no connection could be made."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _retryable(method: str, response: requests.Response) -> bool:
+    if response.status_code not in RETRY_STATUSES:
+        return False
+    if method.upper() in IDEMPOTENT_METHODS:
+        return True
+    # Refused before processing: throttled, or unavailable and told when to come back
+    return response.status_code == 429 or (response.status_code == 503 and "Retry-After" in response.headers)
+
+
+def get_session() -> requests.Session:
+    """Return the process-wide Tabs session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # pool_block makes extra threads wait for a free connection
+                # instead of opening (and then discarding) overflow connections
+                adapter = HTTPAdapter(
+                    pool_connections=POOL_CONNECTIONS,
+                    pool_maxsize=POOL_MAXSIZE,
+                    pool_block=True,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({
+                    "Accept": "application/json",
+                    "Connection": "keep-alive",
+                })
+                _session = session
+    return _session
+
+
+def add_observer(callback) -> None:
+    """Call ``callback(method, url, status, seconds)`` after every request attempt."""
+    with _session_lock:
+        _observers.append(callback)
+
+
+def remove_observer(callback) -> None:
+    with _session_lock:
+        if callback in _observers:
+            _observers.remove(callback)
+
+
+def _notify(method: str, url: str, status: int | None, seconds: float) -> None:
+    for callback in list(_observers):
+        try:
+            callback(method, url, status, seconds)
+        except Exception:
+            pass  # metrics must never break a request
+
+
+def auth_headers(api_key: str, json_content: bool = False) -> dict:
+    """Headers sent with every Tabs call; the API key is passed through as-is."""
+    headers = {"Authorization": f"{api_key}"}
+    if json_content:
+        headers["Content-Type"] = "application/json"
+    return headers
+
+
+def set_base_url(url: str | None) -> str:
+    """Send every following call to ``url`` (the v3 API root); empty restores
+    the production API. Applies process-wide, so only for one-run processes
+    (the command line); the app takes the URL from the environment only.
+    Returns the base URL in use."""
+    global TABS_API_BASE_URL
+    TABS_API_BASE_URL = (url or "").strip().rstrip("/") or DEFAULT_BASE_URL
+    return TABS_API_BASE_URL
+
+
+def scoped_cache_dir(cache_dir: str) -> str:
+    """Where caches of API data (invoices, NetSuite IDs, the upload journal)
+    live under ``cache_dir``: ``cache_dir`` itself for the production API, a
+    subdirectory per other base URL, so a stand-in server never fills the
+    production caches."""
+    if TABS_API_BASE_URL == DEFAULT_BASE_URL:
+        return cache_dir
+    return os.path.join(cache_dir, "api_" + hashlib.md5(TABS_API_BASE_URL.encode("utf-8")).hexdigest()[:10])
+
+
+def api_url(path: str) -> str:
+    """Build an absolute URL from a path relative to the v3 API root."""
+    if path.startswith("http://") or path.startswith("https://"):
+        return path
+    return f"{TABS_API_BASE_URL}/{path.lstrip('/')}"
+
+
+def request(method: str, path: str, api_key: str, json_content: bool = False,
+            max_attempts: int = MAX_ATTEMPTS, **kwargs) -> requests.Response:
+    """Send a request through the shared session with the Tabs auth headers.
+
+    Rate-limited by the shared token bucket; 429/5xx responses and
+    connection errors are retried up to ``max_attempts`` times in total
+    (only those the server cannot have acted on for non-idempotent methods).
+    The last response is returned (or the last connection error raised).
+    """
+    headers = auth_headers(api_key, json_content=json_content)
+    headers.update(kwargs.pop("headers", None) or {})
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    url = api_url(path)
+    session = get_session()
+    for attempt in range(max_attempts):
+        last_attempt = attempt == max_attempts - 1
+        if attempt:
+            _rewind_files(kwargs.get("files"))
+            if hasattr(kwargs.get("data"), "seek"):
+                kwargs["data"].seek(0)  # a streamed body
+        rate_limiter = _rate_limiter
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, headers=headers, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if _observers:
+                _notify(method, url, None, time.perf_counter() - started)
+            if last_attempt or (method.upper() not in IDEMPOTENT_METHODS and not _connect_failed(e)):
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        if _observers:
+            _notify(method, url, response.status_code, time.perf_counter() - started)
+        if last_attempt or not _retryable(method, response):
+            return response
+        delay = retry_after_seconds(response)
+        if delay is None:
+            delay = backoff_delay(attempt)
+        else:
+            delay = min(delay, BACKOFF_MAX)
+        if response.status_code == 429:
+            # Throttled: slow every thread down, not just this one
+            if rate_limiter is not None:
+                rate_limiter.pause(delay)
+        response.close()
+        time.sleep(delay)
+    return response
+
+
+def get(path: str, api_key: str, **kwargs) -> requests.Response:
+    return request("GET", path, api_key, **kwargs)
+
+
+def post(path: str, api_key: str, **kwargs) -> requests.Response:
+    return request("POST", path, api_key, **kwargs)
+
+
+# -------- Paged list endpoints --------
+class PagedResult(NamedTuple):
+    items: list[dict]
+    pages_fetched: int
+    total_pages: int | None  # as reported by the API, None if not reported
+    failed_pages: dict[int, str]  # page -> error message
+    truncated: bool  # stopped at max_pages
+
+
+def parse_page(data: dict) -> tuple[list[dict], int | None]:
+    """Items and reported ``totalPages`` of one list response."""
+    payload = data.get("payload") or {}
+    items = payload.get("data") or data.get("data") or data.get("items") or []
+    total_pages = data.get("totalPages") or payload.get("totalPages")
+    return items, total_pages
+
+
+def fetch_page(path: str, api_key: str, page: int, limit: int, params: dict | None = None):
+    """Fetch one page; raises RuntimeError on a non-200 response."""
+    response = get(
+        path,
+        api_key,
+        json_content=True,
+        params={**(params or {}), "limit": limit, "page": page},
+        timeout=30,
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"API call failed with status {response.status_code}")
+    return parse_page(response.json())
+
+
+def fetch_all_pages(path: str, api_key: str, params: dict | None = None, limit: int = 1000,
+                    max_pages: int = 100, max_workers: int = PAGE_WORKERS,
+                    on_page=None) -> PagedResult:
+    """Fetch every page of a list endpoint.
+
+    Page 1 is fetched first to learn ``totalPages``; the remaining pages are
+    then fetched with ``max_workers`` requests in flight. If the API does not
+    report ``totalPages`` pages are fetched one by one until a short page.
+    Items are returned in page order. ``on_page(pages_done, total_pages,
+    item_count)`` is called from the calling thread after each page.
+    """
+    pages: dict[int, list[dict]] = {}
+    failed: dict[int, str] = {}
+    fetched_count = 0
+
+    def _record(page, page_items, total):
+        nonlocal fetched_count
+        pages[page] = page_items
+        fetched_count += len(page_items)
+        if on_page:
+            on_page(len(pages), total, fetched_count)
+
+    try:
+        first_page, total_pages = fetch_page(path, api_key, 1, limit, params)
+    except Exception as e:
+        return PagedResult([], 0, None, {1: str(e)}, False)
+
+    truncated = False
+    if total_pages:
+        last_page = min(int(total_pages), max_pages)
+        truncated = int(total_pages) > max_pages
+        _record(1, first_page, last_page)
+        if last_page > 1:
+            with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+                futures = {
+                    executor.submit(fetch_page, path, api_key, page, limit, params): page
+                    for page in range(2, last_page + 1)
+                }
+                for future in as_completed(futures):
+                    page = futures[future]
+                    try:
+                        _record(page, future.result()[0], last_page)
+                    except Exception as e:
+                        failed[page] = str(e)
+    else:
+        # No pagination metadata: walk pages until a short/empty one
+        _record(1, first_page, max_pages)
+        page = 1
+        page_items = first_page
+        while page_items and len(page_items) >= limit:
+            if page >= max_pages:
+                truncated = True
+                break
+            page += 1
+            try:
+                page_items, _ = fetch_page(path, api_key, page, limit, params)
+            except Exception as e:
+                failed[page] = str(e)
+                break
+            _record(page, page_items, max_pages)
+
+    items = [item for page in sorted(pages) for item in pages[page]]
+    return PagedResult(items, len(pages), total_pages, failed, truncated)
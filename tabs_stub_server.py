@@ -0,0 +1,385 @@
+"""Local stand-in for the Tabs API, for load-testing the network paths offline.
+
+Serves the endpoints the app and the command line call, from synthetic data
+held in memory:
+
+- ``GET  /v3/customers``: paged, or filtered with ``externalIds.externalId:eq:"<NS ID>"``
+- ``GET  /v3/invoices``: paged, optionally filtered with ``updatedAt:gte:"<timestamp>"``
+- ``GET  /v3/customers/{id}/invoices``: one customer's invoices, optionally ``?issueDate=YYYY-MM-DD``
+- ``POST /v3/customers/{id}/invoices/{id}/attachments``: multipart upload, kept in memory
+
+plus ``GET /_stub/stats`` (requests, statuses and attachments received so far)
+and ``POST /_stub/reset`` (clears them).
+
+Customers come from a client mappings file (every NetSuite ID and Tabs ID in
+it) and/or ``--customers`` synthetic ones; each gets one invoice per issue
+date. Latency, random 503s, dropped connections and 429 throttling (random,
+or above a request rate) are configurable, the 503s and 429s with
+``Retry-After``, so retries, backoff and concurrency can be exercised
+without the live API:
+
+    python tabs_stub_server.py --mappings client_mappings.json --latency-ms 80 --throttle-rate 0.05
+    TABS_API_BASE_URL=http://127.0.0.1:8765/v3 streamlit run new.py
+
+Any non-empty ``Authorization`` header is accepted. Uses only the standard
+library; not meant to be exposed beyond localhost.
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# ============ CONFIG ============
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_PAGE_LIMIT = 1000
+DEFAULT_ISSUE_MONTHS = 3   # default issue dates: the 1st of this month and the months before
+# =================================
+
+_FILTER = re.compile(r'^([\w.]+):(eq|gte):"?([^"]*)"?$')
+_CUSTOMER_INVOICES = re.compile(r"^/v3/customers/([^/]+)/invoices$")
+_ATTACHMENTS = re.compile(r"^/v3/customers/([^/]+)/invoices/([^/]+)/attachments$")
+_FILENAME = re.compile(rb'filename="([^"]*)"')
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _normalize_ns_id(ns_id) -> str:
+    return str(ns_id or "").strip().replace(".0", "")
+
+
+def default_issue_dates(months: int = DEFAULT_ISSUE_MONTHS) -> list[str]:
+    """The 1st of the current month and of the ``months - 1`` before it."""
+    today = date.today()
+    dates = []
+    for back in range(months):
+        year, month = divmod(today.year * 12 + today.month - 1 - back, 12)
+        dates.append(date(year, month + 1, 1).isoformat())
+    return dates
+
+
+class StubData:
+    """Customers, invoices and received attachments, guarded by one lock."""
+
+    def __init__(self, customers: list[dict], issue_dates: list[str], seed: int = 42):
+        rng = random.Random(seed)
+        self.customers = customers
+        self.by_id = {customer["id"]: customer for customer in customers}
+        self.by_ns_id: dict[str, list[dict]] = {}
+        for customer in customers:
+            for external_id in customer["externalIds"]:
+                self.by_ns_id.setdefault(external_id["id"], []).append(customer)
+        created = _now()
+        self.invoices = [
+            {
+                "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                "customerId": customer["id"],
+                "issueDate": issue_date,
+                "status": "OPEN",
+                "source": "TABS",
+                "updatedAt": created,
+                "line_items": [{"description": f"{customer['name']} usage"}],
+            }
+            for customer in customers for issue_date in issue_dates
+        ]
+        self.invoices_by_customer: dict[str, list[dict]] = {}
+        for invoice in self.invoices:
+            self.invoices_by_customer.setdefault(invoice["customerId"], []).append(invoice)
+        self.attachments: list[dict] = []
+        self.requests: dict[str, int] = {}
+        self.statuses: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def generate(cls, mappings: dict | None = None, synthetic_customers: int = 0,
+                 issue_dates: list[str] | None = None, seed: int = 42) -> "StubData":
+        """Customers for every NetSuite and Tabs ID in ``mappings`` (shaped like
+        ``client_mappings.json``) plus ``synthetic_customers`` more."""
+        mappings = mappings or {}
+        rng = random.Random(seed)
+        customers: dict[str, dict] = {}
+        names = mappings.get("acct_to_base_name", {})
+        for acct, ns_id in mappings.get("acct_to_ns_id", {}).items():
+            ns_id = _normalize_ns_id(ns_id)
+            customer_id = str(uuid.uuid5(uuid.NAMESPACE_OID, f"netsuite:{ns_id}"))
+            customers.setdefault(customer_id, {
+                "id": customer_id,
+                "name": names.get(acct) or f"Customer NS {ns_id}",
+                "externalIds": [{"type": "NETSUITE", "id": ns_id}],
+            })
+        for key in ("acct_to_tabs_id", "parent_to_id"):
+            for label, customer_id in mappings.get(key, {}).items():
+                customers.setdefault(str(customer_id), {
+                    "id": str(customer_id),
+                    "name": names.get(label) or label,
+                    "externalIds": [],
+                })
+        for i in range(synthetic_customers):
+            customer_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            customers[customer_id] = {
+                "id": customer_id,
+                "name": f"Synthetic Customer {i}",
+                "externalIds": [{"type": "NETSUITE", "id": str(900000 + i)}],
+            }
+        return cls(list(customers.values()), issue_dates or default_issue_dates(), seed)
+
+    def count(self, endpoint: str, status: int) -> None:
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "customers": len(self.customers),
+                "invoices": len(self.invoices),
+                "attachments": len(self.attachments),
+                "attachment_bytes": sum(attachment["size"] for attachment in self.attachments),
+                "requests": dict(self.requests),
+                "statuses": dict(self.statuses),
+            }
+
+    def reset(self) -> None:
+        with self.lock:
+            self.attachments.clear()
+            self.requests.clear()
+            self.statuses.clear()
+
+
+class Faults:
+    """Injected latency and failures. ``rate_limit`` (requests/second, 0 for
+    none) throttles with 429s the way the API does under load."""
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0,
+                 throttle_rate: float = 0, drop_rate: float = 0, rate_limit: float = 0,
+                 retry_after: float = 1, seed: int | None = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.drop_rate = drop_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._tokens = float(rate_limit)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _over_rate_limit(self) -> bool:
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(float(self.rate_limit), self._tokens + (now - self._updated) * self.rate_limit)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return False
+            return True
+
+    def decide(self) -> tuple[float, str | None]:
+        """Seconds to wait before answering, and the fault to answer with
+        (``"drop"``, ``"throttle"``, ``"error"`` or None)."""
+        with self._lock:
+            delay = max(0.0, self.latency_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            roll = self._rng.random()
+        if self._over_rate_limit():
+            return delay, "throttle"
+        for fault, rate in (("drop", self.drop_rate), ("throttle", self.throttle_rate), ("error", self.error_rate)):
+            if roll < rate:
+                return delay, fault
+            roll -= rate
+        return delay, None
+
+
+def _paged(items: list, query: dict) -> dict:
+    try:
+        limit = max(1, min(MAX_PAGE_LIMIT, int(query.get("limit", [MAX_PAGE_LIMIT])[0])))
+        page = max(1, int(query.get("page", [1])[0]))
+    except ValueError:
+        limit, page = MAX_PAGE_LIMIT, 1
+    total_pages = max(1, -(-len(items) // limit))
+    return {"payload": {
+        "data": items[(page - 1) * limit:page * limit],
+        "currentPage": page,
+        "totalPages": total_pages,
+        "totalItems": len(items),
+    }}
+
+
+def _parse_filter(query: dict) -> tuple[str, str, str] | None:
+    match = _FILTER.match(query.get("filter", [""])[0])
+    return match.groups() if match else None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Request handler; the server carries ``data`` (StubData) and ``faults`` (Faults)."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    server_version = "TabsStub/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _send(self, status: int, body: dict | None = None, headers: dict | None = None) -> None:
+        data = json.dumps(body if body is not None else {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method: str) -> None:
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        data, faults = self.server.data, self.server.faults
+
+        if url.path == "/_stub/stats" and method == "GET":
+            return self._send(200, data.stats())
+        if url.path == "/_stub/reset" and method == "POST":
+            data.reset()
+            return self._send(200, {"reset": True})
+
+        endpoint, status, response = self._route(method, url.path, query, body)
+        delay, fault = faults.decide()
+        if delay:
+            time.sleep(delay)
+        if fault == "drop":
+            data.count(endpoint, 0)
+            self.close_connection = True
+            return
+        if fault == "throttle":
+            status, response = 429, {"error": "Too Many Requests"}
+        elif fault == "error":
+            status, response = 503, {"error": "Service Unavailable (injected)"}
+        if status == 201 and method == "POST":
+            customer_id, invoice_id = _ATTACHMENTS.match(url.path).groups()
+            filename = _FILENAME.search(body)
+            with data.lock:
+                data.attachments.append({
+                    "customer_id": customer_id,
+                    "invoice_id": invoice_id,
+                    "filename": filename.group(1).decode("utf-8", "replace") if filename else "",
+                    "size": len(body),
+                })
+        data.count(endpoint, status)
+        # Injected refusals say when to come back, so clients may resend even a POST
+        self._send(status, response, {"Retry-After": f"{faults.retry_after:g}"} if fault in ("throttle", "error") else None)
+
+    def _route(self, method: str, path: str, query: dict, body: bytes) -> tuple[str, int, dict]:
+        """(endpoint name, status, JSON body) of a request, before injected faults."""
+        data = self.server.data
+        if not self.headers.get("Authorization"):
+            return f"{method} {path}", 401, {"error": "Unauthorized"}
+        if method == "GET" and path == "/v3/customers":
+            condition = _parse_filter(query)
+            if condition and condition[0] == "externalIds.externalId" and condition[1] == "eq":
+                return "GET customers?filter", 200, {"payload": {"data": data.by_ns_id.get(_normalize_ns_id(condition[2]), [])}}
+            return "GET customers", 200, _paged(data.customers, query)
+        if method == "GET" and path == "/v3/invoices":
+            invoices = data.invoices
+            condition = _parse_filter(query)
+            if condition and condition[0] == "updatedAt" and condition[1] == "gte":
+                invoices = [invoice for invoice in invoices if invoice["updatedAt"][:19] >= condition[2][:19]]
+            return "GET invoices", 200, _paged(invoices, query)
+        match = _CUSTOMER_INVOICES.match(path)
+        if method == "GET" and match:
+            if match.group(1) not in data.by_id:
+                return "GET customers/{id}/invoices", 404, {"error": "Customer not found"}
+            invoices = data.invoices_by_customer.get(match.group(1), [])
+            issue_date = query.get("issueDate", [""])[0]
+            if issue_date:
+                invoices = [invoice for invoice in invoices if invoice["issueDate"][:10] == issue_date[:10]]
+            return "GET customers/{id}/invoices", 200, {"data": invoices}
+        match = _ATTACHMENTS.match(path)
+        if method == "POST" and match:
+            customer_id, invoice_id = match.groups()
+            if not any(invoice["id"] == invoice_id for invoice in data.invoices_by_customer.get(customer_id, [])):
+                return "POST attachments", 404, {"error": "Invoice not found"}
+            if not _FILENAME.search(body):
+                return "POST attachments", 400, {"error": "No file in the request"}
+            return "POST attachments", 201, {"payload": {"id": str(uuid.uuid4())}}
+        return f"{method} {path}", 404, {"error": "Not found"}
+
+
+def make_server(data: StubData, faults: Faults | None = None, host: str = DEFAULT_HOST,
+                port: int = DEFAULT_PORT, verbose: bool = False) -> ThreadingHTTPServer:
+    """A stand-in server bound to ``host:port`` (port 0 picks a free one);
+    its ``base_url`` is the v3 API root to point ``tabs_client`` at."""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.data = data
+    server.faults = faults or Faults()
+    server.verbose = verbose
+    server.base_url = f"http://{host}:{server.server_address[1]}/v3"
+    return server
+
+
+def serve_in_thread(data: StubData, faults: Faults | None = None, host: str = DEFAULT_HOST,
+                    port: int = 0) -> ThreadingHTTPServer:
+    """``make_server`` serving from a daemon thread; stop it with ``shutdown()``."""
+    server = make_server(data, faults, host, port)
+    threading.Thread(target=server.serve_forever, name="tabs-stub-server", daemon=True).start()
+    return server
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--mappings", help="client mappings JSON whose NetSuite and Tabs IDs become customers")
+    parser.add_argument("--customers", type=int, default=0, help="synthetic customers to add")
+    parser.add_argument("--issue-dates", help="comma-separated invoice issue dates (default: the 1st of the last 3 months)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every response")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="latency varies by up to this much either way")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered 503")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="fraction of requests answered 429")
+    parser.add_argument("--drop-rate", type=float, default=0, help="fraction of connections closed without a response")
+    parser.add_argument("--rate-limit", type=float, default=0, help="requests/second above which 429s are sent (0: none)")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds sent with 429s and 503s")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+
+    mappings = {}
+    if args.mappings:
+        with open(args.mappings, "r", encoding="utf-8") as f:
+            mappings = json.load(f)
+    issue_dates = [d.strip() for d in args.issue_dates.split(",") if d.strip()] if args.issue_dates else None
+    data = StubData.generate(mappings, args.customers, issue_dates, args.seed)
+    faults = Faults(args.latency_ms, args.jitter_ms, args.error_rate, args.throttle_rate,
+                    args.drop_rate, args.rate_limit, args.retry_after, args.seed)
+    server = make_server(data, faults, args.host, args.port, args.verbose)
+    print(f"🔌 Tabs stand-in API at {server.base_url}: {len(data.customers):,} customers, "
+          f"{len(data.invoices):,} invoices")
+    print(f"   Point the app or the command line at it with TABS_API_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
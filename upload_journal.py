@@ -0,0 +1,72 @@
+"""Persistent journal of invoice attachment uploads.
+
+Every upload is recorded under (invoice_id, content hash of the CSV) in an
+append-only JSON-lines file, so a bulk upload interrupted by a dead session
+or browser reload can be re-run: items that already landed are skipped and
+only failed or unfinished ones are sent again.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+
+from frame_cache import content_hash  # noqa: F401  (re-exported: journal entries are keyed by it)
+
+STATUS_STARTED = "started"    # request sent, outcome unknown
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+
+
+class UploadJournal:
+    """Latest upload status per (invoice_id, content hash), backed by a JSONL file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: dict[tuple[str, str], dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from an interrupted write
+                    self._entries[(entry["invoice_id"], entry["hash"])] = entry
+
+    def status(self, invoice_id, data_hash: str) -> str | None:
+        entry = self._entries.get((str(invoice_id), data_hash))
+        return entry["status"] if entry else None
+
+    def is_uploaded(self, invoice_id, data_hash: str) -> bool:
+        return self.status(invoice_id, data_hash) == STATUS_SUCCESS
+
+    def record(self, invoice_id, data_hash: str, status: str, filename: str = "",
+               customer_id="", reason: str = "") -> None:
+        entry = {
+            "invoice_id": str(invoice_id),
+            "hash": data_hash,
+            "status": status,
+            "filename": filename,
+            "customer_id": str(customer_id),
+            "reason": reason,
+            "timestamp": datetime.now().isoformat(),
+        }
+        with self._lock:
+            self._entries[(entry["invoice_id"], data_hash)] = entry
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def counts(self) -> dict[str, int]:
+        counts: dict[str, int] = {}
+        for entry in self._entries.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return counts
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,98 @@
+"""Declared column types for the Income, LBPA and usage CSVs.
+
+Left to itself ``pd.read_csv`` infers every column from scratch, so names and
+IDs end up as one string object per row. Reading these repeated text columns
+as categoricals stores each distinct value once and lets groupby and map work
+on integer codes; count columns are kept in the smallest integer type that
+holds them.
+
+Categorical columns are read as text, so their values are written back to
+CSV exactly as they appeared in the file. ``SubmissionDate`` is left as text
+in the rows (the split CSVs repeat it verbatim) and is parsed once per
+distinct value with ``parse_dates`` where usage is aggregated.
+"""
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+# ============ CONFIG ============
+# Repeated names and IDs of the Income/LBPA transaction exports
+TRANSACTION_CATEGORIES = ("CustomerName", "AccountName", "AccountID", "ApplicationTypeName")
+TRANSACTION_COUNTS = ("UnitsAsPerSubmission", "IsInitialSubmission")
+# Columns of the generated usage CSV (LoanLogics_upload_All.csv)
+USAGE_CATEGORIES = ("customer_id", "CustomerName", "event_type_name", "ApplicationTypeName", "differentiator")
+# =================================
+
+
+def transaction_dtypes(default=None) -> dict:
+    """``dtype=`` for reading a transaction export; with ``default`` every other
+    column is read as that type (e.g. ``str`` when streaming)."""
+    dtypes = {col: "category" for col in TRANSACTION_CATEGORIES}
+    return defaultdict(lambda: default, dtypes) if default is not None else dtypes
+
+
+def compact_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """Downcast integer count columns in place (values and CSV output unchanged)."""
+    for col in TRANSACTION_COUNTS:
+        if col in df.columns and pd.api.types.is_integer_dtype(df[col].dtype):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    return df
+
+
+def to_counts(series: pd.Series) -> pd.Series:
+    """Numeric counts with blanks and text as 0; compact integer columns are
+    widened back to int64 so sums of them cannot overflow."""
+    counts = pd.to_numeric(series, errors="coerce").fillna(0)
+    if pd.api.types.is_integer_dtype(counts.dtype):
+        counts = counts.astype(np.int64)
+    return counts
+
+
+def read_transactions(source, **kwargs) -> pd.DataFrame:
+    """Read an Income or LBPA export with the declared column types."""
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return compact_counts(pd.read_csv(source, dtype=transaction_dtypes(), **kwargs))
+
+
+def read_usage(source, **kwargs) -> pd.DataFrame:
+    """Read a generated usage CSV with the declared column types."""
+    return pd.read_csv(source, dtype={col: "category" for col in USAGE_CATEGORIES}, **kwargs)
+
+
+def map_text(series: pd.Series, func, missing=None) -> pd.Series:
+    """``func(series.astype(str))``, computed once per distinct value when
+    ``series`` is categorical (the result is then categorical too, with sorted
+    categories). ``func`` takes and returns a Series of strings; missing values
+    give ``missing`` (left missing by default)."""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        result = func(series.astype(str))
+        return result if missing is None else result.fillna(missing)
+    values = func(pd.Series(series.cat.categories.astype(str))).tolist()
+    # Code -1 (missing) picks the extra last entry
+    codes, categories = pd.factorize(pd.Series(values + [missing]), sort=True)
+    return pd.Series(pd.Categorical.from_codes(codes.take(series.cat.codes.to_numpy()), categories),
+                     index=series.index)
+
+
+def map_values(series: pd.Series, mapping: dict) -> pd.Series:
+    """``series.map(mapping)``, looked up once per distinct value when ``series``
+    is categorical; the result is plain values either way."""
+    return decode(series.map(mapping))
+
+
+def decode(series: pd.Series) -> pd.Series:
+    """Categorical ``series`` as plain values (other series are returned as-is)."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.astype(series.cat.categories.dtype)
+    return series
+
+
+def parse_dates(series: pd.Series) -> pd.Series:
+    """``pd.to_datetime(series, errors="coerce")``, parsing each distinct value once."""
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return series
+    codes, uniques = pd.factorize(series)
+    parsed = pd.DatetimeIndex(pd.to_datetime(pd.Series(uniques), errors="coerce"))
+    return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=series.index)